@@ -0,0 +1,665 @@
+import asyncio
+import os
+import stat
+import sys
+import time
+
+import redis.asyncio as aioredis
+
+from chat_scripts import ChatScripts
+from fact_store import FactStore
+from message_codec import CODECS, decode_envelope, get_codec, make_envelope, raw_client, text
+from redis_chatroom import (INBOX_MAXLEN, INBOX_PAGE_SIZE, LISTEN_TIMEOUT, PRESENCE_INTERVAL, PRESENCE_PRUNE_BATCH,
+                            PRESENCE_TTL, RATE_LIMITS, USERS_PAGE_SIZE, WELCOME_MESSAGE, GOODBYE_MESSAGE,
+                            rate_limit_windows)
+from terminal_renderer import format_message
+
+
+class ThreadedLineReader:
+    """
+    Reads lines from a file in a worker thread, for input the event loop cannot watch (a regular file)
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def readline(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.stream.readline)
+
+
+async def open_stdin_reader():
+    """
+    Wrap stdin in an asyncio StreamReader so reading input never blocks the event loop
+    """
+    mode = os.fstat(sys.stdin.fileno()).st_mode
+    # Only pipes, sockets and terminals can be watched by the event loop; input redirected from a file (or
+    # /dev/null) is read in a worker thread instead
+    if not (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or sys.stdin.isatty()):
+        return ThreadedLineReader(sys.stdin.buffer)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    return reader
+
+
+class AsyncRedisChatbot:
+    """
+    An asyncio version of the chatbot. Reading input, receiving pub/sub messages and handling commands
+    all run as coroutines on one event loop, so incoming messages are shown as soon as they arrive and
+    one process can host many sessions (for example behind a bridge or a bot).
+    """
+    def __init__(self, host='my-redis', port=6379, client=None, reader=None, writer=None, codec="json", rate_limits=None):
+        # Sessions can share a client (and therefore its connection pool); otherwise create our own
+        self.owns_client = client is None
+        self.client = client if client is not None else aioredis.Redis(host=host, port=port, decode_responses=True)
+        # The same scripts as the terminal chatbot; registering them sends nothing until they are first called
+        self.scripts = ChatScripts(self.client)
+        self.facts = FactStore(self.scripts)
+        # The same limits as the terminal chatbot, kept in the same Redis windows, so they hold across both
+        self.rate_limits = dict(RATE_LIMITS) if rate_limits is None else rate_limits
+        # Created on the first subscribe
+        self.pubsub_client = None
+        self.pubsub = None
+        # Format outgoing messages are encoded in; incoming messages are decoded whatever their format
+        self.codec = get_codec(codec)
+        self.current_user = None
+        self.listening = False
+        self.listener_task = None
+        # Keeps the current user in the presence set, like the terminal chatbot's heartbeat thread
+        self.heartbeat_task = None
+        self.heartbeat_stop = asyncio.Event()
+        # Where input comes from and output goes to; None means the terminal
+        self.reader = reader
+        self.writer = writer
+
+    def display(self, text="", end="\n"):
+        """
+        Show text to the user, either on the terminal or on the session's stream
+        """
+        if self.writer is None:
+            print(text, end=end)
+            sys.stdout.flush()
+        else:
+            self.writer.write(f"{text}{end}".encode())
+
+    async def read_line(self):
+        """
+        Read one line of input without blocking other coroutines. Raises EOFError when input is closed
+        """
+        if self.reader is None:
+            self.reader = await open_stdin_reader()
+        line = await self.reader.readline()
+        if not line:
+            raise EOFError
+        return line.decode().rstrip("\r\n")
+
+    async def prompt(self, text):
+        """
+        Ask the user a question and wait for the answer
+        """
+        self.display(text, end="")
+        if self.writer is not None:
+            await self.writer.drain()
+        return await self.read_line()
+
+    def rate_limit_key(self, command, username, scope=None):
+        """
+        Name of the sorted set of a user's recent uses of a rate-limited command, optionally per channel or recipient
+        """
+        return f"rate:{command}:{username}" if scope is None else f"rate:{command}:{username}:{scope}"
+
+    async def check_rate(self, command, scope=None):
+        """
+        Count one use of a rate-limited command, in one round trip. Returns 0 if it is allowed, otherwise how many
+        seconds to wait before it will be. Users who have not identified themselves share one limit
+        """
+        username = self.current_user or "anonymous"
+        keys, args = rate_limit_windows(self.rate_limits, command, scope,
+                                        lambda window: self.rate_limit_key(command, username, window))
+        if not keys:
+            return 0
+        return await self.scripts.rate_limit(keys=keys, args=args) / 1000
+
+    async def subscribe(self, *channels):
+        """
+        Subscribe this session to one or more channels
+        """
+        if self.pubsub is None:
+            # The pubsub connection returns bytes, since messages may be in a binary format
+            self.pubsub_client = raw_client(self.client)
+            self.pubsub = self.pubsub_client.pubsub()
+        await self.pubsub.subscribe(*channels)
+
+    async def unsubscribe(self, *channels):
+        """
+        Unsubscribe this session from one or more channels
+        """
+        await self.pubsub.unsubscribe(*channels)
+
+    async def create_user(self, username, age, gender, location):
+        """
+        Store the user's profile, set up their private inbox and start listening for messages.
+        Returns how many unread private messages are waiting for the user
+        """
+        join_date = time.strftime("%Y-%m-%d %I:%M:%S", time.localtime())
+        private_channel = f"{username} private inbox"
+
+        # The same script as the terminal chatbot: store the profile, register the private inbox, index the user
+        # and read their unread count in one atomic round trip
+        profile = ["name", username, "age", age, "gender", gender, "location", location, "join_date", join_date]
+        keys = [f"user:{username}", f"channels:{username}", "users", f"unread:{username}"]
+        unread = await self.scripts.identify_user(keys=keys, args=[username, private_channel, time.time(), *profile])
+        # Identifying as someone else signs the previous user out
+        if self.current_user and self.current_user != username:
+            await self.go_offline()
+        self.current_user = username
+
+        await self.subscribe(private_channel)
+        # Mark the user as online for as long as they are here
+        self.start_heartbeat()
+        self.start_listening()
+        return unread
+
+    async def join(self, channel):
+        """
+        Add the channel to the user's channels and subscribe to it
+        """
+        # The same script as the terminal chatbot, so the join is recorded where the maintenance worker looks for it
+        keys = [f"user:{self.current_user}", f"channels:{self.current_user}", "channel_names", "channel_joins"]
+        await self.scripts.join_channel(keys=keys, args=[channel])
+        await self.subscribe(channel)
+
+    async def leave(self, channel):
+        """
+        Remove the channel from the user's channels and unsubscribe from it
+        """
+        await self.client.srem(f"channels:{self.current_user}", channel)
+        await self.unsubscribe(channel)
+
+    async def publish(self, channel, message):
+        """
+        Publish a message to a channel. Returns True if the user is a member of the channel
+        """
+        envelope = make_envelope(self.current_user, message)
+        # Publish the message, record the channel and check membership in one round trip
+        pipe = self.client.pipeline(transaction=False)
+        pipe.publish(channel, self.codec.encode(envelope))
+        pipe.sadd("channel_names", channel)
+        pipe.sismember(f"channels:{self.current_user}", channel)
+        _, _, is_member = await pipe.execute()
+        return is_member
+
+    async def publish_private(self, recipient, message):
+        """
+        Put a private message in the recipient's inbox and publish it to their private channel, in one atomic round trip.
+        Returns -1 if the recipient does not exist, otherwise how many subscribers received it right away
+        """
+        envelope = make_envelope(self.current_user, message, private=True)
+        keys = [f"user:{recipient}", f"inbox:{recipient}", f"unread:{recipient}"]
+        # The same script as the terminal chatbot; the inbox keeps the JSON form whatever codec the sender uses
+        args = [CODECS["json"].encode(envelope), self.codec.encode(envelope), f"{recipient} private inbox",
+                INBOX_MAXLEN, "PUBLISH"]
+        return await self.scripts.send_private(keys=keys, args=args)
+
+    async def delete_user(self):
+        """
+        Delete the current user's profile and unsubscribe from all of their channels
+        """
+        username = self.current_user
+        # Stop heartbeating first, so a heartbeat cannot put the user back in the presence set after the script
+        # has removed them
+        await self.stop_heartbeat()
+        # The same script and keys as the terminal chatbot, so the user's inbox, unread count, last seen entries
+        # and presence go with their profile and a new user with the same name starts with none of them
+        keys = [f"user:{username}", f"channels:{username}", f"last_seen:{username}", "users", "presence",
+                f"inbox:{username}", f"unread:{username}"]
+        channels = await self.scripts.delete_user(keys=keys, args=[username])
+        private_channel = f"{username} private inbox"
+        await self.unsubscribe(private_channel, *channels)
+        await self.stop_listening()
+        self.current_user = None
+
+    def start_heartbeat(self):
+        """
+        Start the heartbeat coroutine, if it is not already running
+        """
+        if self.heartbeat_task is not None:
+            return
+        self.heartbeat_stop.clear()
+        self.heartbeat_task = asyncio.ensure_future(self.send_heartbeats())
+
+    async def stop_heartbeat(self):
+        """
+        Stop the heartbeat coroutine and wait for it to finish
+        """
+        if self.heartbeat_task is None:
+            return
+        # Woken rather than cancelled, so a heartbeat on the shared connection pool is never cut off halfway
+        self.heartbeat_stop.set()
+        await self.heartbeat_task
+        self.heartbeat_task = None
+
+    async def send_heartbeats(self):
+        """
+        Heartbeat every PRESENCE_INTERVAL seconds until told to stop
+        """
+        while True:
+            try:
+                await self.heartbeat()
+            except (aioredis.ConnectionError, aioredis.TimeoutError):
+                # Presence catches up on the next heartbeat once Redis is back
+                pass
+            try:
+                await asyncio.wait_for(self.heartbeat_stop.wait(), PRESENCE_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    async def heartbeat(self):
+        """
+        Record that the current user is online and prune a batch of users who stopped heartbeating, in one round trip
+        """
+        username = self.current_user
+        if not username:
+            return
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd("presence", {username: now})
+        await self.scripts.prune_presence(keys=["presence"], args=[now - PRESENCE_TTL, PRESENCE_PRUNE_BATCH], client=pipe)
+        await pipe.execute()
+
+    async def go_offline(self):
+        """
+        Remove the current user from the presence set, so they are not shown as online until their heartbeat expires
+        """
+        if self.current_user:
+            await self.client.zrem("presence", self.current_user)
+
+    def start_listening(self):
+        """
+        Start the listener coroutine, if it is not already running
+        """
+        if self.listening:
+            return
+        self.listening = True
+        self.listener_task = asyncio.ensure_future(self.listen_for_messages())
+
+    async def stop_listening(self):
+        """
+        Stop the listener coroutine and wait for it to finish
+        """
+        self.listening = False
+        # The listener wakes up at least every LISTEN_TIMEOUT seconds, so this wait is bounded. It is not
+        # cancelled mid-read because that can leave the pubsub connection with a half-read reply on it
+        if self.listener_task is not None:
+            await self.listener_task
+        self.listener_task = None
+
+    async def listen_for_messages(self):
+        """
+        Wait for pub/sub messages and display each one the moment it arrives
+        """
+        while self.listening:
+            # Suspends this coroutine until the socket is readable or the timeout expires
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=LISTEN_TIMEOUT)
+            if message and message['type'] == 'message':
+                self.deliver(text(message['channel']), message['data'])
+
+    def deliver(self, channel, raw):
+        """
+        Decode a raw message published on a channel and show it to the user
+        """
+        formatted = format_message(channel, decode_envelope(raw), self.current_user)
+        if formatted:
+            self.display(formatted)
+
+    def require_user(self):
+        """
+        Return True if the user has identified themselves, otherwise tell them how to
+        """
+        if not self.current_user:
+            self.display("Please identify yourself first. Type 1 to identify yourself.\n")
+            return False
+        return True
+
+    async def identify_user(self):
+        """
+        Identify the user, set up their private inbox, and start listening for messages
+        """
+        username = await self.prompt("Enter your username: ")
+        age = await self.prompt("Enter your age: ")
+        gender = await self.prompt("Enter your gender: ")
+        location = await self.prompt("Enter your location: ")
+        unread = await self.create_user(username, age, gender, location)
+        self.display(f"Welcome {username}! You have been identified and your private inbox has been set up.\n")
+        if unread:
+            self.display(f"You have {unread} unread private message(s). Type !inbox to read them.\n")
+
+    async def join_channel(self):
+        """
+        Allow the user to join a channel
+        """
+        if not self.require_user():
+            return
+        channel = await self.prompt("Enter the channel name to join: ")
+        await self.join(channel)
+        self.display(f"You've joined the channel: {channel}\n")
+
+    async def leave_channel(self):
+        """
+        Allow the user to leave a channel
+        """
+        if not self.require_user():
+            return
+        channel = await self.prompt("Enter the channel name to leave: ")
+        await self.leave(channel)
+        self.display(f"You've left the channel: {channel}")
+
+    async def send_message(self):
+        """
+        Allow the user to send a message to a channel
+        """
+        if not self.require_user():
+            await self.identify_user()
+            return
+        channel = (await self.prompt("Enter the channel name: ")).strip()
+        message = (await self.prompt("Enter your message: ")).strip()
+        wait = await self.check_rate("send", channel)
+        if wait:
+            self.display(f"You are sending messages to {channel} too quickly. Please wait {wait:.1f} seconds and try again.\n")
+            return
+        is_member = await self.publish(channel, message)
+        self.display(f"Message sent to channel {channel}")
+
+        # If user not in channel, ask if they want to join
+        if not is_member:
+            join = await self.prompt(f"You are not in the channel {channel}. Would you like to join? (yes/no): \n")
+            if join.lower() == 'yes':
+                await self.join(channel)
+                self.display(f"You've joined the channel: {channel}\n")
+
+    async def send_private_message(self):
+        """
+        Allow the user to send a private message to another user
+        """
+        if not self.require_user():
+            return
+        recipient = await self.prompt("Enter the username of the recipient: ")
+        message = await self.prompt("Enter your private message: ")
+        wait = await self.check_rate("private", recipient)
+        if wait:
+            self.display(f"You are sending messages to {recipient} too quickly. Please wait {wait:.1f} seconds and try again.\n")
+            return
+        receivers = await self.publish_private(recipient, message)
+        if receivers < 0:
+            self.display(f"There is no user called {recipient}.\n")
+        elif receivers == 0:
+            self.display(f"{recipient} is offline. They will find your message in their inbox.\n")
+        else:
+            self.display(f"Private message sent to {recipient}\n")
+
+    async def show_inbox(self, args):
+        """
+        Show one page of the user's private messages, newest first. Reading the first page marks them all as read
+        """
+        if not self.require_user():
+            return
+        try:
+            page = int(args[0]) if args else 1
+        except ValueError:
+            page = 0
+        if page < 1:
+            self.display("Please give a page number. For example, !inbox 2\n")
+            return
+
+        # Read the page, the unread count and the inbox length, and acknowledge, in one round trip
+        inbox_key = f"inbox:{self.current_user}"
+        start = (page - 1) * INBOX_PAGE_SIZE
+        pipe = self.client.pipeline()
+        pipe.lrange(inbox_key, start, start + INBOX_PAGE_SIZE - 1)
+        pipe.llen(inbox_key)
+        if page == 1:
+            pipe.getset(f"unread:{self.current_user}", 0)
+        results = await pipe.execute()
+        payloads, total = results[0], results[1]
+        unread = int(results[2] or 0) if page == 1 else 0
+
+        if not payloads:
+            self.display("Your inbox is empty.\n" if page == 1 else f"There is no page {page} in your inbox.\n")
+            return
+        self.display(f"\nYour inbox ({unread} new):" if unread else "\nYour inbox:")
+        for payload in payloads:
+            data = decode_envelope(payload)
+            sent = time.strftime('%Y-%m-%d %I:%M:%S %p', time.localtime(data['sent_at'] / 1000))
+            self.display(f"{sent} -- {data['from']}: {data['message']}")
+        if start + len(payloads) < total:
+            self.display(f"\nFor older messages type: !inbox {page + 1}")
+        self.display()
+
+    async def delete_profile(self):
+        """
+        Allow the user to delete their profile
+        """
+        if not self.require_user():
+            return
+        confirm = await self.prompt(f"Are you sure you want to delete your profile, {self.current_user}? This action cannot be undone. (yes/no): ")
+        if confirm.lower() != 'yes':
+            self.display("Profile deletion cancelled.\n")
+            return
+        username = self.current_user
+        await self.delete_user()
+        self.display(f"Profile for {username} has been deleted.")
+
+    async def get_user_info(self):
+        """
+        Allow the user to get information about another user
+        """
+        username = await self.prompt("Enter username to get info about: ")
+        user_info = await self.client.hgetall(f"user:{username}")
+        if user_info:
+            self.display(f"Info for user {username}:\n")
+            for key, value in user_info.items():
+                self.display(f"{key.capitalize()}: {value}")
+        else:
+            self.display(f"No information found for user {username}")
+
+    async def list_all_users(self):
+        """
+        List all users in the chatroom in the order they joined, one page of profiles at a time
+        """
+        print_header = True
+        start = 0
+        while True:
+            usernames = await self.client.zrange("users", start, start + USERS_PAGE_SIZE - 1)
+            if not usernames:
+                break
+
+            # Fetch the page's profiles in one round trip
+            pipe = self.client.pipeline(transaction=False)
+            for username in usernames:
+                pipe.hgetall(f"user:{username}")
+            profiles = await pipe.execute()
+
+            if print_header:
+                self.display("\nList of all users:")
+                print_header = False
+            for username, user_info in zip(usernames, profiles):
+                self.display(f"- {username}")
+                for key, value in user_info.items():
+                    if key != 'name':
+                        self.display(f"  {key.capitalize()}: {value}")
+                self.display()
+            start += USERS_PAGE_SIZE
+
+        if print_header:
+            self.display("No users found.")
+
+    async def add_fact(self, fact):
+        """
+        Allow the user to add a fact to the set of facts in the database
+        """
+        if not fact:
+            self.display("Please provide a fact to add.")
+            return
+        wait = await self.check_rate("add_fact")
+        if wait:
+            self.display(f"You have added a lot of facts recently. Please wait {wait:.0f} seconds before adding another.\n")
+            return
+        # Added through the facts engine, so !fact can serve it and facts that only differ in case, spacing
+        # or punctuation are stored once
+        if await self.facts.add(fact, self.client):
+            self.display("\nFact added successfully! Other users can now learn from your wisdom.\n")
+        else:
+            self.display("\nSomeone already added that fact, so it has been marked as more popular instead.\n")
+
+    async def list_user_channels(self):
+        """
+        List all channels the user has joined
+        """
+        if not self.require_user():
+            return
+        channels = await self.client.smembers(f"channels:{self.current_user}")
+        if channels:
+            self.display("\nList of channels you've joined:")
+            for channel in channels:
+                self.display(f"- {channel}")
+            self.display("\n")
+        else:
+            self.display("You haven't joined any channels yet.")
+
+    async def list_channels(self):
+        """
+        List all channels available
+        """
+        channels = await self.client.smembers("channel_names")
+        if channels:
+            self.display("\nList of all channels:")
+            for channel in channels:
+                self.display(f"- {channel}")
+            self.display("\n")
+        else:
+            self.display("No channels found.")
+
+    async def get_weather(self, city):
+        """
+        Get the weather for a specific city
+        """
+        if not city:
+            self.display("Please provide a city name after the command. For example, !weather New York\n")
+            return
+        city = city.lower()
+        weather = await self.client.hget("weather", city)
+        if weather:
+            self.display(f"\nThe weather in {city.title()} is {weather}\n")
+        else:
+            self.display(f"No weather information available for {city.title()}\n")
+
+    async def get_fact(self):
+        """
+        Get a random fact from the set of facts
+        """
+        fact = await self.client.srandmember("facts")
+        if fact:
+            self.display(f"\nDid you know? {fact}\n")
+        else:
+            self.display("No facts available at the moment.")
+
+    async def get_whoami(self):
+        """
+        Get the user's information
+        """
+        if not self.require_user():
+            return
+        user_info = await self.client.hgetall(f"user:{self.current_user}")
+        if user_info:
+            self.display("Your user information:\n")
+            for key, value in user_info.items():
+                self.display(f"{key.capitalize()}: {value}")
+                self.display()
+        else:
+            self.display("No information found for your user.\n")
+
+    async def handle_special_commands(self, command):
+        """
+        Handle special commands that start with an exclamation
+        """
+        parts = command.split()
+        if parts[0] == "!help":
+            self.display(WELCOME_MESSAGE)
+        elif parts[0] == "!weather":
+            await self.get_weather(" ".join(parts[1:]))
+        elif parts[0] == "!fact":
+            await self.get_fact()
+        elif parts[0] == "!whoami":
+            await self.get_whoami()
+        elif parts[0] == "!users":
+            await self.list_all_users()
+        elif parts[0] == "!delete_profile":
+            await self.delete_profile()
+        elif parts[0] == "!inbox":
+            await self.show_inbox(parts[1:])
+        elif parts[0] == "!add_fact":
+            await self.add_fact(" ".join(parts[1:]))
+        elif parts[0] == "!list_my_channels":
+            await self.list_user_channels()
+        elif parts[0] == "!list_all_channels":
+            await self.list_channels()
+        else:
+            self.display("Unknown command. Type !help for a list of commands.")
+
+    async def handle_choice(self, choice):
+        """
+        Run the menu option or command the user typed. Returns False when the user wants to exit
+        """
+        if choice.startswith("!"):
+            await self.handle_special_commands(choice)
+        elif choice == "1":
+            await self.identify_user()
+        elif choice == "2":
+            await self.join_channel()
+        elif choice == "3":
+            await self.leave_channel()
+        elif choice == "4":
+            await self.send_message()
+        elif choice == "5":
+            await self.get_user_info()
+        elif choice == "6":
+            await self.send_private_message()
+        elif choice == "7":
+            self.display(GOODBYE_MESSAGE)
+            return False
+        else:
+            self.display("Invalid choice. Please try again.")
+        return True
+
+    async def close(self):
+        """
+        Stop listening and release this session's connections
+        """
+        await self.stop_listening()
+        await self.stop_heartbeat()
+        await self.go_offline()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+            await self.pubsub_client.aclose()
+        if self.owns_client:
+            await self.client.aclose()
+
+    async def run(self):
+        """
+        Main loop to run the chatbot
+        """
+        self.display(WELCOME_MESSAGE)
+        try:
+            while True:
+                try:
+                    choice = (await self.read_line()).strip()
+                except EOFError:
+                    break
+                if choice and not await self.handle_choice(choice):
+                    break
+        finally:
+            await self.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(AsyncRedisChatbot().run())
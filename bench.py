@@ -0,0 +1,648 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import threading
+import time
+import timeit
+
+import redis
+
+from chat_metrics import Metrics
+from chat_scripts import ChatScripts
+from fact_store import FactStore
+from message_codec import CODECS, decode_envelope, make_envelope
+from message_search import MessageIndex
+from receive_buffer import ReceiveBuffer
+from redis_chatroom import HISTORY_MAXLEN, LISTEN_TIMEOUT, RedisChatbot
+from terminal_renderer import compose_frame, format_message
+
+
+class RoundTripCounter:
+    """
+    Counts the requests a Redis client sends. A pipeline or transaction is sent as one request,
+    so this is the number of network round trips the client waits on. Only requests sent from the
+    thread that created the counter are counted, so background work such as heartbeats is left out.
+    """
+    def __init__(self, client):
+        self.count = 0
+        self.thread = threading.get_ident()
+        counter = self
+        pool = client.connection_pool
+        base = pool.connection_class
+
+        class CountingConnection(base):
+            def send_packed_command(self, command, check_health=True):
+                if threading.get_ident() == counter.thread:
+                    counter.count += 1
+                return super().send_packed_command(command, check_health)
+
+            def connect(self):
+                # Setting up a new connection is not part of the operation that needed it
+                start = counter.count
+                super().connect()
+                counter.count = start
+
+        # Connections are created lazily, so every connection the pool hands out from now on is counted
+        pool.disconnect()
+        pool.connection_class = CountingConnection
+
+    def measure(self, operation, *args):
+        """
+        Run an operation and return how many round trips it took
+        """
+        start = self.count
+        # The chatbot prints as it goes; keep that out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            operation(*args)
+        return self.count - start
+
+
+def make_client(args):
+    """
+    Connect to the Redis server under test, or to an in-process fake one
+    """
+    if args.fake:
+        import fakeredis
+        # Every client in a run shares one fake server, as they would share a real one
+        if getattr(args, "fake_server", None) is None:
+            args.fake_server = fakeredis.FakeServer()
+        return fakeredis.FakeRedis(server=args.fake_server, decode_responses=True)
+    return redis.Redis(host=args.host, port=args.port, decode_responses=True)
+
+
+# The command sequences the chatbot used before its multi-command paths were pipelined,
+# kept here so the benchmark can show the difference
+
+def baseline_create_user(chatbot, username):
+    chatbot.client.hset(f"user:{username}", mapping={"name": username, "age": "0", "gender": "n/a", "location": "n/a", "join_date": "n/a"})
+    chatbot.client.sadd(f"channels:{username}", f"{username} private inbox")
+    chatbot.pubsub.subscribe(f"{username} private inbox")
+    chatbot.current_user = username
+
+
+def baseline_join(chatbot, channel):
+    chatbot.client.sadd(f"channels:{chatbot.current_user}", channel)
+    chatbot.client.sadd("channel_names", channel)
+    chatbot.pubsub.subscribe(channel)
+
+
+def baseline_publish(chatbot, channel, message):
+    chatbot.client.publish(channel, json.dumps({"from": chatbot.current_user, "message": message}))
+    chatbot.client.sadd("channel_names", channel)
+    chatbot.client.sismember(f"channels:{chatbot.current_user}", channel)
+
+
+def baseline_list_all_users(chatbot):
+    for user_key in chatbot.client.keys("user:*"):
+        chatbot.client.hgetall(user_key)
+
+
+def baseline_delete_user(chatbot):
+    chatbot.client.delete(f"user:{chatbot.current_user}")
+    channels = chatbot.client.smembers(f"channels:{chatbot.current_user}")
+    for channel in channels:
+        chatbot.pubsub.unsubscribe(channel)
+    chatbot.client.delete(f"channels:{chatbot.current_user}")
+    chatbot.pubsub.unsubscribe(f"{chatbot.current_user} private inbox")
+    chatbot.current_user = None
+
+
+def round_trips(args):
+    """
+    Report the Redis round trips each chat operation takes, before and after pipelining
+    """
+    client = make_client(args)
+    counter = RoundTripCounter(client)
+    chatbot = RedisChatbot(client=client)
+
+    # Background users so listing users has something to list
+    pipe = client.pipeline(transaction=False)
+    for i in range(args.users):
+        pipe.hset(f"user:bench-{i}", mapping={"name": f"bench-{i}", "age": "0", "gender": "n/a", "location": "n/a"})
+        pipe.zadd("users", {f"bench-{i}": i})
+    pipe.execute()
+
+    # Open the command and pubsub connections up front so connection setup is not counted against an operation
+    chatbot.pubsub.subscribe("bench-warmup")
+    chatbot.pubsub.unsubscribe("bench-warmup")
+    client.ping()
+    # Listing users once first runs the one-off backfill of profiles from before the users index, if it is due
+    with contextlib.redirect_stdout(io.StringIO()):
+        chatbot.list_all_users()
+
+    results = {}
+    channels = [f"bench-channel-{i}" for i in range(args.channels)]
+
+    before = {}
+    before["identify"] = counter.measure(baseline_create_user, chatbot, "bench-before")
+    before["join"] = sum(counter.measure(baseline_join, chatbot, channel) for channel in channels) / len(channels)
+    before["send"] = counter.measure(baseline_publish, chatbot, channels[0], "hello")
+    before["users"] = counter.measure(baseline_list_all_users, chatbot)
+    before["delete"] = counter.measure(baseline_delete_user, chatbot)
+
+    after = {}
+    after["identify"] = counter.measure(chatbot.create_user, "bench-after", "0", "n/a", "n/a")
+    after["join"] = sum(counter.measure(chatbot.join, channel) for channel in channels) / len(channels)
+    after["send"] = counter.measure(chatbot.publish, channels[0], "hello")
+    after["users"] = counter.measure(chatbot.list_all_users)
+    after["delete"] = counter.measure(chatbot.delete_user)
+
+    for operation in before:
+        results[operation] = {"before": before[operation], "after": after[operation]}
+
+    # Clean up what the benchmark created
+    client.delete(*[f"user:bench-{i}" for i in range(args.users)])
+    client.zrem("users", *[f"bench-{i}" for i in range(args.users)])
+    client.srem("channel_names", *channels)
+    chatbot.pubsub.close()
+
+    return {"benchmark": "round-trips", "users": args.users, "channels": args.channels, "round_trips": results}
+
+
+def print_round_trips(report):
+    """
+    Print the round-trip report as a table
+    """
+    print(f"Round trips per operation ({report['users']} other users, {report['channels']} channel(s) joined)")
+    print(f"{'operation':<12}{'before':>10}{'after':>10}")
+    for operation, counts in report["round_trips"].items():
+        print(f"{operation:<12}{counts['before']:>10g}{counts['after']:>10g}")
+
+
+def codecs(args):
+    """
+    Report the encode and decode cost and the size on the wire of one message in each codec
+    """
+    message = args.message or "x" * args.message_size
+    envelope = make_envelope("alice", message, message_id="1700000000000-0", stored=True)
+    results = {}
+    for name, codec in CODECS.items():
+        payload = codec.encode(envelope)
+        encode_seconds = timeit.timeit(lambda: codec.encode(envelope), number=args.iterations)
+        # Decoding goes through format detection, as it does in the listener
+        decode_seconds = timeit.timeit(lambda: decode_envelope(payload), number=args.iterations)
+        results[name] = {
+            "bytes": len(payload),
+            "encode_us": encode_seconds / args.iterations * 1e6,
+            "decode_us": decode_seconds / args.iterations * 1e6,
+        }
+    return {"benchmark": "codec", "message_chars": len(message), "iterations": args.iterations, "codecs": results}
+
+
+def print_codecs(report):
+    """
+    Print the codec report as a table
+    """
+    print(f"Message envelope codecs ({report['message_chars']} character message, {report['iterations']} iterations)")
+    print(f"{'codec':<10}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for name, result in report["codecs"].items():
+        print(f"{name:<10}{result['bytes']:>8}{result['encode_us']:>12.2f}{result['decode_us']:>12.2f}")
+
+
+class TimedBuffer(ReceiveBuffer):
+    """
+    A receive buffer that records how long each benchmark message took to arrive instead of keeping it
+    """
+    def __init__(self, latencies):
+        super().__init__()
+        self.latencies = latencies
+
+    def put_message(self, channel, envelope):
+        # Benchmark messages carry the perf_counter() reading from when they were sent
+        sent = float(envelope["message"].split()[-1])
+        self.latencies.append(time.perf_counter() - sent)
+        return True
+
+
+def percentile(samples, fraction):
+    """
+    The value below which the given fraction of the sorted samples fall
+    """
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def load(args):
+    """
+    Drive synthetic users through the chatbot's operations and report throughput, delivery latency,
+    CPU use and round trips per operation
+    """
+    rng = random.Random(args.seed)
+    latencies = []
+    trips = {}
+    # One set of metrics for every user, so the report covers the whole run
+    metrics = Metrics() if args.metrics else None
+
+    def run(operation, counter, *op_args):
+        start = counter.count
+        operation(*op_args)
+        trips.setdefault(operation.__name__, []).append(counter.count - start)
+
+    # Something for !weather and !fact to find
+    seed_client = make_client(args)
+    seed_client.hset("weather", "bench city", "Sunny, 70°F")
+    # Facts are never removed, and adding this one again on later runs leaves it as it is
+    FactStore(ChatScripts(seed_client)).add("Benchmarks should be run more than once.", popularity=0)
+
+    users = []
+    # The chatbot prints as it goes; keep that out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(args.users):
+            client = make_client(args)
+            counter = RoundTripCounter(client)
+            chatbot = RedisChatbot(client=client, cache=not args.no_cache, codec=args.codec, metrics=metrics)
+            chatbot.message_queue = TimedBuffer(latencies)
+            run(chatbot.create_user, counter, f"bench-user-{i}", "0", "n/a", "n/a")
+            run(chatbot.join, counter, "bench-load")
+            users.append((chatbot, counter))
+        # Give the listeners time to finish subscribing
+        time.sleep(LISTEN_TIMEOUT)
+
+        sent_to_channel = sent_private = 0
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            chatbot, counter = rng.choice(users)
+            roll = rng.random()
+            if roll < args.lookups:
+                if rng.random() < 0.5:
+                    run(chatbot.get_weather, counter, "bench city")
+                else:
+                    run(chatbot.get_fact, counter)
+            elif roll < args.lookups + args.private:
+                recipient = rng.choice(users)[0]
+                run(chatbot.publish_private, counter, recipient.current_user, f"bench {time.perf_counter()!r}")
+                sent_private += 1 if recipient is not chatbot else 0
+            else:
+                run(chatbot.publish, counter, "bench-load", f"bench {time.perf_counter()!r}")
+                sent_to_channel += 1
+        publish_seconds = time.perf_counter() - start
+
+        # Wait for every delivery, or give up after the timeout
+        expected = sent_to_channel * (args.users - 1) + sent_private
+        deadline = time.perf_counter() + args.timeout
+        while len(latencies) < expected and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        total_seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+
+        for chatbot, counter in users:
+            run(chatbot.delete_user, counter)
+            chatbot.close()
+
+    seed_client.hdel("weather", "bench city")
+    seed_client.srem("channel_names", "bench-load")
+
+    samples = sorted(latencies)
+    publishes = sent_to_channel + sent_private
+    return {
+        "benchmark": "load",
+        "users": args.users,
+        "operations": args.messages,
+        "codec": args.codec,
+        "cache": not args.no_cache,
+        "publishes": publishes,
+        "publish_throughput": publishes / publish_seconds if publish_seconds else None,
+        "deliveries_expected": expected,
+        "deliveries_received": len(samples),
+        "delivery_latency_ms": {
+            "p50": percentile(samples, 0.50) * 1000 if samples else None,
+            "p99": percentile(samples, 0.99) * 1000 if samples else None,
+            "p999": percentile(samples, 0.999) * 1000 if samples else None,
+            "max": samples[-1] * 1000 if samples else None,
+        },
+        "cpu_ms_per_client": cpu_seconds / args.users * 1000,
+        "wall_seconds": total_seconds,
+        "round_trips": {operation: sum(counts) / len(counts) for operation, counts in trips.items()},
+        "metrics": metrics.snapshot() if metrics else None,
+    }
+
+
+def print_load(report):
+    """
+    Print the load report
+    """
+    print(f"{report['users']} users, {report['operations']} operations ({report['codec']} codec, cache {'on' if report['cache'] else 'off'})")
+    print(f"Publish throughput: {report['publish_throughput']:.0f} messages/s")
+    print(f"Deliveries: {report['deliveries_received']} of {report['deliveries_expected']}")
+    latency = report["delivery_latency_ms"]
+    if latency["p50"] is not None:
+        print(f"Delivery latency: p50 {latency['p50']:.2f} ms, p99 {latency['p99']:.2f} ms, "
+              f"p99.9 {latency['p999']:.2f} ms, max {latency['max']:.2f} ms")
+    print(f"CPU per client: {report['cpu_ms_per_client']:.1f} ms over {report['wall_seconds']:.2f} s")
+    print("Round trips per operation:")
+    for operation, count in report["round_trips"].items():
+        print(f"  {operation:<16}{count:g}")
+    if report["metrics"]:
+        print("Redis calls (p50/p99 are bucket bounds):")
+        for labels, histogram in report["metrics"]["histograms"]["chat_redis_command_seconds"].items():
+            print(f"  {labels:<28}{histogram['count']:>8} calls, p50 <= {histogram['p50'] * 1000:g} ms, "
+                  f"p99 <= {histogram['p99'] * 1000:g} ms")
+
+
+def search(args):
+    """
+    Index synthetic channel messages and report indexing throughput and query latency
+    """
+    rng = random.Random(args.seed)
+    client = make_client(args)
+    index = MessageIndex(client, channel_postings=HISTORY_MAXLEN)
+
+    # Word frequencies follow Zipf's law, as they do in real chat, so some posting lists are long and most are short
+    vocabulary = [f"benchw{i}" for i in range(args.vocabulary)]
+    cum_weights = []
+    total = 0
+    for rank in range(args.vocabulary):
+        total += 1 / (rank + 1)
+        cum_weights.append(total)
+    channels = [f"bench-search-{i}" for i in range(args.channels)]
+    start_ms = int(time.time() * 1000) - args.messages
+
+    start = time.perf_counter()
+    for batch_start in range(0, args.messages, args.batch):
+        pipe = client.pipeline(transaction=False)
+        for i in range(batch_start, min(batch_start + args.batch, args.messages)):
+            # One message per millisecond, so entry IDs and send times line up
+            text = " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=args.words))
+            index.add(pipe, rng.choice(channels), f"{start_ms + i}-0", start_ms + i, text)
+        pipe.execute()
+    index_seconds = time.perf_counter() - start
+
+    def query_word():
+        # Pick query words uniformly, so queries hit rare words as well as common ones
+        return rng.choice(vocabulary)
+
+    queries = {
+        "one word": lambda: (query_word(), None, None),
+        "two words": lambda: (f"{query_word()} {query_word()}", None, None),
+        "channel": lambda: (query_word(), rng.choice(channels), None),
+        "time range": lambda: (query_word(), None, start_ms + rng.randrange(args.messages)),
+    }
+    latency = {}
+    for kind, make_query in queries.items():
+        samples = []
+        for _ in range(args.queries):
+            text, channel, since = make_query()
+            query_start = time.perf_counter()
+            index.search(text, channel, since)
+            samples.append((time.perf_counter() - query_start) * 1000)
+        samples.sort()
+        latency[kind] = {"p50": percentile(samples, 0.5), "p99": percentile(samples, 0.99), "max": samples[-1]}
+
+    # Clean up what the benchmark created
+    keys = list(client.scan_iter("search:*benchw*", count=1000))
+    for batch_start in range(0, len(keys), 1000):
+        client.delete(*keys[batch_start:batch_start + 1000])
+
+    return {
+        "benchmark": "search",
+        "messages": args.messages,
+        "channels": args.channels,
+        "vocabulary": args.vocabulary,
+        "index_throughput": args.messages / index_seconds,
+        "query_latency_ms": latency,
+    }
+
+
+def print_search(report):
+    """
+    Print the search report
+    """
+    print(f"{report['messages']} messages in {report['channels']} channels, {report['vocabulary']} distinct words")
+    print(f"Indexing throughput: {report['index_throughput']:.0f} messages/s")
+    print("Query latency:")
+    for kind, latency in report["query_latency_ms"].items():
+        print(f"  {kind:<12}p50 {latency['p50']:.2f} ms, p99 {latency['p99']:.2f} ms, max {latency['max']:.2f} ms")
+
+
+def rate_limit(args):
+    """
+    Report what the rate limiter adds to the publish path, and check that a flood is cut off at the limit
+    """
+    client = make_client(args)
+    counter = RoundTripCounter(client)
+    # A limit that is never reached while timing, so every check does the full work of an allowed send
+    chatbot = RedisChatbot(client=client, cache=False, rate_limits={"send": (args.operations * 2, 60)})
+    with contextlib.redirect_stdout(io.StringIO()):
+        chatbot.create_user("bench-limited", "0", "n/a", "n/a")
+    client.ping()
+
+    def limited_publish(channel, message):
+        if not chatbot.check_rate("send", channel):
+            chatbot.publish(channel, message)
+
+    latency = {}
+    trips = {}
+    operations = {
+        "publish": chatbot.publish,
+        "check": lambda channel, message: chatbot.check_rate("send", channel),
+        "check + publish": limited_publish,
+    }
+    for name, operation in operations.items():
+        samples = []
+        start = counter.count
+        for _ in range(args.operations):
+            operation_start = time.perf_counter()
+            operation("bench-rate", "hello")
+            samples.append((time.perf_counter() - operation_start) * 1000)
+        trips[name] = (counter.count - start) / args.operations
+        samples.sort()
+        latency[name] = {"p50": percentile(samples, 0.5), "p99": percentile(samples, 0.99), "max": samples[-1]}
+        client.delete(chatbot.rate_limit_key("send", "bench-limited", "bench-rate"))
+
+    # A flood well past the limit should only get the limit's worth of messages through
+    uses, seconds = args.limit, 60
+    chatbot.rate_limits = {"send": (uses, seconds)}
+    allowed = sum(1 for _ in range(uses * 10) if not chatbot.check_rate("send", "bench-flood"))
+    # Spreading the same flood over many channels is cut off by the limit across all of the user's channels
+    spread_channels = [f"bench-flood-{number}" for number in range(10)]
+    chatbot.rate_limits = {"send": (uses, seconds), "send_total": (uses * 2, seconds)}
+    spread_allowed = sum(1 for number in range(uses * 10)
+                         if not chatbot.check_rate("send", spread_channels[number % len(spread_channels)]))
+
+    # Clean up what the benchmark created
+    with contextlib.redirect_stdout(io.StringIO()):
+        chatbot.delete_user()
+    client.delete(chatbot.rate_limit_key("send", "bench-limited", "bench-flood"), chatbot.rate_limit_key("send", "bench-limited"),
+                  *[chatbot.rate_limit_key("send", "bench-limited", channel) for channel in spread_channels])
+    client.srem("channel_names", "bench-rate")
+    chatbot.close()
+
+    return {
+        "benchmark": "rate-limit",
+        "operations": args.operations,
+        "latency_ms": latency,
+        "round_trips": trips,
+        "flood": {"sent": uses * 10, "allowed": allowed, "limit": uses, "window_seconds": seconds},
+        "spread_flood": {"sent": uses * 10, "channels": len(spread_channels), "allowed": spread_allowed,
+                         "limit": uses * 2, "window_seconds": seconds},
+    }
+
+
+def print_rate_limit(report):
+    """
+    Print the rate limiter report
+    """
+    print(f"Publish path with and without the rate limiter ({report['operations']} operations each)")
+    print(f"{'operation':<18}{'round trips':>12}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, latency in report["latency_ms"].items():
+        print(f"{name:<18}{report['round_trips'][name]:>12g}{latency['p50']:>10.3f}{latency['p99']:>10.3f}{latency['max']:>10.3f}")
+    flood = report["flood"]
+    print(f"Flood: {flood['allowed']} of {flood['sent']} sends allowed (limit {flood['limit']} per {flood['window_seconds']}s)")
+    spread = report["spread_flood"]
+    print(f"Flood over {spread['channels']} channels: {spread['allowed']} of {spread['sent']} sends allowed "
+          f"(limit {spread['limit']} per {spread['window_seconds']}s across channels)")
+
+
+def render(args):
+    """
+    Report how fast received messages can be written to a pipe: one print and flush per message, as the
+    chatbot used to, against one write per frame, with each message in full or bursts grouped under one header
+    """
+    rng = random.Random(args.seed)
+    channels = [f"bench-{number}" for number in range(args.channels)]
+    sent_at = time.time() * 1000
+    items = [(rng.choice(channels), {"from": f"user{rng.randrange(20)}", "message": "x" * args.message_size,
+                                     "sent_at": sent_at, "private": False})
+             for _ in range(args.messages)]
+    frames = [items[start:start + args.frame_size] for start in range(0, len(items), args.frame_size)]
+
+    def per_message(write):
+        for channel, data in items:
+            write(format_message(channel, data, "bench-reader") + "\n")
+
+    def per_frame_full(write):
+        for frame in frames:
+            write("".join(format_message(channel, data, "bench-reader") + "\n" for channel, data in frame))
+
+    def per_frame_grouped(write):
+        for frame in frames:
+            write(compose_frame(frame, "bench-reader"))
+
+    modes = {
+        "per message": per_message,
+        "per frame, in full": per_frame_full,
+        "per frame, grouped": per_frame_grouped,
+    }
+    results = {}
+    for name, mode in modes.items():
+        read_fd, write_fd = os.pipe()
+        received = [0]
+
+        def drain_pipe():
+            # Read as fast as a terminal would, so the writer never blocks on a full pipe for long
+            while True:
+                chunk = os.read(read_fd, 65536)
+                if not chunk:
+                    return
+                received[0] += len(chunk)
+
+        reader = threading.Thread(target=drain_pipe)
+        reader.start()
+        stream = os.fdopen(write_fd, "w")
+        writes = [0]
+
+        def write(text):
+            stream.write(text)
+            stream.flush()
+            writes[0] += 1
+
+        start = time.perf_counter()
+        mode(write)
+        seconds = time.perf_counter() - start
+        stream.close()
+        reader.join()
+        os.close(read_fd)
+        results[name] = {"messages_per_second": args.messages / seconds, "writes": writes[0], "bytes": received[0]}
+    return {
+        "benchmark": "render",
+        "messages": args.messages,
+        "channels": args.channels,
+        "frame_size": args.frame_size,
+        "modes": results,
+    }
+
+
+def print_render(report):
+    """
+    Print the render report
+    """
+    print(f"{report['messages']} messages in {report['channels']} channel(s), {report['frame_size']} per frame")
+    print(f"{'mode':<24}{'messages/s':>14}{'writes':>10}{'bytes':>12}")
+    for name, result in report["modes"].items():
+        print(f"{name:<24}{result['messages_per_second']:>14.0f}{result['writes']:>10}{result['bytes']:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the Redis chatroom")
+    parser.add_argument("--host", default="my-redis", help="Redis host")
+    parser.add_argument("--port", type=int, default=6379, help="Redis port")
+    parser.add_argument("--fake", action="store_true", help="use an in-process fake Redis (needs fakeredis)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--output", metavar="FILE", help="also write the results as JSON to FILE, for comparing runs")
+    subcommands = parser.add_subparsers(dest="benchmark", required=True)
+
+    trips = subcommands.add_parser("round-trips", help="count Redis round trips per chat operation")
+    trips.add_argument("--users", type=int, default=100, help="number of other users to list")
+    trips.add_argument("--channels", type=int, default=3, help="number of channels to join")
+    trips.set_defaults(run=round_trips, show=print_round_trips)
+
+    codec = subcommands.add_parser("codec", help="compare message envelope codecs (needs no Redis)")
+    codec.add_argument("--message", help="message body to encode")
+    codec.add_argument("--message-size", type=int, default=64, help="length of the generated message body")
+    codec.add_argument("--iterations", type=int, default=100000)
+    codec.set_defaults(run=codecs, show=print_codecs)
+
+    load_test = subcommands.add_parser("load", help="drive synthetic users through the chat operations")
+    load_test.add_argument("--users", type=int, default=20, help="number of synthetic users")
+    load_test.add_argument("--messages", type=int, default=2000, help="number of operations to run")
+    load_test.add_argument("--private", type=float, default=0.1, help="fraction of operations that are private messages")
+    load_test.add_argument("--lookups", type=float, default=0.1, help="fraction of operations that are !weather or !fact")
+    load_test.add_argument("--codec", default="json", choices=sorted(CODECS), help="message codec the users send with")
+    load_test.add_argument("--no-cache", action="store_true", help="turn off the local cache")
+    load_test.add_argument("--seed", type=int, default=0, help="random seed, so runs pick the same operations")
+    load_test.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for outstanding deliveries")
+    load_test.add_argument("--metrics", action="store_true",
+                           help="run with instrumentation on and include its metrics, to compare against a run without")
+    load_test.set_defaults(run=load, show=print_load)
+
+    search_test = subcommands.add_parser("search", help="measure message indexing throughput and search latency")
+    search_test.add_argument("--messages", type=int, default=100000, help="number of messages to index")
+    search_test.add_argument("--channels", type=int, default=100, help="number of channels the messages are spread over")
+    search_test.add_argument("--vocabulary", type=int, default=20000, help="number of distinct words")
+    search_test.add_argument("--words", type=int, default=8, help="words per message")
+    search_test.add_argument("--batch", type=int, default=500, help="messages indexed per pipeline")
+    search_test.add_argument("--queries", type=int, default=200, help="queries of each kind to time")
+    search_test.add_argument("--seed", type=int, default=0, help="random seed, so runs index the same messages")
+    search_test.set_defaults(run=search, show=print_search)
+
+    limiter = subcommands.add_parser("rate-limit", help="measure the rate limiter's cost on the publish path")
+    limiter.add_argument("--operations", type=int, default=2000, help="publishes to time with and without the limiter")
+    limiter.add_argument("--limit", type=int, default=20, help="sends allowed per window in the flood test")
+    limiter.set_defaults(run=rate_limit, show=print_rate_limit)
+
+    renderer = subcommands.add_parser("render", help="measure how fast received messages are written to a pipe (needs no Redis)")
+    renderer.add_argument("--messages", type=int, default=100000, help="number of messages to render")
+    renderer.add_argument("--channels", type=int, default=1, help="number of channels the messages are spread over")
+    renderer.add_argument("--message-size", type=int, default=64, help="length of each message body")
+    renderer.add_argument("--frame-size", type=int, default=100, help="messages that arrive between two frames")
+    renderer.add_argument("--seed", type=int, default=0, help="random seed, so runs spread the messages the same way")
+    renderer.set_defaults(run=render, show=print_render)
+
+    args = parser.parse_args()
+    report = args.run(args)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        args.show(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+import argparse
+import contextlib
+import csv
+import json
+import sys
+import time
+
+import redis
+
+from chat_scripts import ChatScripts
+from fact_store import FactStore
+from redis_chatroom import batched
+
+# Rows written per pipeline when loading, and keys or members read per SCAN call when exporting
+BATCH_SIZE = 1000
+# Seconds between progress reports
+PROGRESS_INTERVAL = 5
+
+
+def queue_facts(pipe, rows):
+    """
+    Queue a batch of facts through the facts engine, which stores each distinct fact once
+    """
+    facts = FactStore(ChatScripts(pipe))
+    for row in rows:
+        facts.add(row["fact"], pipe, popularity=0)
+
+
+def queue_weather(pipe, rows):
+    """
+    Queue one variadic HSET for a batch of city weather reports
+    """
+    pipe.hset("weather", mapping={row["city"]: row["weather"] for row in rows})
+
+
+def queue_users(pipe, rows):
+    """
+    Queue the profile, channels and users index entry of each user in a batch
+    """
+    now = time.time()
+    for row in rows:
+        profile = {field: value for field, value in row.items() if field != "channels"}
+        pipe.hset(f"user:{row['name']}", mapping=profile)
+        channels = row.get("channels") or []
+        if channels:
+            pipe.sadd(f"channels:{row['name']}", *channels)
+    # NX keeps the original join time of users who are already indexed
+    pipe.zadd("users", {row["name"]: now for row in rows}, nx=True)
+
+
+def queue_channels(pipe, rows):
+    """
+    Queue one variadic SADD for a batch of channel names
+    """
+    pipe.sadd("channel_names", *[row["channel"] for row in rows])
+
+
+def export_facts(client, batch_size):
+    """
+    Read the facts engine's facts with HSCAN, so a large corpus never blocks the server
+    """
+    for _, fact in client.hscan_iter(FactStore(ChatScripts(client)).key("text"), count=batch_size):
+        yield {"fact": fact}
+
+
+def export_weather(client, batch_size):
+    """
+    Read the weather reports with HSCAN
+    """
+    for city, weather in client.hscan_iter("weather", count=batch_size):
+        yield {"city": city, "weather": weather}
+
+
+def export_users(client, batch_size):
+    """
+    Read every profile and the channels the user joined, one pipelined round trip per batch of keys
+    """
+    batch = []
+    for user_key in client.scan_iter("user:*", count=batch_size):
+        batch.append(user_key)
+        if len(batch) == batch_size:
+            yield from read_users(client, batch)
+            batch = []
+    if batch:
+        yield from read_users(client, batch)
+
+
+def read_users(client, user_keys):
+    """
+    Read a batch of profiles and their channels in one round trip
+    """
+    pipe = client.pipeline(transaction=False)
+    for user_key in user_keys:
+        pipe.hgetall(user_key)
+        pipe.smembers(f"channels:{user_key.split(':', 1)[1]}")
+    results = pipe.execute()
+    for profile, channels in zip(results[::2], results[1::2]):
+        if profile:
+            yield dict(profile, channels=sorted(channels))
+
+
+def export_channels(client, batch_size):
+    """
+    Read the channel names with SSCAN
+    """
+    for channel in client.sscan_iter("channel_names", count=batch_size):
+        yield {"channel": channel}
+
+
+# Dataset name -> (columns, function that queues a batch of rows, function that reads the rows back)
+DATASETS = {
+    "facts": (["fact"], queue_facts, export_facts),
+    "weather": (["city", "weather"], queue_weather, export_weather),
+    "users": (["name", "age", "gender", "location", "join_date", "channels"], queue_users, export_users),
+    "channels": (["channel"], queue_channels, export_channels),
+}
+
+
+def read_rows(stream, fmt):
+    """
+    Stream rows from CSV (with a header line) or JSON Lines. A users CSV holds each user's channels as a JSON list
+    """
+    if fmt == "csv":
+        for row in csv.DictReader(stream):
+            if "channels" in row:
+                row["channels"] = json.loads(row["channels"] or "[]")
+            yield row
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_rows(stream, fmt, columns, rows):
+    """
+    Write rows as CSV (with a header line) or JSON Lines, returning how many were written
+    """
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(stream, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+    for row in rows:
+        if fmt == "csv":
+            if "channels" in row:
+                row = dict(row, channels=json.dumps(row["channels"]))
+            writer.writerow(row)
+        else:
+            stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+
+def load_rows(client, dataset, rows, batch_size=BATCH_SIZE, checkpoint=None, resume=False, report=None):
+    """
+    Write rows into a dataset in pipelined batches and return (rows loaded, rows skipped). With a checkpoint
+    key, the number of rows loaded so far is stored with each batch, and resume skips that many rows first
+    """
+    _, queue_batch, _ = DATASETS[dataset]
+    skip = int(client.get(checkpoint) or 0) if checkpoint and resume else 0
+    done = skip
+    loaded = 0
+    start = last_report = time.perf_counter()
+
+    for batch in batched(rows, batch_size):
+        if skip >= len(batch):
+            skip -= len(batch)
+            continue
+        batch = batch[skip:]
+        skip = 0
+        # The batch and the checkpoint are applied together, so a resumed load never skips unwritten rows
+        pipe = client.pipeline(transaction=checkpoint is not None)
+        queue_batch(pipe, batch)
+        done += len(batch)
+        if checkpoint:
+            pipe.set(checkpoint, done)
+        pipe.execute()
+        loaded += len(batch)
+
+        now = time.perf_counter()
+        if report and now - last_report >= PROGRESS_INTERVAL:
+            report(f"{loaded} rows loaded, {loaded / (now - start):.0f} rows/s")
+            last_report = now
+
+    return loaded, done - loaded
+
+
+def open_input(path):
+    """
+    Open a file to read rows from, or stdin for - (which is left open afterwards)
+    """
+    return contextlib.nullcontext(sys.stdin) if path == "-" else open(path, newline="", encoding="utf-8")
+
+
+def open_output(path):
+    """
+    Open a file to write rows to, or stdout for - (which is left open afterwards)
+    """
+    return contextlib.nullcontext(sys.stdout) if path == "-" else open(path, "w", newline="", encoding="utf-8")
+
+
+def guess_format(path, fmt):
+    """
+    Use the given format, or guess it from the file extension (JSON Lines for stdin and stdout)
+    """
+    if fmt:
+        return fmt
+    return "csv" if path.endswith(".csv") else "jsonl"
+
+
+def report(message):
+    """
+    Print progress to stderr, so exports to stdout stay clean
+    """
+    print(message, file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load and export chatroom data")
+    parser.add_argument("--host", default="my-redis", help="Redis host")
+    parser.add_argument("--port", type=int, default=6379, help="Redis port")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    load = subcommands.add_parser("load", help="load rows from a CSV or JSON Lines file")
+    load.add_argument("dataset", choices=sorted(DATASETS))
+    load.add_argument("file", nargs="?", default="-", help="file to read, or - for stdin (the default)")
+    load.add_argument("--format", choices=["csv", "jsonl"], help="input format (guessed from the file name if not given)")
+    load.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows written per pipeline")
+    load.add_argument("--resume", action="store_true", help="skip the rows an earlier load of the same file already wrote")
+    load.add_argument("--checkpoint", help="name to record progress under (defaults to the file name)")
+
+    export = subcommands.add_parser("export", help="write a dataset out as CSV or JSON Lines")
+    export.add_argument("dataset", choices=sorted(DATASETS))
+    export.add_argument("file", nargs="?", default="-", help="file to write, or - for stdout (the default)")
+    export.add_argument("--format", choices=["csv", "jsonl"], help="output format (guessed from the file name if not given)")
+    export.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="keys or members read per SCAN call")
+
+    args = parser.parse_args()
+    client = redis.Redis(host=args.host, port=args.port, decode_responses=True)
+    fmt = guess_format(args.file, args.format)
+    start = time.perf_counter()
+
+    if args.command == "load":
+        checkpoint = f"bulk_load:{args.dataset}:{args.checkpoint or args.file}"
+        with open_input(args.file) as stream:
+            loaded, skipped = load_rows(client, args.dataset, read_rows(stream, fmt), args.batch_size,
+                                        checkpoint, args.resume, report)
+        seconds = time.perf_counter() - start
+        report(f"Loaded {loaded} rows into {args.dataset} in {seconds:.2f}s ({loaded / max(seconds, 1e-9):.0f} rows/s)"
+               + (f", skipped {skipped} rows loaded earlier" if skipped else ""))
+    else:
+        columns, _, export_rows = DATASETS[args.dataset]
+        with open_output(args.file) as stream:
+            count = write_rows(stream, fmt, columns, export_rows(client, args.batch_size))
+        seconds = time.perf_counter() - start
+        report(f"Exported {count} rows from {args.dataset} in {seconds:.2f}s ({count / max(seconds, 1e-9):.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
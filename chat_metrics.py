@@ -0,0 +1,237 @@
+import bisect
+import functools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (in seconds) of the histogram buckets, from half a millisecond up to ten seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Every metric name starts with this, so the chatbot's metrics are easy to find among others
+PREFIX = "chat_"
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, plus their sum, in the shape Prometheus expects
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket, and a last one for observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """
+        The upper bound of the bucket the given fraction of observations fall within, or None if there are none
+        """
+        if not self.total:
+            return None
+        rank = fraction * self.total
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def label_text(labels):
+    """
+    Format labels the way Prometheus writes them, e.g. {command="GET"}
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges for one or more chatbots, readable as JSON or in the Prometheus text format.
+    Instrumentation is opt-in: a chatbot without a Metrics object skips all of it, so it costs nothing when off.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # (name, labels) -> value or Histogram, where labels is a sorted tuple of (label, value) pairs
+        self.counters = {}
+        self.histograms = {}
+        # name -> function that returns the current value, read when the metrics are
+        self.gauges = {}
+        # The listener thread and the main thread both record
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Add to a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """
+        Record one value (usually seconds) in a histogram
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, read):
+        """
+        Register a function that returns a gauge's current value. Registering a name again replaces it
+        """
+        self.gauges[name] = read
+
+    def timed(self, name, function, **labels):
+        """
+        Wrap a function so every call is timed into a histogram
+        """
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - start, **labels)
+        return timed_function
+
+    def instrument(self, client):
+        """
+        Time every command a Redis client sends, and every pipeline or transaction as one call, and count
+        the ones that fail. The client's methods are replaced on this instance only
+        """
+        execute_command = client.execute_command
+        pipeline = client.pipeline
+
+        def timed_execute_command(*args, **options):
+            start = time.perf_counter()
+            command = str(args[0]).upper() if args else "UNKNOWN"
+            try:
+                return execute_command(*args, **options)
+            except Exception:
+                self.inc("redis_errors_total", command=command)
+                raise
+            finally:
+                self.observe("redis_command_seconds", time.perf_counter() - start, command=command)
+
+        def timed_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+
+            def timed_execute(*execute_args, **execute_kwargs):
+                start = time.perf_counter()
+                command = "MULTI" if getattr(pipe, "transaction", False) else "PIPELINE"
+                self.inc("redis_pipelined_commands_total", len(pipe), command=command)
+                try:
+                    return execute(*execute_args, **execute_kwargs)
+                except Exception:
+                    self.inc("redis_errors_total", command=command)
+                    raise
+                finally:
+                    self.observe("redis_command_seconds", time.perf_counter() - start, command=command)
+
+            pipe.execute = timed_execute
+            return pipe
+
+        client.execute_command = timed_execute_command
+        client.pipeline = timed_pipeline
+        return client
+
+    def snapshot(self):
+        """
+        Return every metric as a dictionary that can be dumped as JSON. Histograms include approximate
+        percentiles, read from the bucket bounds
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (histogram.total, histogram.sum, histogram.quantile(0.5), histogram.quantile(0.99))
+                          for key, histogram in self.histograms.items()}
+        result = {"uptime_seconds": time.time() - self.started, "counters": {}, "histograms": {}, "gauges": {}}
+        for (name, labels), value in sorted(counters.items()):
+            result["counters"].setdefault(PREFIX + name, {})[label_text(labels)] = value
+        for (name, labels), (count, total, p50, p99) in sorted(histograms.items()):
+            result["histograms"].setdefault(PREFIX + name, {})[label_text(labels)] = {
+                "count": count, "sum": total, "p50": p50, "p99": p99,
+            }
+        for name, read in sorted(self.gauges.items()):
+            result["gauges"][PREFIX + name] = read()
+        return result
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        """
+        Return every metric in the Prometheus text exposition format
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(histogram.counts), histogram.total, histogram.sum)
+                                for key, histogram in self.histograms.items())
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(PREFIX + name, "counter")
+            lines.append(f"{PREFIX}{name}{label_text(labels)} {value}")
+        for (name, labels), counts, total, seconds in histograms:
+            declare(PREFIX + name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{PREFIX}{name}_bucket{label_text(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{label_text(labels)} {seconds}")
+            lines.append(f"{PREFIX}{name}_count{label_text(labels)} {total}")
+        for name, read in sorted(self.gauges.items()):
+            declare(PREFIX + name, "gauge")
+            lines.append(f"{PREFIX}{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serve the metrics over HTTP from a background thread: /metrics in the Prometheus format,
+        /metrics.json as JSON. Returns the server, so it can be shut down
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.to_prometheus(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = metrics.to_json(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would otherwise be printed over the chat
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        # Set the thread as a daemon so it will stop when the main thread stops
+        thread.daemon = True
+        thread.start()
+        return server
@@ -0,0 +1,273 @@
+# Store a profile, register the private inbox and index the user, all or nothing. Returns the user's unread
+# private message count
+# KEYS: user profile, user's channels, users index, user's unread count
+# ARGV: username, private inbox channel, join time, then the profile's field/value pairs
+IDENTIFY_USER = """
+redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+redis.call('SADD', KEYS[2], ARGV[2])
+-- NX keeps the time the user first joined when they identify again
+redis.call('ZADD', KEYS[3], 'NX', ARGV[3], ARGV[1])
+return tonumber(redis.call('GET', KEYS[4]) or 0)
+"""
+
+# Add a channel to a user's channels and to the channel names, if the user still exists, and record when it
+# was last joined so the maintenance worker never removes a channel that is joined while it looks at it
+# KEYS: user profile, user's channels, channel names, channel join times (sorted set of channels)
+# ARGV: channel
+JOIN_CHANNEL = """
+-- A profile deleted by another session must not leave an orphaned channels set behind
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[1])
+local time = redis.call('TIME')
+redis.call('ZADD', KEYS[4], tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000), ARGV[1])
+return 1
+"""
+
+# Delete a user's keys and remove them from the users index and presence, returning the channels they had joined
+# KEYS: user profile, user's channels, user's last seen entries, users index, presence, user's inbox, user's unread count
+# ARGV: username
+DELETE_USER = """
+local channels = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3], KEYS[6], KEYS[7])
+redis.call('ZREM', KEYS[4], ARGV[1])
+redis.call('ZREM', KEYS[5], ARGV[1])
+return channels
+"""
+
+# Keep a private message in the recipient's capped inbox and wake them up with one publish. Returns -1 if there
+# is no such user, otherwise the number of clients the publish reached (0 when the recipient is offline)
+# KEYS: recipient profile, recipient's inbox, recipient's unread count
+# ARGV: message as stored, message as published, recipient's private inbox channel, inbox length, publish command
+SEND_PRIVATE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local inbox_length = tonumber(ARGV[4])
+redis.call('LPUSH', KEYS[2], ARGV[1])
+redis.call('LTRIM', KEYS[2], 0, inbox_length - 1)
+local receivers = redis.call(ARGV[5], ARGV[3], ARGV[2])
+-- A message someone received straight away has been seen; the others wait in the inbox as unread
+if receivers == 0 and redis.call('INCR', KEYS[3]) > inbox_length then
+    redis.call('SET', KEYS[3], inbox_length)
+end
+return receivers
+"""
+
+# Remove up to a batch of users whose last heartbeat is older than the cutoff, returning how many were removed
+# KEYS: presence
+# ARGV: cutoff time, batch size
+PRUNE_PRESENCE = """
+-- Members are ordered by their last heartbeat, so the expired ones are the lowest ranks
+local expired = redis.call('ZCOUNT', KEYS[1], '-inf', '(' .. ARGV[1])
+if expired == 0 then
+    return 0
+end
+return redis.call('ZREMRANGEBYRANK', KEYS[1], 0, math.min(expired, tonumber(ARGV[2])) - 1)
+"""
+
+# Count one use of a rate-limited command in each of its sliding windows of the uses before it, if every one
+# of them has room. Returns 0 if the use is allowed, otherwise the milliseconds until the oldest use leaves the
+# fullest window; a refused use is not counted anywhere
+# KEYS: the windows (sorted sets of uses scored by time), e.g. one per channel and one across all channels
+# ARGV: a unique member for this use, then the most uses allowed and the length (ms) of each window in turn
+RATE_LIMIT = """
+-- The server's clock decides, so every client of the same user shares one window
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local wait = 0
+for i = 1, #KEYS do
+    local uses, window = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now - window)
+    if redis.call('ZCARD', KEYS[i]) >= uses then
+        local oldest = redis.call('ZRANGE', KEYS[i], 0, 0, 'WITHSCORES')
+        wait = math.max(wait, 1, oldest[2] and tonumber(oldest[2]) + window - now or window)
+    end
+end
+if wait > 0 then
+    return wait
+end
+for i = 1, #KEYS do
+    redis.call('ZADD', KEYS[i], now, ARGV[1])
+    -- An idle window expires on its own
+    redis.call('PEXPIRE', KEYS[i], ARGV[i * 2 + 1])
+end
+return 0
+"""
+
+# Add a fact with a popularity of 1 unless a fact with the same normalized text is already known, in which case
+# that fact's popularity goes up instead. Facts get dense IDs, so a position in a shuffled order can be turned into
+# a fact. Returns 1 if the fact was added, 0 if it was a duplicate
+# KEYS: digest -> ID hash, ID -> text hash, popularity (sorted set of IDs), plain set of facts for older clients
+# ARGV: digest of the normalized fact, fact, popularity to add for a duplicate (0 when loading, so loads can be repeated)
+ADD_FACT = """
+local id = redis.call('HGET', KEYS[1], ARGV[1])
+if id then
+    if tonumber(ARGV[3]) > 0 then
+        redis.call('ZINCRBY', KEYS[3], ARGV[3], id)
+    end
+    return 0
+end
+-- Facts are never removed, so the next ID is the number of facts
+id = redis.call('HLEN', KEYS[2])
+redis.call('HSET', KEYS[2], id, ARGV[2])
+redis.call('HSET', KEYS[1], ARGV[1], id)
+redis.call('ZADD', KEYS[3], 1, id)
+redis.call('SADD', KEYS[4], ARGV[2])
+return 1
+"""
+
+# Return the next fact in a user's own shuffled order of every fact, so nobody sees a fact twice until they have
+# seen them all. The order is the permutation id = (step * position + offset) mod size, so the cursor is a few
+# numbers however many facts there are. Returns nil if there are no facts
+# KEYS: user's cursor, ID -> text hash
+# ARGV: random step and offset for a new pass, cursor lifetime (ms)
+NEXT_FACT = """
+local function gcd(a, b)
+    while b > 0 do
+        a, b = b, a % b
+    end
+    return a
+end
+
+local cursor = redis.call('HMGET', KEYS[1], 'size', 'step', 'offset', 'position')
+local size, step, offset, position = tonumber(cursor[1]), tonumber(cursor[2]), tonumber(cursor[3]), tonumber(cursor[4])
+if not position or position >= size then
+    -- Start a new pass over every fact there is now, in a new order. Facts added during a pass come up in the next one
+    size = redis.call('HLEN', KEYS[2])
+    if size == 0 then
+        return false
+    end
+    -- Every position lands on a different fact only if the step and the size have no common factor
+    step = math.max(1, tonumber(ARGV[1]) % size)
+    while gcd(step, size) ~= 1 do
+        step = step + 1
+    end
+    offset = tonumber(ARGV[2]) % size
+    position = 0
+    redis.call('HSET', KEYS[1], 'size', size, 'step', step, 'offset', offset)
+end
+redis.call('HSET', KEYS[1], 'position', position + 1)
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+return redis.call('HGET', KEYS[2], (step * position + offset) % size)
+"""
+
+# Return a fact picked with probability proportional to its popularity, or nil if there are no facts. Facts are
+# grouped into tiers of popularity [2^k, 2^(k+1)); a tier is picked by its size times its upper bound, a fact is
+# picked uniformly within it by rank, and it is kept with probability popularity / 2^(k+1), which is at least one
+# half, so a few tries are enough whatever the distribution
+# KEYS: popularity (sorted set of IDs), ID -> text hash
+# ARGV: random numbers in [0, 1), three per try
+SAMPLE_FACT = """
+local top = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+if #top == 0 then
+    return false
+end
+local tiers = {}
+local mass = 0
+local low, high = 1, 2
+while low <= tonumber(top[2]) do
+    local count = redis.call('ZCOUNT', KEYS[1], low, '(' .. high)
+    if count > 0 then
+        -- Facts are ordered by popularity, so a tier is a run of ranks
+        local first = redis.call('ZCOUNT', KEYS[1], '-inf', '(' .. low)
+        mass = mass + count * high
+        table.insert(tiers, {first, count, high, mass})
+    end
+    low, high = high, high * 2
+end
+
+local id
+for i = 1, #ARGV - 2, 3 do
+    local target = tonumber(ARGV[i]) * mass
+    local tier = tiers[#tiers]
+    for _, candidate in ipairs(tiers) do
+        if target < candidate[4] then
+            tier = candidate
+            break
+        end
+    end
+    local rank = tier[1] + math.floor(tonumber(ARGV[i + 1]) * tier[2])
+    local entry = redis.call('ZRANGE', KEYS[1], rank, rank, 'WITHSCORES')
+    id = entry[1]
+    if tonumber(ARGV[i + 2]) * tier[3] < tonumber(entry[2]) then
+        break
+    end
+end
+return redis.call('HGET', KEYS[2], id)
+"""
+
+# Remove what a deleted user left behind, unless their profile exists again. Checking and deleting together means
+# a user who identifies while the maintenance worker runs keeps their keys. Returns how many keys and index
+# entries were removed
+# KEYS: user profile, users index, presence, then the user's other keys
+# ARGV: username
+DELETE_ORPHANED = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local removed = redis.call('ZREM', KEYS[2], ARGV[1]) + redis.call('ZREM', KEYS[3], ARGV[1])
+for i = 4, #KEYS do
+    -- UNLINK frees large values in the background instead of blocking the server
+    removed = removed + redis.call('UNLINK', KEYS[i])
+end
+return removed
+"""
+
+# Remove an abandoned channel's name and history, unless since the maintenance worker looked it has been joined,
+# subscribed to or written to. Checking and removing together means a join that lands meanwhile keeps the channel.
+# Returns 1 if the channel was removed
+# KEYS: channel names, channel join times, channel's history
+# ARGV: channel, server time (ms) the worker started looking for joins, cutoff (ms) for the newest message
+DELETE_ABANDONED = """
+local joined = redis.call('ZSCORE', KEYS[2], ARGV[1])
+if joined and tonumber(joined) >= tonumber(ARGV[2]) then
+    return 0
+end
+if redis.call('PUBSUB', 'NUMSUB', ARGV[1])[2] > 0 then
+    return 0
+end
+local newest = redis.call('XREVRANGE', KEYS[3], '+', '-', 'COUNT', 1)[1]
+if newest and tonumber(string.match(newest[1], '^%d+')) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('SREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('UNLINK', KEYS[3])
+return 1
+"""
+
+
+class ChatScripts:
+    """
+    The Lua scripts behind the chat operations that change several keys. Each one runs atomically on the
+    server in a single round trip, so a client that crashes halfway cannot leave a half-created user behind.
+    """
+    def __init__(self, client):
+        self.client = client
+        # Scripts are called with EVALSHA, falling back to loading them if the server has lost its script cache
+        self.identify_user = client.register_script(IDENTIFY_USER)
+        self.join_channel = client.register_script(JOIN_CHANNEL)
+        self.delete_user = client.register_script(DELETE_USER)
+        self.prune_presence = client.register_script(PRUNE_PRESENCE)
+        self.send_private = client.register_script(SEND_PRIVATE)
+        self.rate_limit = client.register_script(RATE_LIMIT)
+        self.add_fact = client.register_script(ADD_FACT)
+        self.next_fact = client.register_script(NEXT_FACT)
+        self.sample_fact = client.register_script(SAMPLE_FACT)
+        self.delete_orphaned = client.register_script(DELETE_ORPHANED)
+        self.delete_abandoned = client.register_script(DELETE_ABANDONED)
+
+    def load(self):
+        """
+        Load every script into the server's script cache in one round trip, so no call has to send the script itself
+        """
+        pipe = self.client.pipeline(transaction=False)
+        scripts = (self.identify_user, self.join_channel, self.delete_user, self.prune_presence, self.send_private,
+                   self.rate_limit, self.add_fact, self.next_fact, self.sample_fact, self.delete_orphaned,
+                   self.delete_abandoned)
+        for script in scripts:
+            pipe.script_load(script.script)
+        pipe.execute()
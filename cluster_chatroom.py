@@ -0,0 +1,411 @@
+import argparse
+import threading
+import time
+
+import redis
+from redis.backoff import FullJitterBackoff
+from redis.cluster import RedisCluster
+
+from chat_metrics import Metrics
+from chat_scripts import ChatScripts
+from fact_store import FactStore
+from message_codec import text
+from receive_buffer import OVERFLOW_POLICIES
+from redis_chatroom import (LISTEN_TIMEOUT, NUMSUB_BATCH_SIZE, PRESENCE_PRUNE_BATCH, RATE_LIMITS, RECONNECT_BASE,
+                            RECONNECT_CAP, RedisChatbot, batched, parse_rate_limit)
+from terminal_renderer import MAX_FPS
+
+
+class ShardedSubscriber:
+    """
+    Sharded pub/sub (SSUBSCRIBE) across a Redis Cluster. A shard channel is served by the node that owns its
+    hash slot, so this keeps one pubsub connection and one listener thread per node, and moves subscriptions
+    to the new owner when a slot migrates or a node fails over.
+    """
+    def __init__(self, cluster, handler, reconnected):
+        # A cluster client that returns bytes, since messages may be in a binary format
+        self.cluster = cluster
+        # Called with every message received on any node
+        self.handler = handler
+        # Called with the channels that were moved and the time the node was lost, once they are subscribed again
+        self.reconnected = reconnected
+        self.backoff = FullJitterBackoff(cap=RECONNECT_CAP, base=RECONNECT_BASE)
+        # Channels we want to be subscribed to, and the node each one is currently subscribed on
+        self.channels = set()
+        self.channel_nodes = {}
+        # Node name -> pubsub connection to that node, and the thread listening on it
+        self.pubsubs = {}
+        self.threads = {}
+        self.running = False
+        # Subscriptions change from the main thread and from listeners handling a moved slot
+        self.lock = threading.RLock()
+
+    def ssubscribe(self, *channels):
+        """
+        Subscribe to channels on the nodes that own them
+        """
+        with self.lock:
+            for channel in channels:
+                self.channels.add(channel)
+                self.subscribe_on_owner(channel)
+
+    def sunsubscribe(self, *channels):
+        """
+        Unsubscribe from channels on the nodes they were subscribed on
+        """
+        with self.lock:
+            for channel in channels:
+                self.channels.discard(channel)
+                node_name = self.channel_nodes.pop(channel, None)
+                if node_name in self.pubsubs:
+                    self.pubsubs[node_name].sunsubscribe(channel)
+
+    def subscribe_on_owner(self, channel):
+        """
+        Subscribe to a channel on the node that currently owns its slot. The caller holds the lock
+        """
+        node = self.cluster.get_node_from_key(channel)
+        self.node_pubsub(node).ssubscribe(channel)
+        self.channel_nodes[channel] = node.name
+
+    def node_pubsub(self, node):
+        """
+        The pubsub connection to a node, opening it (and its listener, if we are listening) the first time
+        """
+        pubsub = self.pubsubs.get(node.name)
+        if pubsub is None:
+            pubsub = self.cluster.get_redis_connection(node).pubsub()
+            self.pubsubs[node.name] = pubsub
+            if self.running:
+                self.start_node(node.name)
+        return pubsub
+
+    def start(self):
+        """
+        Start a listener thread for every node we are subscribed on
+        """
+        with self.lock:
+            self.running = True
+            for node_name in self.pubsubs:
+                self.start_node(node_name)
+
+    def start_node(self, node_name):
+        """
+        Start the listener thread for one node. The caller holds the lock
+        """
+        thread = threading.Thread(target=self.listen, args=(node_name, self.pubsubs[node_name]))
+        # Set the thread as a daemon so it will stop when the main thread stops
+        thread.daemon = True
+        self.threads[node_name] = thread
+        thread.start()
+
+    def stop(self):
+        """
+        Stop every listener thread and wait for them to exit. Subscriptions are kept
+        """
+        with self.lock:
+            self.running = False
+            threads = list(self.threads.values())
+            self.threads = {}
+        # Each listener wakes up at least every LISTEN_TIMEOUT seconds, so these joins are bounded
+        for thread in threads:
+            if thread is not threading.current_thread():
+                thread.join(LISTEN_TIMEOUT * 2)
+
+    def close(self):
+        """
+        Stop listening and close every pubsub connection
+        """
+        self.stop()
+        with self.lock:
+            for pubsub in self.pubsubs.values():
+                pubsub.close()
+            self.pubsubs = {}
+            self.channel_nodes = {}
+
+    def listen(self, node_name, pubsub):
+        """
+        Listen for messages from one node until we stop or the node's connection is replaced
+        """
+        while self.running and self.pubsubs.get(node_name) is pubsub:
+            try:
+                message = pubsub.get_message(timeout=LISTEN_TIMEOUT)
+            except (redis.ConnectionError, redis.TimeoutError):
+                self.node_failed(node_name, pubsub)
+                return
+            if not message:
+                continue
+            if message['type'] == 'sunsubscribe':
+                self.handle_sunsubscribe(node_name, text(message['channel']))
+            else:
+                self.handler(message)
+
+    def handle_sunsubscribe(self, node_name, channel):
+        """
+        The server drops shard subscriptions when their slot moves to another node. Follow the slot
+        to its new owner unless we asked to leave the channel
+        """
+        with self.lock:
+            if channel not in self.channels or self.channel_nodes.get(channel) != node_name:
+                return
+            self.cluster.nodes_manager.initialize()
+            self.subscribe_on_owner(channel)
+
+    def node_failed(self, node_name, pubsub):
+        """
+        Re-read the cluster's topology after losing a node and subscribe to its channels on their new owners
+        """
+        with self.lock:
+            if self.pubsubs.get(node_name) is pubsub:
+                del self.pubsubs[node_name]
+            self.threads.pop(node_name, None)
+            channels = [channel for channel, name in self.channel_nodes.items() if name == node_name]
+        try:
+            pubsub.close()
+        except redis.RedisError:
+            pass
+
+        # Keep trying until a replica has been promoted and the topology can be read again, backing off
+        # (with jitter) so that every client of a failed node does not hammer the rest of the cluster
+        lost_at = time.time()
+        failures = 0
+        while self.running:
+            time.sleep(self.backoff.compute(failures))
+            failures += 1
+            try:
+                with self.lock:
+                    self.cluster.nodes_manager.initialize()
+                    channels = [channel for channel in channels if channel in self.channels]
+                    for channel in channels:
+                        self.subscribe_on_owner(channel)
+            except (redis.ConnectionError, redis.TimeoutError, redis.exceptions.ClusterError):
+                continue
+            self.reconnected(channels, lost_at)
+            return
+
+
+class ClusterRedisChatbot(RedisChatbot):
+    """
+    The chatbot on a Redis Cluster. Channels use sharded pub/sub (SSUBSCRIBE/SPUBLISH), so each message is
+    only propagated within the shard that owns its channel instead of being broadcast to every node.
+    """
+    # The private inbox channel lives in the recipient's slot, so the send script can publish to it
+    publish_command = "SPUBLISH"
+
+    def __init__(self, host='my-redis', port=6379, durable=False, codec="json", buffer_size=1000, overflow="coalesce",
+                 metrics=None, rate_limits=None, max_fps=MAX_FPS):
+        client = RedisCluster(host=host, port=port, decode_responses=True)
+        # Subscriptions are held per node, over connections that return bytes
+        self.sharded = ShardedSubscriber(RedisCluster(host=host, port=port, decode_responses=False),
+                                         self.handle_message, self.report_gap)
+        # Tracking invalidations are sent per node and cannot be redirected across the cluster, so profiles,
+        # weather and facts are always read from Redis
+        super().__init__(durable=durable, client=client, cache=False, codec=codec,
+                         buffer_size=buffer_size, overflow=overflow, metrics=metrics,
+                         rate_limits=rate_limits, max_fps=max_fps)
+
+    def open_pubsub(self):
+        """
+        Cluster mode has no single pubsub connection; see ShardedSubscriber
+        """
+        return None
+
+    def open_search_index(self):
+        """
+        A query intersects the posting lists of several words, which live in different slots, so cluster mode
+        does not index messages
+        """
+        return None
+
+    def search_messages(self, args):
+        """
+        Search is not available on a cluster
+        """
+        print("Search is not available when chatting through a Redis Cluster.\n")
+
+    def open_fact_store(self):
+        """
+        The facts engine's scripts touch all of its keys at once, so they share the hash tag {facts}, which
+        also puts them in the slot of the plain facts set
+        """
+        return FactStore(self.scripts, prefix="{facts}")
+
+    def user_key(self, username):
+        """
+        Name of the hash that holds a user's profile. The hash tag keeps all of a user's keys in one slot
+        """
+        return f"user:{{{username}}}"
+
+    def channels_key(self, username):
+        """
+        Name of the set of channels a user has joined
+        """
+        return f"channels:{{{username}}}"
+
+    def last_seen_key(self, username):
+        """
+        Name of the hash of the newest history entry a user has seen on each channel
+        """
+        return f"last_seen:{{{username}}}"
+
+    def inbox_key(self, username):
+        """
+        Name of the list of private messages sent to a user
+        """
+        return f"inbox:{{{username}}}"
+
+    def unread_key(self, username):
+        """
+        Name of the count of private messages a user has not read yet
+        """
+        return f"unread:{{{username}}}"
+
+    def rate_limit_key(self, command, username, scope=None):
+        """
+        Name of a user's rate limit window. The hash tag keeps the per-channel and the overall window in one
+        slot, so one script can check both
+        """
+        return super().rate_limit_key(command, f"{{{username}}}", scope)
+
+    def private_channel(self, username):
+        """
+        Name of the channel that serves as a user's private inbox, on the same shard as the user's keys
+        """
+        return f"{{{username}}} private inbox"
+
+    def load_scripts(self):
+        """
+        The users index and channel names live in other slots than the user's keys, and a script can only
+        touch keys in one slot, so cluster mode pipelines these updates instead (they are not atomic). Only
+        the single-key scripts are used, and they are loaded on each node the first time they run
+        """
+        self.scripts = ChatScripts(self.client)
+
+    def save_profile(self, username, profile):
+        """
+        Store a user's profile, register their private inbox and index them in one round trip per node.
+        Returns how many unread private messages are waiting for them
+        """
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(self.user_key(username), mapping=profile)
+        pipe.sadd(self.channels_key(username), self.private_channel(username))
+        pipe.zadd("users", {username: time.time()}, nx=True)
+        pipe.get(self.unread_key(username))
+        return int(pipe.execute()[3] or 0)
+
+    def add_user_channel(self, channel):
+        """
+        Record that the current user joined a channel
+        """
+        pipe = self.client.pipeline(transaction=False)
+        pipe.sadd(self.channels_key(self.current_user), channel)
+        pipe.sadd("channel_names", channel)
+        pipe.execute()
+        return True
+
+    def remove_user_keys(self, username):
+        """
+        Delete a user's keys and drop them from the users index. Returns their channels
+        """
+        pipe = self.client.pipeline(transaction=False)
+        pipe.smembers(self.channels_key(username))
+        pipe.delete(self.user_key(username), self.last_seen_key(username), self.channels_key(username),
+                    self.inbox_key(username), self.unread_key(username))
+        pipe.zrem("users", username)
+        pipe.zrem("presence", username)
+        channels, _, _, _ = pipe.execute()
+        return channels
+
+    def prune_presence(self, target, cutoff):
+        """
+        Remove a batch of users whose last heartbeat is older than cutoff. Cluster pipelines cannot reload a
+        script the node has lost, so this runs on its own
+        """
+        return self.scripts.prune_presence(keys=["presence"], args=[cutoff, PRESENCE_PRUNE_BATCH])
+
+    def subscriber_counts(self, channels):
+        """
+        Return the number of subscribers of each shard channel, fetching the counts in batches
+        """
+        counts = {}
+        for batch in batched(channels, NUMSUB_BATCH_SIZE):
+            counts.update(self.client.pubsub_shardnumsub(*batch))
+        return counts
+
+    def subscribe(self, *channels):
+        """
+        Subscribe to channels on the shards that own them
+        """
+        self.sharded.ssubscribe(*channels)
+
+    def unsubscribe(self, *channels):
+        """
+        Unsubscribe from channels on the shards that own them
+        """
+        self.sharded.sunsubscribe(*channels)
+
+    def publish_payload(self, target, channel, payload):
+        """
+        Queue an SPUBLISH of an encoded message on a client or pipeline
+        """
+        return target.spublish(channel, payload)
+
+    def index_existing_users(self):
+        """
+        Profiles in a cluster were always created with the users index, so there is nothing to backfill
+        """
+        self.client.set("users:indexed", 1)
+
+    def start_listening(self):
+        """
+        Start a listener thread per shard, if they are not already running
+        """
+        if self.listening:
+            return
+        self.listening = True
+        self.sharded.start()
+
+    def stop_listening(self):
+        """
+        Stop the shard listener threads and wait for them to exit
+        """
+        self.listening = False
+        self.sharded.stop()
+
+    def close(self):
+        """
+        Stop listening and close every shard's pubsub connection
+        """
+        self.stop_listening()
+        self.stop_heartbeat()
+        self.go_offline()
+        if self.durable:
+            self.save_last_seen()
+        self.sharded.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat with other users through a Redis Cluster")
+    parser.add_argument("--host", default="my-redis", help="host of any node in the cluster")
+    parser.add_argument("--port", type=int, default=6379, help="port of that node")
+    parser.add_argument("--durable", action="store_true", help="keep channel history in Redis Streams so it can be read back later")
+    parser.add_argument("--codec", default="json", choices=["json", "struct", "msgpack"],
+                        help="format to send messages in; every format is understood when receiving")
+    parser.add_argument("--buffer-size", type=int, default=1000, help="most received messages to hold before the overflow policy applies")
+    parser.add_argument("--overflow", default="coalesce", choices=OVERFLOW_POLICIES,
+                        help="what to do with messages that arrive while the buffer is full")
+    parser.add_argument("--metrics", action="store_true", help="time Redis calls, commands and message delivery; see !metrics")
+    parser.add_argument("--metrics-port", type=int, help="also serve the metrics over HTTP on this port (implies --metrics)")
+    parser.add_argument("--rate-limit", type=parse_rate_limit, action="append", default=[], metavar="COMMAND=USES/SECONDS",
+                        help="change how often a command can be used, e.g. send=20/10 (per channel) or send_total=40/10 (across channels); may be repeated")
+    parser.add_argument("--no-rate-limit", action="store_true", help="turn off every rate limit")
+    parser.add_argument("--max-fps", type=float, default=MAX_FPS, help="most times a second received messages are written to the terminal")
+    args = parser.parse_args()
+    metrics = Metrics() if args.metrics or args.metrics_port else None
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    rate_limits = {} if args.no_rate_limit else dict(RATE_LIMITS, **dict(args.rate_limit))
+    chatbot = ClusterRedisChatbot(args.host, args.port, durable=args.durable, codec=args.codec,
+                                  buffer_size=args.buffer_size, overflow=args.overflow, metrics=metrics,
+                                  rate_limits=rate_limits, max_fps=args.max_fps)
+    chatbot.run()
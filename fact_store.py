@@ -0,0 +1,104 @@
+import hashlib
+import random
+import re
+import unicodedata
+
+# Runs of letters and digits; everything between them is ignored when comparing facts
+WORD_PATTERN = re.compile(r"\w+")
+# A user's place in their shuffled order of facts is forgotten after they have not asked for one in this long
+CURSOR_TTL = 30 * 24 * 60 * 60
+# Tries SAMPLE_FACT gets to accept a candidate; each one succeeds with probability at least one half
+SAMPLE_TRIES = 8
+
+
+def normalize_fact(fact):
+    """
+    The form facts are compared in: Unicode-normalized, case-folded, and with punctuation and runs of
+    whitespace reduced to single spaces
+    """
+    return " ".join(WORD_PATTERN.findall(unicodedata.normalize("NFKC", fact).casefold()))
+
+
+def fact_digest(fact):
+    """
+    A short hash of a fact's normalized form, so duplicates are found without comparing whole facts
+    """
+    return hashlib.blake2b(normalize_fact(fact).encode(), digest_size=16).hexdigest()
+
+
+class FactStore:
+    """
+    The facts served by !fact. Each fact has a dense ID, so a user's cursor into their own shuffled order
+    of all facts is a handful of numbers rather than a copy of the facts. Duplicates are found by the hash
+    of their normalized text and make the original more popular, and popular facts can be sampled by weight.
+    The plain set of facts is kept up to date for clients that read it directly.
+    """
+    def __init__(self, scripts, prefix="facts", plain_key="facts"):
+        self.scripts = scripts
+        self.client = scripts.client
+        self.prefix = prefix
+        self.plain_key = plain_key
+        # Whether the facts from before the facts engine are known to have been imported
+        self.imported = False
+
+    def key(self, name):
+        """
+        Name of one of the facts engine's keys
+        """
+        return f"{self.prefix}:{name}"
+
+    def cursor_key(self, username):
+        """
+        Name of the hash that holds a user's place in their shuffled order of facts
+        """
+        return f"{self.prefix}:cursor:{username}"
+
+    def add(self, fact, target=None, popularity=1):
+        """
+        Add a fact, or add popularity to the fact it duplicates. Returns True if it was new. Pass a pipeline
+        as target to queue the addition instead, or an asyncio client to get an awaitable of the script's
+        result (1 if new). Loads pass a popularity of 0, so loading the same facts again changes nothing
+        """
+        fact = fact.strip()
+        keys = [self.key("digests"), self.key("text"), self.key("popularity"), self.plain_key]
+        added = self.scripts.add_fact(keys=keys, args=[fact_digest(fact), fact, popularity], client=target)
+        return added if target is not None else added == 1
+
+    def next_fact(self, username):
+        """
+        Return the next fact the user has not seen in this pass over all facts, or None if there are none
+        """
+        args = [random.randrange(1, 2 ** 31), random.randrange(2 ** 31), CURSOR_TTL * 1000]
+        return self.scripts.next_fact(keys=[self.cursor_key(username), self.key("text")], args=args)
+
+    def popular_fact(self):
+        """
+        Return a fact picked with probability proportional to its popularity, or None if there are none
+        """
+        args = [random.random() for _ in range(SAMPLE_TRIES * 3)]
+        return self.scripts.sample_fact(keys=[self.key("popularity"), self.key("text")], args=args)
+
+    def import_existing(self, batch_size=1000):
+        """
+        Add the facts from the plain set that were there before the facts engine, using SSCAN so the server is
+        never blocked. Only runs once; returns whether it ran
+        """
+        if self.imported or self.client.exists(self.key("imported")):
+            self.imported = True
+            return False
+        # Imported here because redis_chatroom imports this module
+        from redis_chatroom import batched
+        for batch in batched(self.client.sscan_iter(self.plain_key, count=batch_size), batch_size):
+            self.add_batch(batch)
+        self.client.set(self.key("imported"), 1)
+        self.imported = True
+        return True
+
+    def add_batch(self, facts):
+        """
+        Add several facts in one round trip, without making the ones already known more popular
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for fact in facts:
+            self.add(fact, pipe, popularity=0)
+        pipe.execute()
@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import time
+
+import redis.asyncio as aioredis
+
+from async_chatroom import AsyncRedisChatbot
+from message_codec import raw_client, text
+from redis_chatroom import LISTEN_TIMEOUT, RATE_LIMITS, parse_rate_limit
+
+
+class GatewaySession(AsyncRedisChatbot):
+    """
+    One logical user inside the gateway. It uses the gateway's shared client for commands and receives
+    its pub/sub messages from the gateway's queue instead of holding a PubSub connection of its own.
+    """
+    def __init__(self, gateway, reader=None, writer=None):
+        super().__init__(client=gateway.client, reader=reader, writer=writer, codec=gateway.codec,
+                         rate_limits=gateway.rate_limits)
+        self.gateway = gateway
+        # Messages fanned out to this session by the gateway, as (channel, raw) pairs
+        self.inbox = asyncio.Queue()
+
+    async def subscribe(self, *channels):
+        """
+        Subscribe this session to channels through the gateway's shared PubSub connection
+        """
+        await self.gateway.subscribe(self, *channels)
+
+    async def unsubscribe(self, *channels):
+        """
+        Unsubscribe this session from channels on the gateway's shared PubSub connection
+        """
+        await self.gateway.unsubscribe(self, *channels)
+
+    async def stop_listening(self):
+        """
+        Stop the listener coroutine and wait for it to finish
+        """
+        if not self.listening:
+            return
+        self.listening = False
+        # Wake the listener up so it notices it should stop
+        self.inbox.put_nowait(None)
+        await self.listener_task
+        self.listener_task = None
+
+    async def listen_for_messages(self):
+        """
+        Display each message the gateway fans out to this session
+        """
+        while self.listening:
+            item = await self.inbox.get()
+            if item is not None:
+                self.deliver(*item)
+
+    async def close(self):
+        """
+        Stop listening and drop this session's subscriptions. The shared client stays open
+        """
+        await self.stop_listening()
+        await self.stop_heartbeat()
+        await self.go_offline()
+        await self.gateway.drop(self)
+
+
+class ChatGateway:
+    """
+    Hosts many chat sessions in one process. All sessions share one connection pool for commands and one
+    PubSub connection, and the gateway fans each published message out to the sessions subscribed to it.
+    """
+    def __init__(self, host='my-redis', port=6379, max_connections=20, codec="json", rate_limits=None):
+        # Sessions wait for a free connection instead of opening more than max_connections
+        self.pool = aioredis.BlockingConnectionPool(host=host, port=port, max_connections=max_connections, decode_responses=True)
+        self.client = aioredis.Redis(connection_pool=self.pool)
+        # The shared pubsub connection returns bytes, since messages may be in a binary format
+        self.pubsub_client = raw_client(self.client)
+        self.pubsub = self.pubsub_client.pubsub()
+        # Format sessions send messages in
+        self.codec = codec
+        # Limits on how often each session's user can use a command, kept in Redis so they hold across sessions
+        self.rate_limits = dict(RATE_LIMITS) if rate_limits is None else rate_limits
+        # Channel name -> set of sessions subscribed to it
+        self.subscribers = {}
+        self.listening = False
+        self.listener_task = None
+
+    def open_session(self, reader=None, writer=None):
+        """
+        Create a new session that runs over the gateway's shared connections
+        """
+        return GatewaySession(self, reader=reader, writer=writer)
+
+    async def subscribe(self, session, *channels):
+        """
+        Add a session to channels, subscribing the shared PubSub connection to any channel that is new
+        """
+        new_channels = []
+        for channel in channels:
+            if channel not in self.subscribers:
+                self.subscribers[channel] = set()
+                new_channels.append(channel)
+            self.subscribers[channel].add(session)
+        if new_channels:
+            await self.pubsub.subscribe(*new_channels)
+        self.start_listening()
+
+    async def unsubscribe(self, session, *channels):
+        """
+        Remove a session from channels, unsubscribing the shared connection from channels nobody is left in
+        """
+        empty_channels = []
+        for channel in channels:
+            sessions = self.subscribers.get(channel)
+            if sessions is None:
+                continue
+            sessions.discard(session)
+            if not sessions:
+                del self.subscribers[channel]
+                empty_channels.append(channel)
+        if empty_channels:
+            await self.pubsub.unsubscribe(*empty_channels)
+
+    async def drop(self, session):
+        """
+        Remove a session from every channel it is subscribed to
+        """
+        channels = [channel for channel, sessions in self.subscribers.items() if session in sessions]
+        await self.unsubscribe(session, *channels)
+
+    def start_listening(self):
+        """
+        Start the shared listener coroutine, if it is not already running
+        """
+        if self.listening:
+            return
+        self.listening = True
+        self.listener_task = asyncio.ensure_future(self.listen_for_messages())
+
+    async def listen_for_messages(self):
+        """
+        Read messages from the shared PubSub connection and queue them for every subscribed session
+        """
+        while self.listening:
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=LISTEN_TIMEOUT)
+            if message and message['type'] == 'message':
+                channel = text(message['channel'])
+                for session in self.subscribers.get(channel, ()):
+                    session.inbox.put_nowait((channel, message['data']))
+
+    async def handle_connection(self, reader, writer):
+        """
+        Run an interactive chat session for one TCP connection
+        """
+        session = self.open_session(reader=reader, writer=writer)
+        try:
+            # run() closes the session however it ends
+            await session.run()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        """
+        Accept chat sessions over TCP until the process is stopped
+        """
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Gateway listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def close(self):
+        """
+        Stop the shared listener and close the shared connections
+        """
+        self.listening = False
+        if self.listener_task is not None:
+            await self.listener_task
+            self.listener_task = None
+        await self.pubsub.aclose()
+        await self.pubsub_client.aclose()
+        await self.client.aclose()
+
+
+class CountingWriter:
+    """
+    A stand-in for a session's output stream that only counts what would have been written
+    """
+    def __init__(self):
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+    async def drain(self):
+        pass
+
+
+async def load_test(gateway, users):
+    """
+    Connect many synthetic users through the gateway and compare the Redis connections it needs
+    with one process (one client and one PubSub connection) per user
+    """
+    before = (await gateway.client.info("clients"))["connected_clients"]
+
+    sessions = []
+    start = time.perf_counter()
+    for i in range(users):
+        session = gateway.open_session(writer=CountingWriter())
+        await session.create_user(f"loadtest-{i}", "0", "n/a", "n/a")
+        await session.join("loadtest")
+        sessions.append(session)
+    setup_seconds = time.perf_counter() - start
+
+    # One message to the shared channel reaches every other user
+    start = time.perf_counter()
+    await sessions[0].publish("loadtest", "hello from the load test")
+    expected = users - 1
+    while sum(session.writer.writes for session in sessions) < expected:
+        await asyncio.sleep(0.001)
+    fanout_seconds = time.perf_counter() - start
+
+    after = (await gateway.client.info("clients"))["connected_clients"]
+    gateway_connections = after - before + 1
+
+    for session in sessions:
+        await session.delete_user()
+        await session.close()
+
+    print(f"Users: {users}")
+    print(f"Setup time: {setup_seconds:.2f}s")
+    print(f"Fan-out of one message to {expected} users: {fanout_seconds * 1000:.1f} ms")
+    print(f"Redis connections with one process per user: {users * 2}")
+    print(f"Redis connections through the gateway: {gateway_connections}")
+    print(f"Connections per user: {gateway_connections / users:.4f} (was 2)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Serve many chat users from one process")
+    parser.add_argument("--redis-host", default="my-redis")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--max-connections", type=int, default=20, help="size of the shared connection pool")
+    parser.add_argument("--host", default="0.0.0.0", help="address to accept chat sessions on")
+    parser.add_argument("--port", type=int, default=7000, help="port to accept chat sessions on")
+    parser.add_argument("--codec", default="json", choices=["json", "struct", "msgpack"], help="format sessions send messages in")
+    parser.add_argument("--rate-limit", type=parse_rate_limit, action="append", default=[], metavar="COMMAND=USES/SECONDS",
+                        help="change how often a command can be used, e.g. send=20/10 (per channel) or send_total=40/10 (across channels); may be repeated")
+    parser.add_argument("--no-rate-limit", action="store_true", help="turn off every rate limit")
+    parser.add_argument("--load-test", type=int, metavar="USERS", help="run a load test with this many users and exit")
+    args = parser.parse_args()
+
+    rate_limits = {} if args.no_rate_limit else dict(RATE_LIMITS, **dict(args.rate_limit))
+    gateway = ChatGateway(args.redis_host, args.redis_port, args.max_connections, args.codec, rate_limits)
+    try:
+        if args.load_test:
+            await load_test(gateway, args.load_test)
+        else:
+            await gateway.serve(args.host, args.port)
+    finally:
+        await gateway.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
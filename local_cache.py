@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache:
+    """
+    An in-process LRU cache with a time-to-live for values read from Redis. Entries are grouped by
+    the Redis key they were read from, so a change to that key drops everything cached from it.
+    """
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (redis key, field) -> (expiry time, value), least recently used first
+        self.entries = OrderedDict()
+        # redis key -> set of (redis key, field) entries read from it
+        self.fields = {}
+        # Bumped on every invalidation, so a value read while its key was changing is not stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # The listener thread invalidates while the main thread reads
+        self.lock = threading.Lock()
+
+    def get(self, key, field, loader):
+        """
+        Return the cached value for (key, field), calling loader() to read it from Redis on a miss
+        """
+        entry_key = (key, field)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(entry_key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(entry_key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        value = loader()
+
+        with self.lock:
+            if generation == self.generation:
+                self.entries[entry_key] = (now + self.ttl, value)
+                self.entries.move_to_end(entry_key)
+                self.fields.setdefault(key, set()).add(entry_key)
+                while len(self.entries) > self.max_entries:
+                    (old_key, old_field), _ = self.entries.popitem(last=False)
+                    self.forget(old_key, (old_key, old_field))
+        return value
+
+    def forget(self, key, entry_key):
+        """
+        Remove an entry from the per-key index. The caller holds the lock
+        """
+        fields = self.fields.get(key)
+        if fields is not None:
+            fields.discard(entry_key)
+            if not fields:
+                del self.fields[key]
+
+    def invalidate(self, key):
+        """
+        Drop everything cached from a Redis key
+        """
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            for entry_key in self.fields.pop(key, ()):
+                self.entries.pop(entry_key, None)
+
+    def clear(self):
+        """
+        Drop every cached value, for example when invalidations may have been missed
+        """
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            self.entries.clear()
+            self.fields.clear()
+
+    def stats(self):
+        """
+        Return the cache's counters
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,317 @@
+import argparse
+import re
+import time
+
+import redis
+
+from chat_scripts import ChatScripts
+from redis_chatroom import HISTORY_MAXLEN, NUMSUB_BATCH_SIZE, batched, history_key, stream_id_tuple
+
+# Keys read per SCAN call and sent per pipeline
+BATCH_SIZE = 500
+# Seconds to rest between batches, so the chat's own commands are never stuck behind a long run of ours
+BATCH_PAUSE = 0.01
+# Seconds between maintenance passes
+PASS_INTERVAL = 300
+# A channel nobody has joined or is subscribed to is removed once it has had no messages for this many days
+ABANDON_AFTER_DAYS = 30
+# Fewest messages per channel the memory budget may trim histories down to
+MIN_HISTORY = 50
+# A user's keys other than their profile, by prefix; they are orphaned once the profile is gone
+USER_KEY_PREFIXES = ["channels:", "last_seen:", "inbox:", "unread:"]
+# Units --memory-budget understands
+SIZE_UNITS = {"b": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3}
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def parse_size(value):
+    """
+    Parse a size such as 512mb or 2gb into bytes
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?b)?\s*", value.lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f"expected a size such as 512mb, got {value!r}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2) or "b"])
+
+
+def parse_channel_retention(value):
+    """
+    Parse a --channel-retention option such as general=7 into ("general", 7.0)
+    """
+    channel, _, days = value.rpartition("=")
+    try:
+        return channel, float(days)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected CHANNEL=DAYS, got {value!r}")
+
+
+def format_bytes(size):
+    """
+    Format a number of bytes for the pass report
+    """
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return f"{size} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+class MaintenanceWorker:
+    """
+    Garbage-collects what the chat leaves behind and keeps its memory bounded: keys of deleted users, channels
+    nobody uses any more, history and search postings older than their retention, and, when Redis is over its
+    memory budget, the oldest history of every channel. All of it is done incrementally with SCAN, in small
+    pipelined batches with a pause between them, so the server is never blocked for long.
+    """
+    def __init__(self, client, retention_days=None, channel_retention=None, abandon_after_days=ABANDON_AFTER_DAYS,
+                 history_maxlen=HISTORY_MAXLEN, memory_budget=None, min_history=MIN_HISTORY, batch_size=BATCH_SIZE,
+                 pause=BATCH_PAUSE):
+        self.client = client
+        self.scripts = ChatScripts(client)
+        # Days of history kept by default, and for particular channels (None keeps everything)
+        self.retention_days = retention_days
+        self.channel_retention = channel_retention or {}
+        self.abandon_after_days = abandon_after_days
+        self.history_maxlen = history_maxlen
+        # Messages kept per channel; lowered while Redis is over its memory budget and raised again once it is not
+        self.history_cap = history_maxlen
+        self.memory_budget = memory_budget
+        self.min_history = min_history
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def batches(self, items):
+        """
+        Group what a SCAN-family iterator returns into batches, resting between them
+        """
+        for batch in batched(items, self.batch_size):
+            yield batch
+            time.sleep(self.pause)
+
+    def scan_batches(self, pattern, key_type=None):
+        """
+        Batches of the keys matching a pattern, read incrementally with SCAN
+        """
+        return self.batches(self.client.scan_iter(match=pattern, count=self.batch_size, _type=key_type))
+
+    def used_memory(self):
+        """
+        Bytes of memory Redis is using
+        """
+        return self.client.info("memory")["used_memory"]
+
+    def retention_cutoff(self, channel):
+        """
+        Time (ms) before which a channel's messages are dropped, or None if they are kept however old they are
+        """
+        days = self.channel_retention.get(channel, self.retention_days)
+        if days is None:
+            return None
+        return int(time.time() * 1000 - days * DAY_MS)
+
+    def run_pass(self):
+        """
+        Run every maintenance task once and return what was done
+        """
+        start = time.perf_counter()
+        memory_before = self.used_memory()
+        stats = {"orphaned_keys": self.collect_orphans(), "abandoned_channels": self.collect_channels()}
+        stats["history_trimmed"], stats["postings_trimmed"] = self.apply_retention()
+        self.enforce_budget(stats)
+        stats["memory_before"] = memory_before
+        stats["memory_after"] = self.used_memory()
+        stats["history_cap"] = self.history_cap
+        stats["seconds"] = time.perf_counter() - start
+        return stats
+
+    def collect_orphans(self):
+        """
+        Remove the keys and index entries of users whose profile no longer exists. Returns how many were removed
+        """
+        removed = 0
+        for prefix in USER_KEY_PREFIXES:
+            for keys in self.scan_batches(f"{prefix}*"):
+                removed += self.remove_orphans({key[len(prefix):] for key in keys})
+        for entries in self.batches(self.client.zscan_iter("users", count=self.batch_size)):
+            removed += self.remove_orphans({username for username, _ in entries})
+        return removed
+
+    def remove_orphans(self, usernames):
+        """
+        Remove what is left of the given users whose profiles are gone, one round trip to find them and one to remove them
+        """
+        usernames = sorted(usernames)
+        pipe = self.client.pipeline(transaction=False)
+        for username in usernames:
+            pipe.exists(f"user:{username}")
+        orphans = [username for username, exists in zip(usernames, pipe.execute()) if not exists]
+        if not orphans:
+            return 0
+
+        # The script checks the profile again, in case the user identified since
+        pipe = self.client.pipeline(transaction=False)
+        for username in orphans:
+            keys = [f"user:{username}", "users", "presence"] + [prefix + username for prefix in USER_KEY_PREFIXES]
+            self.scripts.delete_orphaned(keys=keys, args=[username], client=pipe)
+        return sum(pipe.execute())
+
+    def collect_channels(self):
+        """
+        Remove channels that no user has joined, nobody is subscribed to and nobody has written to in a while,
+        along with their history and search postings. Returns how many were removed
+        """
+        # Channels joined from now on are recorded with a later time, and kept by the removal script
+        seconds, microseconds = self.client.time()
+        started = seconds * 1000 + microseconds // 1000
+        cutoff = int(time.time() * 1000 - self.abandon_after_days * DAY_MS)
+        joined = set()
+        for keys in self.scan_batches("channels:*"):
+            pipe = self.client.pipeline(transaction=False)
+            for key in keys:
+                pipe.smembers(key)
+            for channels in pipe.execute():
+                joined.update(channels)
+
+        removed = set()
+        for channels in self.batches(self.client.sscan_iter("channel_names", count=self.batch_size)):
+            candidates = [channel for channel in channels if channel not in joined]
+            for batch in batched(candidates, NUMSUB_BATCH_SIZE):
+                removed.update(self.remove_abandoned(batch, started, cutoff))
+        if removed:
+            self.remove_postings(removed, cutoff)
+        return len(removed)
+
+    def remove_abandoned(self, channels, started, cutoff):
+        """
+        Remove the channels among the given unjoined ones that have no subscribers and no messages since the
+        cutoff, and return them. The script checks again, so a channel joined meanwhile is kept
+        """
+        idle = [channel for channel, count in self.client.pubsub_numsub(*channels) if count == 0]
+        if not idle:
+            return []
+        pipe = self.client.pipeline(transaction=False)
+        for channel in idle:
+            pipe.xrevrange(history_key(channel), count=1)
+        abandoned = [channel for channel, newest in zip(idle, pipe.execute())
+                     if not newest or stream_id_tuple(newest[0][0])[0] < cutoff]
+        if not abandoned:
+            return []
+
+        pipe = self.client.pipeline(transaction=False)
+        for channel in abandoned:
+            keys = ["channel_names", "channel_joins", history_key(channel)]
+            self.scripts.delete_abandoned(keys=keys, args=[channel, started, cutoff], client=pipe)
+        return [channel for channel, deleted in zip(abandoned, pipe.execute()) if deleted]
+
+    def remove_postings(self, channels, cutoff):
+        """
+        Remove the search postings of removed channels, in one SCAN over every posting however many channels there
+        are. Only postings from before the cutoff go, so a channel that is written to again keeps its new ones
+        """
+        for keys in self.scan_batches("search:*", "zset"):
+            # Postings are search:<channel>:<word>, and words never contain a colon
+            keys = [key for key in keys if key[len("search:"):].rsplit(":", 1)[0] in channels]
+            if keys:
+                pipe = self.client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.zremrangebyscore(key, "-inf", f"({cutoff}")
+                pipe.execute()
+
+    def apply_retention(self):
+        """
+        Drop history entries and search postings older than their channel's retention, and trim every history
+        to the current cap. Trimming is approximate (whole stream nodes at a time), which keeps it cheap.
+        Returns (history entries removed, postings removed)
+        """
+        history_trimmed = 0
+        for keys in self.scan_batches("history:*", "stream"):
+            pipe = self.client.pipeline(transaction=False)
+            for key in keys:
+                cutoff = self.retention_cutoff(key[len("history:"):])
+                if cutoff is not None:
+                    pipe.xtrim(key, minid=f"{cutoff}-0", approximate=True)
+                pipe.xtrim(key, maxlen=self.history_cap, approximate=True)
+            history_trimmed += sum(pipe.execute())
+
+        postings_trimmed = 0
+        for keys in self.scan_batches("search:*", "zset"):
+            pipe = self.client.pipeline(transaction=False)
+            for key in keys:
+                # Postings are search:<channel>:<word>, or search:*:<word> across all channels
+                channel = key[len("search:"):].rsplit(":", 1)[0]
+                cutoff = self.retention_cutoff(channel)
+                if cutoff is not None:
+                    pipe.zremrangebyscore(key, "-inf", f"({cutoff}")
+                if channel != "*":
+                    pipe.zremrangebyrank(key, 0, -self.history_cap - 1)
+            postings_trimmed += sum(pipe.execute())
+        return history_trimmed, postings_trimmed
+
+    def enforce_budget(self, stats):
+        """
+        While Redis uses more memory than the budget, halve the history kept per channel (down to min_history)
+        and trim again. Once it is comfortably under budget, let histories grow back
+        """
+        if self.memory_budget is None:
+            return
+        used = self.used_memory()
+        while used > self.memory_budget and self.history_cap > self.min_history:
+            self.history_cap = max(self.min_history, self.history_cap // 2)
+            history_trimmed, postings_trimmed = self.apply_retention()
+            stats["history_trimmed"] += history_trimmed
+            stats["postings_trimmed"] += postings_trimmed
+            used = self.used_memory()
+        if used < self.memory_budget * 0.8 and self.history_cap < self.history_maxlen:
+            self.history_cap = min(self.history_maxlen, self.history_cap * 2)
+        stats["over_budget"] = used > self.memory_budget
+
+    def run(self, interval=PASS_INTERVAL, once=False):
+        """
+        Run maintenance passes every interval seconds, printing what each one did
+        """
+        while True:
+            print_pass(self.run_pass(), self.memory_budget)
+            if once:
+                return
+            time.sleep(interval)
+
+
+def print_pass(stats, memory_budget):
+    """
+    Print one line about a maintenance pass
+    """
+    reclaimed = stats["memory_before"] - stats["memory_after"]
+    print(f"Pass finished in {stats['seconds']:.2f}s: removed {stats['orphaned_keys']} orphaned keys and "
+          f"{stats['abandoned_channels']} abandoned channels, trimmed {stats['history_trimmed']} history entries and "
+          f"{stats['postings_trimmed']} search postings. Memory {format_bytes(stats['memory_before'])} -> "
+          f"{format_bytes(stats['memory_after'])} (reclaimed {format_bytes(reclaimed)})", flush=True)
+    if stats.get("over_budget"):
+        print(f"Still over the memory budget of {format_bytes(memory_budget)} with histories trimmed to "
+              f"{stats['history_cap']} messages per channel", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clean up and bound the memory of the chatroom's Redis data")
+    parser.add_argument("--host", default="my-redis", help="Redis host")
+    parser.add_argument("--port", type=int, default=6379, help="Redis port")
+    parser.add_argument("--once", action="store_true", help="run one pass and exit")
+    parser.add_argument("--interval", type=float, default=PASS_INTERVAL, help="seconds between passes")
+    parser.add_argument("--retention-days", type=float, help="drop history older than this many days (kept by default)")
+    parser.add_argument("--channel-retention", type=parse_channel_retention, action="append", default=[],
+                        metavar="CHANNEL=DAYS", help="retention for one channel, overriding --retention-days; may be repeated")
+    parser.add_argument("--abandon-after-days", type=float, default=ABANDON_AFTER_DAYS,
+                        help="remove channels nobody has joined once they have had no messages for this many days")
+    parser.add_argument("--history-maxlen", type=int, default=HISTORY_MAXLEN, help="most messages kept per channel")
+    parser.add_argument("--memory-budget", type=parse_size, help="trim histories further while Redis uses more than this, e.g. 512mb")
+    parser.add_argument("--min-history", type=int, default=MIN_HISTORY, help="fewest messages per channel the budget may trim to")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="keys read per SCAN call and sent per pipeline")
+    parser.add_argument("--pause", type=float, default=BATCH_PAUSE, help="seconds to rest between batches")
+    args = parser.parse_args()
+
+    client = redis.Redis(host=args.host, port=args.port, decode_responses=True)
+    worker = MaintenanceWorker(client, args.retention_days, dict(args.channel_retention), args.abandon_after_days,
+                               args.history_maxlen, args.memory_budget, args.min_history, args.batch_size, args.pause)
+    worker.run(args.interval, args.once)
+
+
+if __name__ == "__main__":
+    main()
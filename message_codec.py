@@ -0,0 +1,147 @@
+import json
+import os
+import struct
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Version of the envelope layout, carried in every message so it can change without breaking old readers
+ENVELOPE_VERSION = 1
+
+# Bits of the flags byte
+FLAG_PRIVATE = 0x01
+# The message ID is the entry ID of the copy kept in the channel's history stream
+FLAG_STORED = 0x02
+
+# First byte of a struct-encoded message. 0xc1 is never used by msgpack and is not valid UTF-8,
+# so it cannot be confused with either of the other formats
+STRUCT_MAGIC = 0xc1
+# magic, version, flags, sent_at (ms), sender length, ID length; then sender, ID and body follow. The lengths
+# are two bytes wide, so a sender of any length (in UTF-8 bytes) up to 65535 fits
+STRUCT_HEADER = struct.Struct(">BBBQHH")
+
+
+def make_envelope(sender, message, private=False, message_id=None, stored=False, sent_at=None):
+    """
+    Build the envelope for a chat message. Without an ID one is generated
+    """
+    return {
+        "from": sender,
+        "message": message,
+        "private": private,
+        "stored": stored,
+        "id": message_id or os.urandom(8).hex(),
+        "sent_at": sent_at if sent_at is not None else int(time.time() * 1000),
+    }
+
+
+class JsonCodec:
+    """
+    The original JSON format. Old clients read the "from", "message" and "private" keys and ignore the rest
+    """
+    name = "json"
+
+    def encode(self, envelope):
+        data = {"v": ENVELOPE_VERSION, "from": envelope["from"], "message": envelope["message"],
+                "id": envelope["id"], "sent_at": envelope["sent_at"]}
+        if envelope["private"]:
+            data["private"] = True
+        if envelope["stored"]:
+            data["stored"] = True
+        return json.dumps(data, separators=(",", ":")).encode()
+
+    def decode(self, payload):
+        data = json.loads(payload)
+        # Messages from clients that predate the envelope have no ID or timestamp
+        return make_envelope(data["from"], data["message"], data.get("private", False),
+                             data.get("id"), data.get("stored", False), data.get("sent_at"))
+
+
+class StructCodec:
+    """
+    A fixed binary header followed by the sender, the message ID and the UTF-8 body
+    """
+    name = "struct"
+
+    def encode(self, envelope):
+        sender = envelope["from"].encode()
+        message_id = envelope["id"].encode()
+        flags = (FLAG_PRIVATE if envelope["private"] else 0) | (FLAG_STORED if envelope["stored"] else 0)
+        header = STRUCT_HEADER.pack(STRUCT_MAGIC, ENVELOPE_VERSION, flags, envelope["sent_at"], len(sender), len(message_id))
+        return b"".join((header, sender, message_id, envelope["message"].encode()))
+
+    def decode(self, payload):
+        _, _, flags, sent_at, sender_length, id_length = STRUCT_HEADER.unpack_from(payload)
+        start = STRUCT_HEADER.size
+        sender = payload[start:start + sender_length].decode()
+        start += sender_length
+        message_id = payload[start:start + id_length].decode()
+        message = payload[start + id_length:].decode()
+        return make_envelope(sender, message, bool(flags & FLAG_PRIVATE), message_id, bool(flags & FLAG_STORED), sent_at)
+
+
+class MsgpackCodec:
+    """
+    msgpack array of [version, flags, sent_at, sender, id, body]. Needs the msgpack package
+    """
+    name = "msgpack"
+
+    def encode(self, envelope):
+        flags = (FLAG_PRIVATE if envelope["private"] else 0) | (FLAG_STORED if envelope["stored"] else 0)
+        return msgpack.packb([ENVELOPE_VERSION, flags, envelope["sent_at"], envelope["from"], envelope["id"], envelope["message"]])
+
+    def decode(self, payload):
+        _, flags, sent_at, sender, message_id, message = msgpack.unpackb(payload)
+        return make_envelope(sender, message, bool(flags & FLAG_PRIVATE), message_id, bool(flags & FLAG_STORED), sent_at)
+
+
+CODECS = {"json": JsonCodec(), "struct": StructCodec()}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+
+def get_codec(name):
+    """
+    Look up a codec by name
+    """
+    if name not in CODECS:
+        if name == "msgpack":
+            raise ValueError("The msgpack codec needs the msgpack package (pip install msgpack)")
+        raise ValueError(f"Unknown message codec {name!r}; choose one of {', '.join(sorted(CODECS))}")
+    return CODECS[name]
+
+
+def decode_envelope(payload):
+    """
+    Decode a message in any supported format, telling them apart by their first byte
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if payload[:1] == b"{":
+        return CODECS["json"].decode(payload)
+    if payload[0] == STRUCT_MAGIC:
+        return CODECS["struct"].decode(payload)
+    if msgpack is None:
+        raise ValueError("Received a msgpack message but the msgpack package is not installed")
+    return CODECS["msgpack"].decode(payload)
+
+
+def text(value):
+    """
+    Decode a channel name or key from a pubsub connection that returns bytes
+    """
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def raw_client(client, **overrides):
+    """
+    A client with the same connection settings as client but returning bytes, so pubsub messages
+    can carry binary payloads. Works for both redis.Redis and redis.asyncio.Redis. Any other
+    connection settings to change can be passed as keyword arguments
+    """
+    pool = client.connection_pool
+    kwargs = dict(pool.connection_kwargs, decode_responses=False, **overrides)
+    return type(client)(connection_pool=type(pool)(connection_class=pool.connection_class, **kwargs))
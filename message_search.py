@@ -0,0 +1,96 @@
+import os
+import re
+
+# Words are runs of letters, digits and apostrophes, compared in lower case
+WORD_PATTERN = re.compile(r"[\w']+")
+# Words too common to be worth a posting list
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have i if in is it its me my no not of on or so that the
+this to was we were what when with you your
+""".split())
+# Longest word that is indexed; longer ones are cut down to this
+MAX_WORD_LENGTH = 40
+
+# Newest postings kept per word across all channels. Each channel's own posting lists are capped at
+# its history length, since older messages have been trimmed from its stream anyway
+MAX_POSTINGS = 100000
+
+
+def tokenize(text):
+    """
+    Split a message into the distinct words it is indexed under
+    """
+    words = set()
+    for word in WORD_PATTERN.findall(text.lower()):
+        word = word.strip("'")[:MAX_WORD_LENGTH]
+        if word and word not in STOPWORDS:
+            words.add(word)
+    return words
+
+
+class MessageIndex:
+    """
+    An inverted index over channel messages, kept in Redis. Every word has a posting list per channel and one
+    across all channels: sorted sets of the messages' history stream IDs, scored by the time they were sent,
+    so a query intersects the lists for its words and reads the newest matches within a time range.
+    """
+    def __init__(self, client, channel_postings=1000, max_postings=MAX_POSTINGS):
+        self.client = client
+        self.channel_postings = channel_postings
+        self.max_postings = max_postings
+
+    def channel_key(self, channel, word):
+        """
+        Name of the posting list for a word in one channel. Members are stream entry IDs
+        """
+        return f"search:{channel}:{word}"
+
+    def global_key(self, word):
+        """
+        Name of the posting list for a word across all channels. Members are "<entry ID> <channel>"
+        """
+        return f"search:*:{word}"
+
+    def add(self, target, channel, entry_id, sent_at, text):
+        """
+        Queue the postings for a stored message on a pipeline (or send them on a client)
+        """
+        for word in tokenize(text):
+            channel_key = self.channel_key(channel, word)
+            global_key = self.global_key(word)
+            target.zadd(channel_key, {entry_id: sent_at})
+            target.zadd(global_key, {f"{entry_id} {channel}": sent_at})
+            # Keep only the newest postings; the lowest ranks are the oldest messages
+            target.zremrangebyrank(channel_key, 0, -self.channel_postings - 1)
+            target.zremrangebyrank(global_key, 0, -self.max_postings - 1)
+
+    def search(self, text, channel=None, since=None, until=None, limit=20):
+        """
+        Return up to limit (channel, entry ID) pairs for the newest messages containing every word of text,
+        optionally only in one channel and sent between since and until (milliseconds)
+        """
+        words = sorted(tokenize(text))
+        if not words:
+            return []
+        if channel is None:
+            keys = [self.global_key(word) for word in words]
+        else:
+            keys = [self.channel_key(channel, word) for word in words]
+        newest = until if until is not None else "+inf"
+        oldest = since if since is not None else "-inf"
+
+        if len(keys) == 1:
+            members = self.client.zrevrangebyscore(keys[0], newest, oldest, start=0, num=limit)
+        else:
+            # Intersect the posting lists into a short-lived key, read the newest matches and drop it again,
+            # all in one transaction. Redis starts from the smallest list, so rare words make queries cheap
+            result_key = f"search:result:{os.urandom(8).hex()}"
+            pipe = self.client.pipeline()
+            pipe.zinterstore(result_key, keys, aggregate="MAX")
+            pipe.zrevrangebyscore(result_key, newest, oldest, start=0, num=limit)
+            pipe.delete(result_key)
+            _, members, _ = pipe.execute()
+
+        if channel is not None:
+            return [(channel, entry_id) for entry_id in members]
+        return [tuple(reversed(member.split(" ", 1))) for member in members]
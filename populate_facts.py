@@ -1,7 +1,8 @@
+import argparse
 import redis
 
+from bulk_data import load_rows
 
-r = redis.Redis(host='my-redis', port=6379, decode_responses=True)
 
 # Random Assortment of facts I find personally interesting or think are important to know (Sources in README)
 fun_facts = [
@@ -30,6 +31,12 @@ fun_facts = [
 ]
 
 
-# Add facts to Redis set
-for fact in fun_facts:
-    r.sadd("facts", fact)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add the sample facts to Redis")
+    parser.add_argument("--host", default="my-redis", help="Redis host")
+    parser.add_argument("--port", type=int, default=6379, help="Redis port")
+    args = parser.parse_args()
+    r = redis.Redis(host=args.host, port=args.port, decode_responses=True)
+
+    # Add facts through the facts engine, in one pipeline per batch. Facts that are already there are left as they are
+    load_rows(r, "facts", ({"fact": fact} for fact in fun_facts))
@@ -1,7 +1,8 @@
+import argparse
 import random 
 import redis 
 
-r = redis.Redis(host='my-redis', port=6379, db=0)
+from bulk_data import load_rows
 
 # List of randomly selected cities to generate weather data for
 cities = [
@@ -24,9 +25,19 @@ conditions = ["Sunny", "Humid", "Partly Cloudy", "Cloudy", "Rainy", "Thunderstor
 def random_temp():
     return random.randint(40, 80)  
 
-# Storing fake weather data
-for city in cities:
-    condition = random.choice(conditions)
-    temp = random_temp()
-    weather = f"{condition}, {temp}°F"
-    r.hset("weather", city, weather)
+# Generating fake weather data
+def weather_rows():
+    for city in cities:
+        condition = random.choice(conditions)
+        temp = random_temp()
+        yield {"city": city, "weather": f"{condition}, {temp}°F"}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add sample weather reports to Redis")
+    parser.add_argument("--host", default="my-redis", help="Redis host")
+    parser.add_argument("--port", type=int, default=6379, help="Redis port")
+    args = parser.parse_args()
+    r = redis.Redis(host=args.host, port=args.port, db=0)
+
+    # Storing fake weather data, in one variadic HSET per batch
+    load_rows(r, "weather", weather_rows())
@@ -0,0 +1,90 @@
+import threading
+from collections import deque
+
+# What to do with a message that arrives when the buffer is full
+OVERFLOW_POLICIES = ["drop-oldest", "drop-newest", "coalesce"]
+
+
+class ReceiveBuffer:
+    """
+    A bounded buffer between the listener thread and the terminal. It holds messages as received
+    (channel and decoded envelope) so they are only formatted when they are displayed, and when it
+    is full it drops or collapses messages according to its overflow policy instead of growing.
+    """
+    def __init__(self, max_size=1000, policy="coalesce"):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}; choose one of {', '.join(OVERFLOW_POLICIES)}")
+        self.max_size = max_size
+        self.policy = policy
+        # Items are (channel, envelope) for messages and (None, text) for notices
+        self.items = deque()
+        # Messages collapsed by the coalesce policy, per channel, not yet reported to the user
+        self.skipped = {}
+        self.received = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        # Set while there is something to drain, so the renderer can sleep until there is
+        self.ready = threading.Event()
+
+    def put_message(self, channel, envelope):
+        """
+        Add a received message. Returns False if it was dropped or collapsed
+        """
+        return self.put((channel, envelope))
+
+    def put_text(self, text):
+        """
+        Add a line of text to display, such as a message read back from history
+        """
+        return self.put((None, text))
+
+    def put(self, item):
+        with self.lock:
+            self.received += 1
+            self.ready.set()
+            if len(self.items) < self.max_size:
+                self.items.append(item)
+                return True
+
+            self.dropped += 1
+            if self.policy == "drop-oldest":
+                self.items.popleft()
+                self.items.append(item)
+                return True
+            if self.policy == "coalesce":
+                channel = item[0] if item[0] is not None else "history"
+                self.skipped[channel] = self.skipped.get(channel, 0) + 1
+            return False
+
+    def drain(self):
+        """
+        Take everything that is waiting. Collapsed messages come back as one notice per channel
+        """
+        with self.lock:
+            items = list(self.items)
+            self.items.clear()
+            skipped = self.skipped
+            self.skipped = {}
+            self.ready.clear()
+        for channel, count in skipped.items():
+            items.append((None, f"\n{count} message(s) skipped in {channel} because they arrived faster than they could be shown\n"))
+        return items
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for something to drain. Returns whether there is
+        """
+        return self.ready.wait(timeout)
+
+    def stats(self):
+        """
+        Return the buffer's depth and counters
+        """
+        with self.lock:
+            return {
+                "depth": len(self.items),
+                "max_size": self.max_size,
+                "policy": self.policy,
+                "received": self.received,
+                "dropped": self.dropped,
+            }
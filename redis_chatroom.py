@@ -1,32 +1,66 @@
+import argparse
+import os
 import redis
-import json
-import random
+import re
 import threading
 import time
-import queue
-import select
-import sys
-import time
+from redis.backoff import FullJitterBackoff, NoBackoff
+from redis.retry import Retry
 
-class RedisChatbot:
-    """ 
-    A chatbot that allows users to chat with each other in channels and send private messages
-    """
-    def __init__(self, host='my-redis', port=6379):
-        # Connect to the Redis server
-        self.client = redis.Redis(host=host, port=port, decode_responses=True)
-        # Create a pubsub instance
-        self.pubsub = self.client.pubsub()
-        self.current_user = None
-        self.listening = False
-        # Create a queue to store messages
-        self.message_queue = queue.Queue()
+from chat_metrics import Metrics
+from chat_scripts import ChatScripts
+from fact_store import FactStore
+from local_cache import LocalCache
+from message_codec import CODECS, decode_envelope, get_codec, make_envelope, raw_client, text
+from message_search import MessageIndex
+from receive_buffer import OVERFLOW_POLICIES, ReceiveBuffer
+from terminal_renderer import MAX_FPS, TerminalRenderer, compose_frame
 
-    def initialize(self):
-        """ 
-        Display the welcome message and list of commands
-        """
-        welcome_message = """
+# How long the listener blocks waiting for a message before re-checking whether it should keep listening
+LISTEN_TIMEOUT = 0.5
+# Reconnect delays grow exponentially from RECONNECT_BASE up to RECONNECT_CAP seconds. The delay is picked at random
+# below that bound (full jitter), so clients dropped together by a Redis restart do not all come back at once
+RECONNECT_BASE = 0.5
+RECONNECT_CAP = 30
+# Commands are retried this many times on a connection error before the error reaches the user
+COMMAND_RETRIES = 3
+
+# In durable mode every channel keeps roughly this many messages in its history stream
+HISTORY_MAXLEN = 1000
+# Keys whose values are cached locally: the weather hash and user profiles. Facts are read from Redis,
+# since each user moves through their own order of them
+CACHED_PREFIXES = ["weather", "user:"]
+# Channel Redis sends client-side caching invalidations on
+INVALIDATION_CHANNEL = "__redis__:invalidate"
+
+# Number of profiles fetched per round trip when listing users
+USERS_PAGE_SIZE = 100
+
+# Number of messages shown when joining a channel and on each page of !history
+HISTORY_PAGE_SIZE = 10
+# Most matches shown by !search
+SEARCH_RESULTS = 20
+
+# Most uses of each rate-limited command per window: (uses, seconds). Sends are limited per user and
+# channel, private messages per user and recipient, and added facts per user. The _total limits apply
+# to a user's sends (or private messages) across every channel (or recipient) together
+RATE_LIMITS = {"send": (20, 10), "send_total": (40, 10), "private": (20, 10), "private_total": (40, 10),
+               "add_fact": (5, 60)}
+
+# Private messages kept in each user's inbox, and shown per page of !inbox
+INBOX_MAXLEN = 100
+INBOX_PAGE_SIZE = 10
+
+# Identified users heartbeat into the presence sorted set every PRESENCE_INTERVAL seconds, and count as
+# online until PRESENCE_TTL seconds after their last heartbeat (three missed heartbeats)
+PRESENCE_INTERVAL = 15
+PRESENCE_TTL = 45
+# Most expired users each heartbeat removes from the presence set, so one prune never blocks Redis for long
+PRESENCE_PRUNE_BATCH = 1000
+# Channels whose subscriber counts are fetched per round trip
+NUMSUB_BATCH_SIZE = 100
+
+WELCOME_MESSAGE = """
         _______________                        |*\_/*|________
     |  ___________  |     .-.     .-.      ||_/-\_|______  |
     | |           | |    .****. .****.     | |           | |
@@ -43,13 +77,19 @@ class RedisChatbot:
     Here are the commands you can use:
     !help: List of commands
     !weather <city>: Weather update
-    !fact: Random fact
+    !fact [popular]: A fact you have not seen yet, or one of the most popular facts
     !add_fact <fact>: Add a fact you find interesting
     !whoami: Your user information
-    !users: List all users
+    !users [online]: List all users, or only the users who are online
     !delete_profile: Delete your user profile
     !list_my_channels: List all channels you are subscribed to
-    !list_all_channels: List all channels available
+    !list_all_channels [online]: List all channels available with how many people are in them, or only the active ones
+    !history <channel> [before-id]: Earlier messages in a channel (durable mode only)
+    !inbox [page]: Your private messages, newest first
+    !search <words> [#channel] [since:YYYY-MM-DD] [until:YYYY-MM-DD]: Find messages (durable mode only)
+    !cache_stats: Local cache hit and miss counters
+    !queue_stats: Incoming message buffer depth and drop counters
+    !metrics [json]: Timings and counters, when started with --metrics
     
     Options:
     1: Identify yourself
@@ -65,71 +105,587 @@ class RedisChatbot:
     If you ever lose your way, type !help to see this message again.
 
     """
-        print(welcome_message)
 
-    def identify_user(self):
+# The ! commands listed above, which are the only ones timed under their own name
+SPECIAL_COMMANDS = frozenset(re.findall(r"^\s*(![a-z_]+)", WELCOME_MESSAGE, re.MULTILINE))
+
+# Shown when another session deleted the current user's profile
+PROFILE_DELETED_MESSAGE = "Your profile has been deleted in another session. Type 1 to identify yourself again.\n"
+
+GOODBYE_MESSAGE = """
+    ____                 _   _                _ 
+    / ___| ___   ___   __| | | |__  _   _  ___| |
+    | |  _ / _ \ / _ \ / _` | | '_ \| | | |/ _ \ |
+    | |_| | (_) | (_) | (_| | | |_) | |_| |  __/_|
+    \____|\___/ \___/ \__,_| |_.__/ \__, |\___(_)
+                                    |___/        
+                            """
+
+
+def batched(iterable, size):
+    """ 
+    Yield lists of up to size items from an iterable
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_rate_limit(value):
+    """
+    Parse a --rate-limit option such as send=20/10 into ("send", (20, 10.0))
+    """
+    try:
+        command, limit = value.split("=")
+        uses, seconds = limit.split("/")
+        if command not in RATE_LIMITS:
+            raise ValueError
+        return command, (int(uses), float(seconds))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected COMMAND=USES/SECONDS with COMMAND one of {', '.join(RATE_LIMITS)}")
+
+
+def rate_limit_windows(rate_limits, command, scope, key):
+    """ 
+    The keys and arguments of the RATE_LIMIT script for one use of a command: a window for the scope (the
+    channel or recipient) and, for scoped commands, one across every scope, so spreading a flood over many
+    channels does not get around the limit. key(scope) names a window; scope None is the one across all
+    """
+    windows = []
+    if command in rate_limits:
+        windows.append((key(scope), rate_limits[command]))
+    if scope is not None and f"{command}_total" in rate_limits:
+        windows.append((key(None), rate_limits[f"{command}_total"]))
+    args = [os.urandom(8).hex()]
+    for _, (uses, seconds) in windows:
+        args += [uses, int(seconds * 1000)]
+    return [window_key for window_key, _ in windows], args
+
+
+def history_key(channel):
+    """ 
+    Name of the stream that holds a channel's message history
+    """
+    return f"history:{channel}"
+
+
+def stream_id_tuple(entry_id):
+    """ 
+    Turn a stream entry ID like "1700000000000-3" into a tuple that compares in stream order
+    """
+    milliseconds, sequence = entry_id.split("-")
+    return int(milliseconds), int(sequence)
+
+
+def format_history_entry(channel, entry_id, fields):
+    """ 
+    Format a message read back from a channel's history stream
+    """
+    # Stream IDs start with the time the entry was added, in milliseconds
+    sent = time.strftime('%Y-%m-%d %I:%M:%S %p', time.localtime(stream_id_tuple(entry_id)[0] / 1000))
+    return f"[{entry_id}] {sent} -- {fields['from']} in {channel}: {fields['message']}"
+
+
+class RedisChatbot:
+    """ 
+    A chatbot that allows users to chat with each other in channels and send private messages
+    """
+    # Command private messages are published with from inside the send script
+    publish_command = "PUBLISH"
+
+    def __init__(self, host='my-redis', port=6379, durable=False, client=None, cache=True, codec="json",
+                 buffer_size=1000, overflow="coalesce", metrics=None, rate_limits=None, max_fps=MAX_FPS):
+        # Connect to the Redis server, unless we were handed a client to use
+        if client is None:
+            retry = Retry(FullJitterBackoff(cap=RECONNECT_CAP, base=RECONNECT_BASE), COMMAND_RETRIES)
+            client = redis.Redis(host=host, port=port, decode_responses=True, retry=retry)
+        self.client = client
+        # Optional instrumentation (see chat_metrics). Without it nothing is wrapped, timed or counted
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.instrument(self.client)
+            self.publish = metrics.timed("publish_seconds", self.publish, kind="channel")
+            self.publish_private = metrics.timed("publish_seconds", self.publish_private, kind="private")
+        # Channels we are subscribed to, so they can be subscribed to again after a reconnect
+        self.subscriptions = set()
+        self.subscription_lock = threading.RLock()
+        self.backoff = FullJitterBackoff(cap=RECONNECT_CAP, base=RECONNECT_BASE)
+        # Background thread that keeps the current user marked as online
+        self.heartbeat_thread = None
+        self.heartbeat_stop = threading.Event()
+        # Limits on how often each command can be used, checked in Redis so they hold across sessions
+        self.rate_limits = dict(RATE_LIMITS) if rate_limits is None else rate_limits
+        # Multi-key updates run as Lua scripts, loaded into Redis once at startup
+        self.load_scripts()
+        # Create a pubsub instance. Its connection returns bytes, since messages may be in a binary format
+        self.pubsub = self.open_pubsub()
+        # Format outgoing messages are encoded in; incoming messages are decoded whatever their format
+        self.codec = get_codec(codec)
+        self.current_user = None
+        self.listening = False
+        self.listener_thread = None
+        # Create a bounded buffer to store received messages until they are displayed
+        self.message_queue = ReceiveBuffer(buffer_size, overflow)
+        # Received messages are written from the renderer's own thread, a frame at a time, while the main
+        # thread waits for input. The buffer is looked up on every wait, so it can be swapped out
+        self.renderer = TerminalRenderer(self.render_frame, lambda timeout: self.message_queue.wait(timeout),
+                                         max_fps=max_fps)
+        # In durable mode messages are also appended to a stream per channel, so they can be read back later
+        self.durable = durable
+        # Stored channel messages are indexed by word so they can be searched
+        self.search_index = self.open_search_index() if durable else None
+        self.facts = self.open_fact_store()
+        # Newest history entry seen on each channel; the listener thread and the main loop both update it
+        self.last_seen = {}
+        self.unsaved_seen = {}
+        self.last_seen_lock = threading.Lock()
+        # Local copies of weather, facts and profiles, kept consistent by invalidations from Redis
+        self.cache = None
+        self.tracking_connection = None
+        if cache:
+            self.cache = LocalCache()
+            self.enable_invalidation()
+            # Invalidations arrive on the pubsub connection, so listen from the start
+            self.start_listening()
+        if metrics is not None:
+            self.register_gauges()
+
+    def register_gauges(self):
         """ 
-        Identify the user, set up their private inbox, and start listening for messages
+        Report the receive buffer's and the local cache's state with the metrics
         """
+        self.metrics.gauge("queue_depth", lambda: self.message_queue.stats()["depth"])
+        self.metrics.gauge("queue_received", lambda: self.message_queue.stats()["received"])
+        self.metrics.gauge("queue_dropped", lambda: self.message_queue.stats()["dropped"])
+        if self.cache is not None:
+            self.metrics.gauge("cache_hits", lambda: self.cache.stats()["hits"])
+            self.metrics.gauge("cache_misses", lambda: self.cache.stats()["misses"])
 
-        # A user is able to identify themselves with a username.
-        username = input("Enter your username: ")
+    def open_pubsub(self):
+        """ 
+        Create the pubsub instance chat messages (and cache invalidations) are received on
+        """
+        # The listener reconnects and resubscribes itself (see reconnect), so the connection does not retry on its own
+        return raw_client(self.client, retry=Retry(NoBackoff(), 0)).pubsub()
 
-        # Store user information, including their name, age, gender, and location
-        age = input("Enter your age: ")
-        gender = input("Enter your gender: ")
-        location = input("Enter your location: ")
+    def open_search_index(self):
+        """ 
+        Create the index that stored channel messages are searched through
+        """
+        # Each channel's postings only need to cover the messages its history stream still holds
+        return MessageIndex(self.client, channel_postings=HISTORY_MAXLEN)
+
+    def open_fact_store(self):
+        """ 
+        Create the facts engine that serves !fact and !add_fact
+        """
+        return FactStore(self.scripts)
+
+    def user_key(self, username):
+        """ 
+        Name of the hash that holds a user's profile
+        """
+        return f"user:{username}"
+
+    def channels_key(self, username):
+        """ 
+        Name of the set of channels a user has joined
+        """
+        return f"channels:{username}"
+
+    def last_seen_key(self, username):
+        """ 
+        Name of the hash of the newest history entry a user has seen on each channel
+        """
+        return f"last_seen:{username}"
+
+    def inbox_key(self, username):
+        """ 
+        Name of the list of private messages sent to a user, newest first
+        """
+        return f"inbox:{username}"
+
+    def unread_key(self, username):
+        """ 
+        Name of the count of private messages a user has not read yet
+        """
+        return f"unread:{username}"
+
+    def rate_limit_key(self, command, username, scope=None):
+        """ 
+        Name of the sorted set of a user's recent uses of a rate-limited command, optionally per channel or recipient
+        """
+        return f"rate:{command}:{username}" if scope is None else f"rate:{command}:{username}:{scope}"
+
+    def private_channel(self, username):
+        """ 
+        Name of the channel that serves as a user's private inbox
+        """
+        # There is no natively implemented direct messaging in Redis, so we create a private channel is created for each user
+        return f"{username} private inbox"
+
+    def load_scripts(self):
+        """ 
+        Register the Lua scripts that update several keys atomically and load them into Redis
+        """
+        self.scripts = ChatScripts(self.client)
+        self.scripts.load()
+
+    def save_profile(self, username, profile):
+        """ 
+        Store a user's profile, register their private inbox and index them, in one atomic round trip.
+        Returns how many unread private messages are waiting for them
+        """
+        fields = [item for field_value in profile.items() for item in field_value]
+        keys = [self.user_key(username), self.channels_key(username), "users", self.unread_key(username)]
+        return self.scripts.identify_user(keys=keys, args=[username, self.private_channel(username), time.time(), *fields])
+
+    def add_user_channel(self, channel):
+        """ 
+        Record that the current user joined a channel. Returns False if their profile no longer exists
+        """
+        keys = [self.user_key(self.current_user), self.channels_key(self.current_user), "channel_names", "channel_joins"]
+        return bool(self.scripts.join_channel(keys=keys, args=[channel]))
+
+    def remove_user_keys(self, username):
+        """ 
+        Delete a user's keys and drop them from the users index in one atomic round trip. Returns their channels
+        """
+        keys = [self.user_key(username), self.channels_key(username), self.last_seen_key(username), "users", "presence",
+                self.inbox_key(username), self.unread_key(username)]
+        return self.scripts.delete_user(keys=keys, args=[username])
+
+    def prune_presence(self, target, cutoff):
+        """ 
+        Queue the removal of a batch of users whose last heartbeat is older than cutoff on a client or pipeline
+        """
+        return self.scripts.prune_presence(keys=["presence"], args=[cutoff, PRESENCE_PRUNE_BATCH], client=target)
+
+    def check_rate(self, command, scope=None):
+        """ 
+        Count one use of a rate-limited command, in one round trip. Returns 0 if it is allowed, otherwise how many
+        seconds to wait before it will be. Users who have not identified themselves share one limit
+        """
+        username = self.current_user or "anonymous"
+        keys, args = rate_limit_windows(self.rate_limits, command, scope,
+                                        lambda window: self.rate_limit_key(command, username, window))
+        if not keys:
+            return 0
+        wait_ms = self.scripts.rate_limit(keys=keys, args=args)
+        if wait_ms and self.metrics is not None:
+            self.metrics.inc("rate_limited_total", command=command)
+        return wait_ms / 1000
+
+    def subscriber_counts(self, channels):
+        """ 
+        Return the number of subscribers of each channel, fetching the counts in batches
+        """
+        counts = {}
+        for batch in batched(channels, NUMSUB_BATCH_SIZE):
+            counts.update(self.client.pubsub_numsub(*batch))
+        return counts
+
+    def subscribe(self, *channels):
+        """ 
+        Subscribe to one or more chat channels
+        """
+        with self.subscription_lock:
+            # Remember the channels first, so they are subscribed to on reconnect even if this fails
+            self.subscriptions.update(channels)
+            self.pubsub.subscribe(*channels)
+
+    def unsubscribe(self, *channels):
+        """ 
+        Unsubscribe from one or more chat channels
+        """
+        with self.subscription_lock:
+            self.subscriptions.difference_update(channels)
+            self.pubsub.unsubscribe(*channels)
+
+    def publish_payload(self, target, channel, payload):
+        """ 
+        Queue a PUBLISH of an encoded message on a client or pipeline
+        """
+        return target.publish(channel, payload)
+
+    def enable_invalidation(self):
+        """ 
+        Ask Redis to tell us when a cached key changes. Uses client-side caching (CLIENT TRACKING, Redis 6+)
+        and falls back to keyspace notifications; if neither is available cached values just expire
+        """
+        prefixes = []
+        for prefix in CACHED_PREFIXES:
+            prefixes += ["PREFIX", prefix]
+        try:
+            # Invalidations are redirected to the pubsub connection, so get its ID before it starts subscribing
+            self.pubsub.execute_command("CLIENT", "ID")
+            pubsub_id = self.pubsub.parse_response(block=True)
+            if isinstance(pubsub_id, Exception):
+                raise pubsub_id
+            # Broadcast mode reports changes to any key with these prefixes, whichever connection read it,
+            # so tracking only has to be switched on for this one dedicated connection
+            self.tracking_connection = self.client.connection_pool.make_connection()
+            self.tracking_connection.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", pubsub_id, "BCAST", *prefixes)
+            self.tracking_connection.read_response()
+            self.pubsub.subscribe(INVALIDATION_CHANNEL)
+        except redis.ResponseError:
+            self.close_tracking_connection()
+            self.enable_keyspace_notifications()
+
+    def enable_keyspace_notifications(self):
+        """ 
+        Subscribe to keyspace notifications for the cached keys, if the server sends them. The server's configuration
+        is left alone: turning notifications on would cost every client for every write, not just ours
+        """
+        try:
+            flags = self.client.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+            # K: keyspace channel, g: DEL and friends, h: hash, s: set, x: expired, e: evicted ("A" covers all but K)
+            missing = "".join(flag for flag in "Kghsxe" if flag not in flags and not (flag != "K" and "A" in flags))
+        except redis.ResponseError:
+            # Managed servers often disallow CONFIG, so subscribe in case notifications are on
+            missing = ""
+        if missing:
+            self.message_queue.put_text(f"\nRedis does not report changes to cached keys, so weather and profiles "
+                                        f"may be shown up to {self.cache.ttl} seconds out of date.\n")
+            return
+        db = self.client.connection_pool.connection_kwargs.get("db", 0)
+        self.pubsub.psubscribe(*[f"__keyspace@{db}__:{prefix}*" for prefix in CACHED_PREFIXES])
+
+    def close_tracking_connection(self):
+        """ 
+        Close the connection client-side caching was switched on for, if there is one
+        """
+        if self.tracking_connection is not None:
+            self.tracking_connection.disconnect()
+            self.tracking_connection = None
+
+    def cached(self, key, field, loader):
+        """ 
+        Read a value through the local cache, or straight from Redis if caching is off
+        """
+        if self.cache is None:
+            return loader()
+        return self.cache.get(key, field, loader)
+
+    def invalidate(self, *keys):
+        """ 
+        Drop locally cached values for keys this client has just changed
+        """
+        if self.cache is not None:
+            for key in keys:
+                self.cache.invalidate(key)
+
+    def handle_invalidation(self, message):
+        """ 
+        Handle an invalidation or keyspace notification from the pubsub connection. Returns True if it was one
+        """
+        if message['type'] == 'pmessage':
+            # The channel is "__keyspace@<db>__:<key>"
+            self.invalidate(text(message['channel']).split(':', 1)[1])
+            return True
+        if message['type'] == 'message' and text(message['channel']) == INVALIDATION_CHANNEL:
+            if message['data'] is None:
+                # Redis flushed its tracking table (for example after FLUSHALL), so drop everything
+                self.cache.clear()
+            else:
+                self.invalidate(*[text(key) for key in message['data']])
+            return True
+        return False
+
+    def show_cache_stats(self):
+        """ 
+        Print the local cache's hit and miss counters
+        """
+        if self.cache is None:
+            print("The local cache is turned off.\n")
+            return
+        stats = self.cache.stats()
+        print("\nLocal cache:")
+        print(f"Entries: {stats['entries']}")
+        print(f"Hits: {stats['hits']}")
+        print(f"Misses: {stats['misses']}")
+        print(f"Hit rate: {stats['hit_rate']:.1%}")
+        print(f"Invalidations: {stats['invalidations']}\n")
+
+    def show_queue_stats(self):
+        """ 
+        Print the incoming message buffer's depth and drop counters
+        """
+        stats = self.message_queue.stats()
+        print("\nIncoming message buffer:")
+        print(f"Waiting to be shown: {stats['depth']} of {stats['max_size']}")
+        print(f"Overflow policy: {stats['policy']}")
+        print(f"Received: {stats['received']}")
+        print(f"Dropped: {stats['dropped']}\n")
+
+    def show_metrics(self, args):
+        """ 
+        Print the metrics in the Prometheus text format, or as JSON
+        """
+        if self.metrics is None:
+            print("Metrics are turned off. Start the chatbot with --metrics to collect them.\n")
+            return
+        print(self.metrics.to_json() if args == ["json"] else self.metrics.to_prometheus())
+
+    def initialize(self):
+        """ 
+        Display the welcome message and list of commands
+        """
+        print(WELCOME_MESSAGE)
+
+    def create_user(self, username, age, gender, location):
+        """ 
+        Store the user's profile, set up their private inbox and start listening for messages.
+        Returns how many unread private messages are waiting for the user
+        """
         join_date = time.strftime("%Y-%m-%d %I:%M:%S", time.localtime())
 
-        user_key = f"user:{username}"
-        self.client.hset(user_key, mapping={
+        unread = self.save_profile(username, {
             "name": username,
             "age": age,
             "gender": gender,
             "location": location, 
             "join_date": join_date
         })
+        self.invalidate(self.user_key(username))
+        # Identifying as someone else signs the previous user out
+        if self.current_user and self.current_user != username:
+            self.go_offline()
         self.current_user = username
 
-        # There is no natively implemented direct messaging in Redis, so we create a private channel is created for each user
-        private_channel = f"{username} private inbox"
-        self.client.sadd(f"channels:{self.current_user}", private_channel)
-
         # Each user automatically subscribes to their private channel
-        self.pubsub.subscribe(private_channel)
+        self.subscribe(self.private_channel(username))
+
+        # Mark the user as online for as long as they are here
+        self.start_heartbeat()
 
         # Start listening for messages
-        if not self.listening:
-            self.listening = True
-            # Create a new thread to listen for messages
-            thread = threading.Thread(target=self.listen_for_messages)
-            # Set the thread as a daemon so it will stop when the main thread stops
-            thread.daemon = True
-            # Start the thread
-            thread.start()
+        self.start_listening()
+        return unread
+
+    def identify_user(self):
+        """ 
+        Identify the user, set up their private inbox, and start listening for messages
+        """
+
+        # A user is able to identify themselves with a username.
+        username = self.prompt("Enter your username: ")
+
+        # Store user information, including their name, age, gender, and location
+        age = self.prompt("Enter your age: ")
+        gender = self.prompt("Enter your gender: ")
+        location = self.prompt("Enter your location: ")
+        unread = self.create_user(username, age, gender, location)
         
         # Welcome message
         print(f"Welcome {username}! You have been identified and your private inbox has been set up.\n")
+        if unread:
+            print(f"You have {unread} unread private message(s). Type !inbox to read them.\n")
+
+        # Show what was sent to the user's channels since they were last here
+        if self.durable:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.hgetall(self.last_seen_key(username))
+            pipe.smembers(self.channels_key(username))
+            last_seen, channels = pipe.execute()
+            with self.last_seen_lock:
+                self.last_seen = last_seen
+                self.unsaved_seen = {}
+            self.catch_up(channels)
+
+    def index_existing_users(self):
+        """ 
+        Add profiles created before the users index existed to the index, using SCAN so the server is never blocked
+        """
+        for user_keys in batched(self.client.scan_iter("user:*", count=USERS_PAGE_SIZE), USERS_PAGE_SIZE):
+            now = time.time()
+            self.client.zadd("users", {user_key.split(':', 1)[1]: now for user_key in user_keys}, nx=True)
+        self.client.set("users:indexed", 1)
 
     def list_all_users(self):
         """ 
-        List all users in the chatroom
+        List all users in the chatroom in the order they joined, one page of profiles at a time
         """
-        user_keys = self.client.keys("user:*")
-        
-        if not user_keys:
+        print_header = True
+        start = 0
+        # Profiles from before the index existed are indexed the first time anyone lists users. Users who
+        # identified since then are already in the index, so the marker is checked rather than the index
+        pipe = self.client.pipeline(transaction=False)
+        pipe.exists("users:indexed")
+        pipe.zrange("users", start, start + USERS_PAGE_SIZE - 1)
+        indexed, usernames = pipe.execute()
+        if not indexed:
+            self.index_existing_users()
+            usernames = None
+        while True:
+            if usernames is None:
+                usernames = self.client.zrange("users", start, start + USERS_PAGE_SIZE - 1)
+            if not usernames:
+                break
+
+            # Fetch the page's profiles in one round trip
+            pipe = self.client.pipeline(transaction=False)
+            for username in usernames:
+                pipe.hgetall(self.user_key(username))
+            profiles = pipe.execute()
+
+            if print_header:
+                print("\nList of all users:")
+                print_header = False
+            for username, user_info in zip(usernames, profiles):
+                print(f"- {username}")
+                for key, value in user_info.items():
+                    if key != 'name':  
+                        print(f"  {key.capitalize()}: {value}")
+                print()  
+            start += USERS_PAGE_SIZE
+            usernames = None
+
+        if print_header:
             print("No users found.")
-            return
 
-        print("\nList of all users:")
-        for user_key in user_keys:
-            username = user_key.split(':')[1]  
-            user_info = self.client.hgetall(user_key)
+    def list_online_users(self):
+        """ 
+        List the users who are online, most recently active first
+        """
+        cutoff = time.time() - PRESENCE_TTL
+        # Both reads use the presence set's score index, so they stay cheap however many users are online
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zcount("presence", cutoff, "+inf")
+        pipe.zrevrangebyscore("presence", "+inf", cutoff, start=0, num=USERS_PAGE_SIZE)
+        online, usernames = pipe.execute()
+
+        if not online:
+            print("No users are online.\n")
+            return
+        print(f"\n{online} user(s) online:")
+        for username in usernames:
             print(f"- {username}")
-            for key, value in user_info.items():
-                if key != 'name':  
-                    print(f"  {key.capitalize()}: {value}")
-            print()  
+        if online > len(usernames):
+            print(f"... and {online - len(usernames)} more")
+        print()
+
+    def delete_user(self):
+        """ 
+        Delete the current user's profile and unsubscribe from all of their channels
+        """
+        # Stop heartbeating first, so a heartbeat cannot put the user back in the presence set after the script
+        # has removed them
+        self.stop_heartbeat()
+        channels = self.remove_user_keys(self.current_user)
+        self.invalidate(self.user_key(self.current_user))
+
+        # Unsubscribe from all channels, including the private channel, with one command
+        self.unsubscribe(*(set(channels) | {self.private_channel(self.current_user)}))
+        self.current_user = None
+        # With the cache on, the listener keeps running to receive invalidations
+        if self.cache is None:
+            self.stop_listening()
     
     def delete_profile(self):
         """ 
@@ -139,29 +695,26 @@ class RedisChatbot:
             print("Please identify yourself first. Type 1 to identify yourself.\n")
             return
 
-        confirm = input(f"Are you sure you want to delete your profile, {self.current_user}? This action cannot be undone. (yes/no): ")
+        confirm = self.prompt(f"Are you sure you want to delete your profile, {self.current_user}? This action cannot be undone. (yes/no): ")
         if confirm.lower() != 'yes':
             print("Profile deletion cancelled.\n")
             return
 
-        # Delete the user's profile information
-        user_key = f"user:{self.current_user}"
-        self.client.delete(user_key)
+        username = self.current_user
+        self.delete_user()
+        print(f"Profile for {username} has been deleted.")
 
-        # Unsubscribe from all channels
-        channels_key = f"channels:{self.current_user}"
-        channels = self.client.smembers(channels_key)
-        for channel in channels:
-            self.pubsub.unsubscribe(channel)
-        self.client.delete(channels_key)
-
-        # Unsubscribe from the private channel
-        private_channel = f"{self.current_user} private inbox"
-        self.pubsub.unsubscribe(private_channel)
+    def join(self, channel):
+        """ 
+        Add the channel to the user's channels and subscribe to it. Returns False if the user's profile was deleted
+        """
+        # The channel name is added to two sets: one for the user and to keep track of all channels
+        if not self.add_user_channel(channel):
+            return False
 
-        print(f"Profile for {self.current_user} has been deleted.")
-        self.current_user = None
-        self.listening = False
+        # Function for user to actually subscribe to the channel
+        self.subscribe(channel)
+        return True
 
     def join_channel(self):
         """ 
@@ -172,16 +725,22 @@ class RedisChatbot:
             return
         
         # A user is able to join a channel by entering the channel name.
-        channel = input("Enter the channel name to join: ")
+        channel = self.prompt("Enter the channel name to join: ")
+        if not self.join(channel):
+            print(PROFILE_DELETED_MESSAGE)
+            return
+        print(f"You've joined the channel: {channel}\n")
 
-        # The channel name is added to two sets: one for the user and to keep track of all channels
-        self.client.sadd(f"channels:{self.current_user}", channel)
-        self.client.sadd("channel_names", channel)
+        # Show the most recent messages so the user has some context
+        if self.durable:
+            self.show_recent(channel)
 
-        # Function for user to actually subscribe to the channel
-        self.pubsub.subscribe(channel)
-        print(f"You've joined the channel: {channel}\n")
-        
+    def leave(self, channel):
+        """ 
+        Remove the channel from the user's channels and unsubscribe from it
+        """
+        self.client.srem(self.channels_key(self.current_user), channel)
+        self.unsubscribe(channel)
 
     def leave_channel(self):
         """ 
@@ -191,17 +750,33 @@ class RedisChatbot:
             print("Please identify yourself first. Type 1 to identify yourself.\n")
             return
         
-        channel = input("Enter the channel name to leave: ")
-
-        # Remove the channel from the user's set of channels
-        self.client.srem(f"channels:{self.current_user}", channel)
-
-        # Unsubscribe from the channel
-        self.pubsub.unsubscribe(channel)
+        channel = self.prompt("Enter the channel name to leave: ")
+        self.leave(channel)
 
         # Notify the user that they have left the channel
         print(f"You've left the channel: {channel}")
 
+    def publish(self, channel, message):
+        """ 
+        Publish a message to a channel. Returns True if the user is a member of the channel
+        """
+        envelope = make_envelope(self.current_user, message)
+
+        # Store the message so it can be read back later; the ID lets receivers skip messages they have already seen
+        if self.durable:
+            self.store_envelope(channel, envelope)
+
+        # Publish the message, record the channel and check membership in one round trip
+        pipe = self.client.pipeline(transaction=False)
+        self.publish_payload(pipe, channel, self.codec.encode(envelope))
+        pipe.sadd("channel_names", channel)
+        pipe.sismember(self.channels_key(self.current_user), channel)
+        # Index the stored message for !search in the same round trip
+        if self.search_index is not None:
+            self.search_index.add(pipe, channel, envelope["id"], envelope["sent_at"], message)
+        is_member = pipe.execute()[2]
+        return is_member
+
     def send_message(self):
         """ 
         Allow the user to send a message to a channel
@@ -211,31 +786,36 @@ class RedisChatbot:
             self.identify_user()
             return
         
-        channel = input("Enter the channel name: ").strip()
-        message = input("Enter your message: ").strip()
-        
-        # Format the message as a JSON object
-        message_obj = {
-            "from": self.current_user,
-            "message": message
-        }
-
-        # Publish the message to the channel
-        self.client.publish(channel, json.dumps(message_obj))
-
-        # Add the channel to the list of all channels if it doesn't already exist in the set
-        self.client.sadd("channel_names", channel)
+        channel = self.prompt("Enter the channel name: ").strip()
+        message = self.prompt("Enter your message: ").strip()
+        wait = self.check_rate("send", channel)
+        if wait:
+            print(f"You are sending messages to {channel} too quickly. Please wait {wait:.1f} seconds and try again.\n")
+            return
+        is_member = self.publish(channel, message)
 
         print(f"Message sent to channel {channel}")
 
         # If user not in channel, ask if they want to join
-        if not self.client.sismember(f"channels:{self.current_user}", channel):
-            join = input(f"You are not in the channel {channel}. Would you like to join? (yes/no): \n")
+        if not is_member:
+            join = self.prompt(f"You are not in the channel {channel}. Would you like to join? (yes/no): \n")
             if join.lower() == 'yes':
-                self.client.sadd(f"channels:{self.current_user}", channel)
-                self.pubsub.subscribe(channel)
-                print(f"You've joined the channel: {channel}\n")
-    
+                if self.join(channel):
+                    print(f"You've joined the channel: {channel}\n")
+                else:
+                    print(PROFILE_DELETED_MESSAGE)
+
+    def publish_private(self, recipient, message):
+        """ 
+        Put a private message in the recipient's inbox and publish it to their private channel, in one atomic round trip.
+        Returns -1 if the recipient does not exist, otherwise how many of their clients received it right away
+        """
+        envelope = make_envelope(self.current_user, message, private=True)
+        keys = [self.user_key(recipient), self.inbox_key(recipient), self.unread_key(recipient)]
+        # The inbox keeps the JSON form, which reads back as text whatever codec the sender publishes with
+        args = [CODECS["json"].encode(envelope), self.codec.encode(envelope), self.private_channel(recipient),
+                INBOX_MAXLEN, self.publish_command]
+        return self.scripts.send_private(keys=keys, args=args)
 
     def send_private_message(self):
         """ 
@@ -248,30 +828,68 @@ class RedisChatbot:
         # A user is able to send a private message to another user by entering the recipient's username, which 
         # is also the name of the channel set up as the recipient's private inbox.
 
-        recipient = input("Enter the username of the recipient: ")
-        message = input("Enter your private message: ")
-        
-        recipient_channel = f"{recipient} private inbox"
-        message_obj = {
-            "from": self.current_user,
-            "message": message,
-            "private": True
-        }
-        
-        # Publish the message to the recipient's private channel
-        self.client.publish(recipient_channel, json.dumps(message_obj))
-        
-        print(f"Private message sent to {recipient}\n")
+        recipient = self.prompt("Enter the username of the recipient: ")
+        message = self.prompt("Enter your private message: ")
+        wait = self.check_rate("private", recipient)
+        if wait:
+            print(f"You are sending messages to {recipient} too quickly. Please wait {wait:.1f} seconds and try again.\n")
+            return
+        receivers = self.publish_private(recipient, message)
+
+        if receivers < 0:
+            print(f"There is no user called {recipient}.\n")
+        elif receivers == 0:
+            print(f"{recipient} is offline. They will find your message in their inbox.\n")
+        else:
+            print(f"Private message sent to {recipient}\n")
+
+    def show_inbox(self, args):
+        """ 
+        Print one page of the user's private messages, newest first. Reading the first page marks them all as read
+        """
+        if not self.current_user:
+            print("Please identify yourself first. Type 1 to identify yourself.\n")
+            return
+        try:
+            page = int(args[0]) if args else 1
+        except ValueError:
+            page = 0
+        if page < 1:
+            print("Please give a page number. For example, !inbox 2\n")
+            return
+
+        # Read the page, the unread count and the inbox length, and acknowledge, in one round trip
+        start = (page - 1) * INBOX_PAGE_SIZE
+        pipe = self.client.pipeline()
+        pipe.lrange(self.inbox_key(self.current_user), start, start + INBOX_PAGE_SIZE - 1)
+        pipe.llen(self.inbox_key(self.current_user))
+        if page == 1:
+            pipe.getset(self.unread_key(self.current_user), 0)
+        results = pipe.execute()
+        payloads, total = results[0], results[1]
+        unread = int(results[2] or 0) if page == 1 else 0
+
+        if not payloads:
+            print("Your inbox is empty.\n" if page == 1 else f"There is no page {page} in your inbox.\n")
+            return
+        print(f"\nYour inbox ({unread} new):" if unread else "\nYour inbox:")
+        for payload in payloads:
+            data = decode_envelope(payload)
+            sent = time.strftime('%Y-%m-%d %I:%M:%S %p', time.localtime(data['sent_at'] / 1000))
+            print(f"{sent} -- {data['from']}: {data['message']}")
+        if start + len(payloads) < total:
+            print(f"\nFor older messages type: !inbox {page + 1}")
+        print()
 
     def get_user_info(self):
         """ 
         Allow the user to get information about another user
         """
-        username = input("Enter username to get info about: ")
-        user_key = f"user:{username}"
+        username = self.prompt("Enter username to get info about: ")
+        user_key = self.user_key(username)
 
         # Retrieve ther user information from the hash mapping
-        user_info = self.client.hgetall(user_key)
+        user_info = self.cached(user_key, None, lambda: self.client.hgetall(user_key))
         if user_info:
             print(f"Info for user {username}:\n")
             for key, value in user_info.items():
@@ -286,10 +904,16 @@ class RedisChatbot:
         if not fact:
             print("Please provide a fact to add.")
             return
+        wait = self.check_rate("add_fact")
+        if wait:
+            print(f"You have added a lot of facts recently. Please wait {wait:.0f} seconds before adding another.\n")
+            return
         
-        # Add the fact to the set of facts
-        self.client.sadd("facts", fact)
-        print("\nFact added successfully! Other users can now learn from your wisdom.\n")
+        # Facts that only differ in case, spacing or punctuation are stored once
+        if self.facts.add(fact):
+            print("\nFact added successfully! Other users can now learn from your wisdom.\n")
+        else:
+            print("\nSomeone already added that fact, so it has been marked as more popular instead.\n")
 
 
     def list_user_channels(self):
@@ -301,7 +925,7 @@ class RedisChatbot:
             return
         
         # Get the set of channels the user has joined
-        channels = self.client.smembers(f"channels:{self.current_user}")
+        channels = self.client.smembers(self.channels_key(self.current_user))
         if channels:
             print("\nList of channels you've joined:")
             for channel in channels:
@@ -310,18 +934,23 @@ class RedisChatbot:
         else:
             print("You haven't joined any channels yet.")
     
-    def list_channels(self):
+    def list_channels(self, online=False):
         """ 
-        List all channels available
+        List all channels available with how many people are subscribed to each, or only the channels someone is in
         """
-        channels = self.client.smembers("channel_names")
+        channels = list(self.client.smembers("channel_names"))
+        counts = self.subscriber_counts(channels)
+        if online:
+            # Only the chat channels' counts are read, in batches, so the cost follows the number of channels.
+            # PUBSUB CHANNELS would also return every online user's private inbox
+            channels = [channel for channel in channels if counts.get(channel, 0)]
         if channels:
-            print("\nList of all channels:")
-            for channel in channels:
-                print(f"- {channel}")
+            print("\nList of active channels:" if online else "\nList of all channels:")
+            for channel in sorted(channels):
+                print(f"- {channel} ({counts.get(channel, 0)} online)")
             print("\n")
         else:
-            print("No channels found.")
+            print("No active channels found." if online else "No channels found.")
     
 
     def handle_special_commands(self, command):
@@ -338,11 +967,14 @@ class RedisChatbot:
             city = " ".join(parts[1:])
             self.get_weather(city)
         elif parts[0] == "!fact":
-            self.get_fact()
+            self.get_fact(popular=parts[1:] == ["popular"])
         elif parts[0] == "!whoami":
             self.get_whoami()
         elif parts[0] == "!users":
-            self.list_all_users()
+            if parts[1:] == ["online"]:
+                self.list_online_users()
+            else:
+                self.list_all_users()
         elif parts[0] == "!delete_profile":
             self.delete_profile()
         elif parts[0] == "!add_fact":
@@ -350,7 +982,19 @@ class RedisChatbot:
         elif parts[0] == "!list_my_channels":
             self.list_user_channels()
         elif parts[0] == "!list_all_channels":
-            self.list_channels()
+            self.list_channels(online=parts[1:] == ["online"])
+        elif parts[0] == "!history":
+            self.show_history(parts[1:])
+        elif parts[0] == "!inbox":
+            self.show_inbox(parts[1:])
+        elif parts[0] == "!search":
+            self.search_messages(parts[1:])
+        elif parts[0] == "!cache_stats":
+            self.show_cache_stats()
+        elif parts[0] == "!queue_stats":
+            self.show_queue_stats()
+        elif parts[0] == "!metrics":
+            self.show_metrics(parts[1:])
         else:
             print("Unknown command. Type !help for a list of commands.")
 
@@ -364,7 +1008,7 @@ class RedisChatbot:
         
         # lowercase the city name because the weather data is stored in lowercase
         city = city.lower()  
-        weather = self.client.hget("weather", city)
+        weather = self.cached("weather", city, lambda: self.client.hget("weather", city))
         if weather:
             print(f"\nThe weather in {city.title()} is {weather}\n")
             return
@@ -372,11 +1016,16 @@ class RedisChatbot:
             print(f"No weather information available for {city.title()}\n")
             return
 
-    def get_fact(self):
+    def get_fact(self, popular=False):
         """ 
-        Get a random fact from the set of facts
+        Get a fact the user has not seen yet, or a popular one. Users who have not identified themselves get popular ones
         """
-        fact = self.client.srandmember("facts")
+        # Facts added before the facts engine existed are imported the first time anyone asks for one
+        self.facts.import_existing()
+        if popular or not self.current_user:
+            fact = self.facts.popular_fact()
+        else:
+            fact = self.facts.next_fact(self.current_user)
         if fact:
             print(f"\nDid you know? {fact}\n")
             return
@@ -390,7 +1039,8 @@ class RedisChatbot:
         if not self.current_user:
             print("Please identify yourself first. Type 1 to identify yourself.")
             return
-        user_info = self.client.hgetall(f"user:{self.current_user}")
+        user_key = self.user_key(self.current_user)
+        user_info = self.cached(user_key, None, lambda: self.client.hgetall(user_key))
         if user_info:
             print("Your user information:\n")
             for key, value in user_info.items():
@@ -399,81 +1049,452 @@ class RedisChatbot:
         else:
             print("No information found for your user.\n")
 
+    def append_history(self, channel, envelope):
+        """ 
+        Append a message to the channel's history stream and return its entry ID
+        """
+        fields = {"from": envelope["from"], "message": envelope["message"]}
+        if envelope["private"]:
+            fields["private"] = "1"
+        # MAXLEN ~ lets Redis trim whole nodes at a time, which keeps trimming cheap while bounding memory
+        return self.client.xadd(history_key(channel), fields, maxlen=HISTORY_MAXLEN, approximate=True)
+
+    def store_envelope(self, channel, envelope):
+        """ 
+        Add a message to the channel's history and give it the stream entry's ID and server timestamp
+        """
+        entry_id = self.append_history(channel, envelope)
+        envelope["id"] = entry_id
+        envelope["stored"] = True
+        envelope["sent_at"] = stream_id_tuple(entry_id)[0]
+
+    def record_seen(self, channel, entry_id):
+        """ 
+        Remember the newest history entry seen on a channel. Returns False if the entry was already seen
+        """
+        with self.last_seen_lock:
+            last = self.last_seen.get(channel)
+            if last and stream_id_tuple(entry_id) <= stream_id_tuple(last):
+                return False
+            self.last_seen[channel] = entry_id
+            self.unsaved_seen[channel] = entry_id
+            return True
+
+    def save_last_seen(self):
+        """ 
+        Write the newest entries seen since the last save to Redis, so a restarted client resumes from there
+        """
+        with self.last_seen_lock:
+            unsaved = self.unsaved_seen
+            self.unsaved_seen = {}
+        if unsaved and self.current_user:
+            try:
+                self.client.hset(self.last_seen_key(self.current_user), mapping=unsaved)
+            except (redis.ConnectionError, redis.TimeoutError):
+                # Keep them for the next save, unless newer entries have been seen since
+                with self.last_seen_lock:
+                    self.unsaved_seen = dict(unsaved, **self.unsaved_seen)
+                raise
+
+    def catch_up(self, channels):
+        """ 
+        Queue every message sent to the given channels after the last one this user saw
+        """
+        for channel in channels:
+            last = self.last_seen.get(channel)
+            if last:
+                # The "(" prefix makes the range exclusive, so the last seen message is not shown again
+                entries = self.client.xrange(history_key(channel), min=f"({last}", max="+", count=HISTORY_MAXLEN)
+            else:
+                # Nothing seen on this channel yet, so show its most recent page
+                entries = self.client.xrevrange(history_key(channel), count=HISTORY_PAGE_SIZE)[::-1]
+            if entries:
+                self.message_queue.put_text(f"\n{len(entries)} new message(s) in {channel} while you were away:")
+            for entry_id, fields in entries:
+                if self.record_seen(channel, entry_id):
+                    self.message_queue.put_text(format_history_entry(channel, entry_id, fields))
+
+    def show_recent(self, channel):
+        """ 
+        Print the last few messages of a channel and mark them as seen
+        """
+        entries = self.client.xrevrange(history_key(channel), count=HISTORY_PAGE_SIZE)
+        if not entries:
+            return
+        print(f"Recent messages in {channel}:")
+        for entry_id, fields in reversed(entries):
+            print(format_history_entry(channel, entry_id, fields))
+            self.record_seen(channel, entry_id)
+        print()
+
+    def show_history(self, args):
+        """ 
+        Print one page of a channel's history, newest page first. An optional entry ID pages back from there
+        """
+        if not self.durable:
+            print("History is only kept when the chatbot runs with --durable.\n")
+            return
+        if not args:
+            print("Please provide a channel name. For example, !history general\n")
+            return
+
+        # Channel names can contain spaces, so only a trailing stream ID is treated as the paging position
+        before = None
+        if len(args) > 1 and re.fullmatch(r"\d+-\d+", args[-1]):
+            before = args.pop()
+        channel = " ".join(args)
+
+        # Private inboxes are only readable by their owner
+        if channel.endswith(" private inbox") and channel != self.private_channel(self.current_user):
+            print("You can only read the history of your own private inbox.\n")
+            return
+
+        newest = f"({before}" if before else "+"
+        entries = self.client.xrevrange(history_key(channel), max=newest, min="-", count=HISTORY_PAGE_SIZE)
+        if not entries:
+            print(f"No earlier messages in {channel}.\n")
+            return
+
+        print(f"\nHistory of {channel}:")
+        for entry_id, fields in reversed(entries):
+            print(format_history_entry(channel, entry_id, fields))
+        if len(entries) == HISTORY_PAGE_SIZE:
+            print(f"\nFor older messages type: !history {channel} {entries[-1][0]}")
+        print()
+
+    def search_messages(self, args):
+        """ 
+        Print the newest stored messages containing every given word, optionally in one channel and time range
+        """
+        if self.search_index is None:
+            print("Search is only available when the chatbot runs with --durable.\n")
+            return
+
+        words = []
+        channel = since = until = None
+        try:
+            for arg in args:
+                if arg.startswith("#") and len(arg) > 1:
+                    channel = arg[1:]
+                elif arg.startswith("since:"):
+                    since = int(time.mktime(time.strptime(arg[6:], "%Y-%m-%d")) * 1000)
+                elif arg.startswith("until:"):
+                    # Include the whole of the last day
+                    until = int((time.mktime(time.strptime(arg[6:], "%Y-%m-%d")) + 86400) * 1000) - 1
+                else:
+                    words.append(arg)
+        except ValueError:
+            print("Dates must look like 2024-10-31.\n")
+            return
+        if not words:
+            print("Please provide some words to search for. For example, !search pizza #general since:2024-10-01\n")
+            return
+
+        matches = self.search_index.search(" ".join(words), channel, since, until, limit=SEARCH_RESULTS)
+
+        # Read the matching messages back from their channels' history streams in one round trip
+        pipe = self.client.pipeline(transaction=False)
+        for match_channel, entry_id in matches:
+            pipe.xrange(history_key(match_channel), min=entry_id, max=entry_id, count=1)
+        entries = pipe.execute() if matches else []
+
+        found = [(match_channel, entry[0]) for (match_channel, _), entry in zip(matches, entries) if entry]
+        if not found:
+            print("No messages found.\n")
+            return
+        print(f"\nMessages matching \"{' '.join(words)}\":")
+        for match_channel, (entry_id, fields) in reversed(found):
+            print(format_history_entry(match_channel, entry_id, fields))
+        print()
+
+    def start_heartbeat(self):
+        """ 
+        Start the background thread that keeps the current user marked as online, if it is not already running
+        """
+        if self.heartbeat_thread is not None:
+            return
+        self.heartbeat_stop.clear()
+        self.heartbeat_thread = threading.Thread(target=self.send_heartbeats)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        """ 
+        Stop the heartbeat thread
+        """
+        if self.heartbeat_thread is None:
+            return
+        self.heartbeat_stop.set()
+        self.heartbeat_thread.join()
+        self.heartbeat_thread = None
+
+    def send_heartbeats(self):
+        """ 
+        Heartbeat every PRESENCE_INTERVAL seconds until told to stop
+        """
+        while True:
+            try:
+                self.heartbeat()
+            except (redis.ConnectionError, redis.TimeoutError):
+                # Presence catches up on the next heartbeat once Redis is back
+                pass
+            if self.heartbeat_stop.wait(PRESENCE_INTERVAL):
+                return
+
+    def heartbeat(self):
+        """ 
+        Record that the current user is online and prune a batch of users who stopped heartbeating, in one round trip
+        """
+        username = self.current_user
+        if not username:
+            return
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd("presence", {username: now})
+        self.prune_presence(pipe, now - PRESENCE_TTL)
+        pipe.execute()
+
+    def go_offline(self):
+        """ 
+        Remove the current user from the presence set, so they are not shown as online until their heartbeat expires
+        """
+        if self.current_user:
+            self.client.zrem("presence", self.current_user)
+
+    def start_listening(self):
+        """ 
+        Start the background thread that listens for messages, if it is not already running
+        """
+        if self.listening:
+            return
+        self.listening = True
+        # Create a new thread to listen for messages
+        self.listener_thread = threading.Thread(target=self.listen_for_messages)
+        # Set the thread as a daemon so it will stop when the main thread stops
+        self.listener_thread.daemon = True
+        # Start the thread
+        self.listener_thread.start()
+
+    def stop_listening(self):
+        """ 
+        Stop the listener thread and wait for it to exit
+        """
+        self.listening = False
+        # The listener wakes up at least every LISTEN_TIMEOUT seconds, so this join is bounded
+        if self.listener_thread and self.listener_thread is not threading.current_thread():
+            self.listener_thread.join(LISTEN_TIMEOUT * 2)
+        self.listener_thread = None
+
     def listen_for_messages(self):
         """
         Listen for messages from the pubsub channel
         """
         while self.listening:
-            # Get the next message from the pubsub channel
-            message = self.pubsub.get_message()
-
-            # If the message is a message type, process the message
-            if message and message['type'] == 'message':
-                data = json.loads(message['data'])
-                channel = message['channel']
-                # If the message is private, only show it to the recipient, not the sender
-                if (data.get('private', False) and (data['from'] != self.current_user)):
-                    self.message_queue.put(f"\n{time.strftime('%I:%M:%S %p', time.localtime())} -- Private message from {data['from']}:\n{data['message']}\n")
-                elif (data['from'] != self.current_user):
-                    # Include the time the message was sent
-                    self.message_queue.put(f"\n{time.strftime('%I:%M:%S %p', time.localtime())} -- Message in channel {channel}\nFrom: {data['from']}\n\n{data['message']}\n")
-            else:
-                time.sleep(0.001)
+            # Block until the pubsub socket is readable (or the timeout expires) instead of polling,
+            # so an idle client sleeps in the kernel rather than waking up a thousand times a second
+            try:
+                message = self.pubsub.get_message(timeout=LISTEN_TIMEOUT)
+            except (redis.ConnectionError, redis.TimeoutError):
+                self.reconnect()
+                continue
+            if self.metrics is not None:
+                self.metrics.inc("listener_polls_total")
+                if not message:
+                    self.metrics.inc("listener_empty_polls_total")
+            if message:
+                self.handle_message(message)
+
+    def reconnect(self):
+        """ 
+        Reopen the pubsub connection after it drops, waiting a little longer (with jitter) after each failed attempt
+        """
+        lost_at = time.time()
+        self.message_queue.put_text("\nLost the connection to Redis. Reconnecting...\n")
+        failures = 0
+        while self.wait(self.backoff.compute(failures)):
+            failures += 1
+            try:
+                self.resubscribe()
+            except (redis.ConnectionError, redis.TimeoutError):
+                continue
+            self.report_gap(list(self.subscriptions), lost_at)
+            return
+
+    def wait(self, seconds):
+        """ 
+        Sleep for up to the given number of seconds, waking up early if we stop listening. Returns whether we still are
+        """
+        deadline = time.monotonic() + seconds
+        while self.listening and time.monotonic() < deadline:
+            time.sleep(min(LISTEN_TIMEOUT, deadline - time.monotonic()))
+        return self.listening
+
+    def resubscribe(self):
+        """ 
+        Replace the pubsub connection and subscribe to every channel again
+        """
+        with self.subscription_lock:
+            old_pubsub = self.pubsub
+            self.pubsub = self.open_pubsub()
+            old_pubsub.close()
+            if self.cache is not None:
+                # Invalidations sent while we were away are lost, so start again with an empty cache
+                self.cache.clear()
+                self.close_tracking_connection()
+                self.enable_invalidation()
+            if self.subscriptions:
+                self.pubsub.subscribe(*self.subscriptions)
+
+    def report_gap(self, channels, lost_at):
+        """ 
+        Tell the user about messages sent while the connection was down. In durable mode they are read back from history
+        """
+        seconds = time.time() - lost_at
+        if self.durable:
+            self.message_queue.put_text(f"\nReconnected to Redis after {seconds:.1f}s.\n")
+            self.catch_up(channels)
+        else:
+            self.message_queue.put_text(f"\nReconnected to Redis after {seconds:.1f}s. "
+                                        "Messages sent while the connection was down were missed.\n")
 
-    def process_message_queue(self):
+    def handle_message(self, message):
         """ 
-        Process the message queue to display messages
+        Handle one message from a pubsub connection
         """
+        # Invalidations for the local cache arrive on the same connection as chat messages
+        if self.handle_invalidation(message):
+            return
+
+        # If the message is a message type (or a sharded message in cluster mode), process the message
+        if message['type'] in ('message', 'smessage'):
+            data = decode_envelope(message['data'])
+            channel = text(message['channel'])
+            # Skip messages that were already shown from the history stream
+            if data['stored'] and not self.record_seen(channel, data['id']):
+                return
+            if self.metrics is not None:
+                # Measured from the sender's clock, so clock skew between machines shows up here too
+                self.metrics.observe("delivery_seconds", max(0.0, time.time() - data['sent_at'] / 1000),
+                                     kind="private" if data['private'] else "channel")
+            # Users do not see their own messages; everything else is formatted when it is displayed
+            if data['from'] != self.current_user:
+                self.message_queue.put_message(channel, data)
+
+    def render_frame(self):
+        """ 
+        Take every waiting message and return the text to show for them, with bursts in one channel grouped
+        """
+        start = time.perf_counter()
+        items = self.message_queue.drain()
+        frame = compose_frame(items, self.current_user)
+        if self.metrics is not None and items:
+            self.metrics.inc("rendered_messages_total", len(items))
+            self.metrics.observe("render_seconds", time.perf_counter() - start)
+
+        if self.durable:
+            try:
+                self.save_last_seen()
+            except (redis.ConnectionError, redis.TimeoutError):
+                # Runs on the renderer's thread, which has no one to tell; the next frame saves them again
+                pass
+        return frame
+
+    def prompt(self, text=""):
+        """ 
+        Read a line the user types, without messages that arrive meanwhile breaking up the prompt
+        """
+        return self.renderer.prompt(text)
+
+    def close(self):
+        """ 
+        Stop listening and close the pubsub and tracking connections
+        """
+        # Stop the listener before closing the connection it is blocked on
+        self.stop_listening()
+        self.stop_heartbeat()
+        self.go_offline()
+        if self.durable:
+            self.save_last_seen()
+        self.close_tracking_connection()
+        self.pubsub.close()
 
-        # Check if there are messages in the queue and display them
-        while not self.message_queue.empty():
-            message = self.message_queue.get()
-            print(message)
-            sys.stdout.flush()
+    def handle_choice(self, choice):
+        """ 
+        Run the menu option or command the user typed. Returns False when the user wants to exit
+        """
+        if choice.startswith("!"):
+            start = time.perf_counter()
+            self.handle_special_commands(choice)
+            if self.metrics is not None:
+                command = choice.split()[0]
+                self.metrics.observe("command_seconds", time.perf_counter() - start,
+                                     command=command if command in SPECIAL_COMMANDS else "other")
+        elif choice == "1":
+            self.identify_user()
+        elif choice == "2":
+            self.join_channel()
+        elif choice == "3":
+            self.leave_channel()
+        elif choice == "4":
+            self.send_message()
+        elif choice == "5":
+            self.get_user_info()
+        elif choice == "6":
+            self.send_private_message()  
+        elif choice == "7":
+            print(GOODBYE_MESSAGE)
+            return False
+        else:
+            print("Invalid choice. Please try again.")
+        return True
 
     def run(self):
         """ 
         Main loop to run the chatbot
         """
         self.initialize()
+        # Messages are shown by the renderer as they arrive, so this loop only waits for what the user types
+        self.renderer.start()
         try:
             while True:
-                rlist, _, _ = select.select([sys.stdin], [], [], 0.1)
-                if rlist:
-                    choice = sys.stdin.readline().strip()
-                    if choice.startswith("!"):
-                        self.handle_special_commands(choice)
-                    elif choice == "1":
-                        self.identify_user()
-                    elif choice == "2":
-                        self.join_channel()
-                    elif choice == "3":
-                        self.leave_channel()
-                    elif choice == "4":
-                        self.send_message()
-                    elif choice == "5":
-                        self.get_user_info()
-                    elif choice == "6":
-                        self.send_private_message()  
-                    elif choice == "7":
-                        print("""
-    ____                 _   _                _ 
-    / ___| ___   ___   __| | | |__  _   _  ___| |
-    | |  _ / _ \ / _ \ / _` | | '_ \| | | |/ _ \ |
-    | |_| | (_) | (_) | (_| | | |_) | |_| |  __/_|
-    \____|\___/ \___/ \__,_| |_.__/ \__, |\___(_)
-                                    |___/        
-                            """)
+                try:
+                    if not self.handle_choice(self.prompt().strip()):
                         break
-                    else:
-                        print("Invalid choice. Please try again.")
-                self.process_message_queue()
+                except (redis.ConnectionError, redis.TimeoutError):
+                    # Commands have already been retried with backoff; keep the session alive until Redis is back
+                    print("\nCould not reach Redis, so that did not go through. Please try again in a moment.\n")
+        except EOFError:
+            # Input was closed, e.g. Ctrl-D or the end of a piped script
+            pass
         finally:
-            self.listening = False
-            self.pubsub.close()
+            self.renderer.stop()
+            self.close()
 
 if __name__ == "__main__":
-    chatbot = RedisChatbot()
+    parser = argparse.ArgumentParser(description="Chat with other users through Redis")
+    parser.add_argument("--host", default="my-redis", help="Redis host")
+    parser.add_argument("--port", type=int, default=6379, help="Redis port")
+    parser.add_argument("--durable", action="store_true", help="keep channel history in Redis Streams so it can be read back later")
+    parser.add_argument("--no-cache", action="store_true", help="read weather, facts and profiles from Redis every time")
+    parser.add_argument("--codec", default="json", choices=["json", "struct", "msgpack"],
+                        help="format to send messages in; every format is understood when receiving, but clients older than the codecs only read json")
+    parser.add_argument("--buffer-size", type=int, default=1000, help="most received messages to hold before the overflow policy applies")
+    parser.add_argument("--overflow", default="coalesce", choices=OVERFLOW_POLICIES,
+                        help="what to do with messages that arrive while the buffer is full")
+    parser.add_argument("--metrics", action="store_true", help="time Redis calls, commands and message delivery; see !metrics")
+    parser.add_argument("--metrics-port", type=int, help="also serve the metrics over HTTP on this port (implies --metrics)")
+    parser.add_argument("--rate-limit", type=parse_rate_limit, action="append", default=[], metavar="COMMAND=USES/SECONDS",
+                        help="change how often a command can be used, e.g. send=20/10 (per channel) or send_total=40/10 (across channels); may be repeated")
+    parser.add_argument("--no-rate-limit", action="store_true", help="turn off every rate limit")
+    parser.add_argument("--max-fps", type=float, default=MAX_FPS, help="most times a second received messages are written to the terminal")
+    args = parser.parse_args()
+    metrics = Metrics() if args.metrics or args.metrics_port else None
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    rate_limits = {} if args.no_rate_limit else dict(RATE_LIMITS, **dict(args.rate_limit))
+    chatbot = RedisChatbot(args.host, args.port, durable=args.durable, cache=not args.no_cache, codec=args.codec,
+                           buffer_size=args.buffer_size, overflow=args.overflow, metrics=metrics, rate_limits=rate_limits,
+                           max_fps=args.max_fps)
     chatbot.run()
 
 
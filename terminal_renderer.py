@@ -0,0 +1,151 @@
+import itertools
+import sys
+import threading
+import time
+
+try:
+    # Lets a prompt be redrawn with whatever the user has typed so far after messages are written above it
+    import readline
+except ImportError:
+    readline = None
+
+# Most frames written per second; messages that arrive in between wait for the next frame
+MAX_FPS = 20
+# How long the renderer waits for messages before checking whether it should keep running
+RENDER_TIMEOUT = 0.5
+# Moves to the start of the line and clears it, so a prompt can be rewritten below new output
+CLEAR_LINE = "\r\033[K"
+
+
+def format_message(channel, data, current_user):
+    """
+    Format a decoded message for display, or return None if the user should not see it
+    """
+    # Users do not see their own messages echoed back to them
+    if data['from'] == current_user:
+        return None
+    # Include the time the message was sent
+    sent = time.strftime('%I:%M:%S %p', time.localtime(data['sent_at'] / 1000))
+    if data.get('private', False):
+        return f"\n{sent} -- Private message from {data['from']}:\n{data['message']}\n"
+    return f"\n{sent} -- Message in channel {channel}\nFrom: {data['from']}\n\n{data['message']}\n"
+
+
+def format_burst(channel, messages):
+    """
+    Format several messages from one channel under a single header, one line each
+    """
+    lines = [f"\n{len(messages)} messages in channel {channel}"]
+    for data in messages:
+        sent = time.strftime('%I:%M:%S %p', time.localtime(data['sent_at'] / 1000))
+        lines.append(f"{sent} {data['from']}: {data['message']}")
+    return "\n".join(lines) + "\n"
+
+
+def burst_channel(item):
+    """
+    The channel a queued item can be grouped by, or None for notices and private messages, which are shown on their own
+    """
+    channel, data = item
+    if channel is None or data.get('private', False):
+        return None
+    return channel
+
+
+def compose_frame(items, current_user):
+    """
+    Turn drained (channel, envelope) and (None, text) items into the text of one frame. Consecutive messages
+    in the same channel are grouped into one burst under a single header; every message is shown
+    """
+    parts = []
+    for channel, group in itertools.groupby(items, key=burst_channel):
+        if channel is None:
+            for item_channel, item in group:
+                parts.append(item if item_channel is None else format_message(item_channel, item, current_user))
+            continue
+        messages = [data for _, data in group if data['from'] != current_user]
+        if len(messages) == 1:
+            parts.append(format_message(channel, messages[0], current_user))
+        elif messages:
+            parts.append(format_burst(channel, messages))
+    return "".join(part + "\n" for part in parts if part)
+
+
+class TerminalRenderer:
+    """
+    Writes received messages to the terminal from its own thread, so a busy channel never holds up reading
+    what the user types. Everything waiting is written as one frame with a single write, at most max_fps
+    times a second, and a prompt the user is answering is redrawn below the new output instead of being
+    broken up by it.
+    """
+    def __init__(self, render_frame, wait, stream=None, max_fps=MAX_FPS):
+        # Returns the text of the next frame, taking what is waiting; waits for something to be waiting
+        self.render_frame = render_frame
+        self.wait = wait
+        self.stream = stream or sys.stdout
+        self.frame_interval = 1 / max_fps
+        self.last_frame = 0
+        # The prompt currently waiting for the user's answer, if any
+        self.prompt_text = None
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start the render thread
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        # Set the thread as a daemon so it will stop when the main thread stops
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the render thread and write anything still waiting
+        """
+        self.running = False
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(RENDER_TIMEOUT * 2)
+        self.thread = None
+        self.write(self.render_frame())
+
+    def run(self):
+        """
+        Write a frame whenever there is something to show, but no sooner than one frame interval after the last
+        """
+        while self.running:
+            if not self.wait(RENDER_TIMEOUT):
+                continue
+            delay = self.last_frame + self.frame_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.write(self.render_frame())
+            self.last_frame = time.monotonic()
+
+    def write(self, frame):
+        """
+        Write a frame in one go. If the user is answering a prompt on a terminal, the prompt and what they have
+        typed so far are written again below it
+        """
+        if not frame:
+            return
+        with self.lock:
+            if self.prompt_text is not None and self.stream.isatty():
+                typed = readline.get_line_buffer() if readline else ""
+                frame = CLEAR_LINE + frame + self.prompt_text + typed
+            self.stream.write(frame)
+            self.stream.flush()
+
+    def prompt(self, text=""):
+        """
+        Ask the user for a line of input, like input(), while messages keep being written above it
+        """
+        with self.lock:
+            self.prompt_text = text
+        try:
+            return input(text)
+        finally:
+            with self.lock:
+                self.prompt_text = None
@@ -0,0 +1,162 @@
+import os
+import threading
+import unittest
+
+import fakeredis
+import redis
+
+from redis_chatroom import RedisChatbot
+
+# Rounds each race is run for; every round starts both sides together on a barrier
+RACE_ROUNDS = 50
+# A Redis server the race tests may flush, e.g. redis://localhost:6379/15. fakeredis runs every command and
+# pipeline under one lock, so races only show up on a real server
+TEST_REDIS_URL = os.environ.get("TEST_REDIS_URL")
+
+
+class ChatScriptsTest(unittest.TestCase):
+    """
+    The identify, join and delete scripts
+    """
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.client = self.make_chatbot().client
+
+    def make_client(self):
+        return fakeredis.FakeRedis(server=self.server, decode_responses=True)
+
+    def make_chatbot(self):
+        # Each session gets its own connection to the shared server, as separate clients would
+        chatbot = RedisChatbot(client=self.make_client(), cache=False)
+        self.addCleanup(chatbot.pubsub.close)
+        return chatbot
+
+    def identify(self, chatbot, username):
+        return chatbot.save_profile(username, {"name": username, "age": "30", "gender": "n/a", "location": "n/a"})
+
+    def assert_consistent(self, username):
+        """
+        A user is either there in full (profile, private inbox, index entry) or not there at all
+        """
+        profile = self.client.exists(f"user:{username}")
+        channels = self.client.smembers(f"channels:{username}")
+        indexed = self.client.zscore("users", username) is not None
+        if profile:
+            self.assertIn(f"{username} private inbox", channels)
+            self.assertTrue(indexed)
+        else:
+            self.assertEqual(channels, set())
+            self.assertFalse(indexed)
+
+    def test_identify_creates_user(self):
+        chatbot = self.make_chatbot()
+        self.client.set("unread:alice", 3)
+        self.assertEqual(self.identify(chatbot, "alice"), 3)
+        self.assertEqual(self.client.hget("user:alice", "age"), "30")
+        self.assertEqual(self.client.smembers("channels:alice"), {"alice private inbox"})
+        self.assert_consistent("alice")
+
+    def test_identify_again_keeps_join_time(self):
+        chatbot = self.make_chatbot()
+        self.identify(chatbot, "alice")
+        joined = self.client.zscore("users", "alice")
+        self.identify(chatbot, "alice")
+        self.assertEqual(self.client.zscore("users", "alice"), joined)
+
+    def test_join_adds_channel(self):
+        chatbot = self.make_chatbot()
+        self.identify(chatbot, "alice")
+        chatbot.current_user = "alice"
+        self.assertTrue(chatbot.add_user_channel("general"))
+        self.assertIn("general", self.client.smembers("channels:alice"))
+        self.assertIn("general", self.client.smembers("channel_names"))
+
+    def test_join_after_delete_returns_0(self):
+        chatbot = self.make_chatbot()
+        self.identify(chatbot, "alice")
+        self.make_chatbot().remove_user_keys("alice")
+        chatbot.current_user = "alice"
+        self.assertEqual(chatbot.scripts.join_channel(
+            keys=["user:alice", "channels:alice", "channel_names", "channel_joins"], args=["general"]), 0)
+        self.assertFalse(chatbot.add_user_channel("general"))
+        # No orphaned channels set, and the channel was not registered
+        self.assertFalse(self.client.exists("channels:alice"))
+        self.assertNotIn("general", self.client.smembers("channel_names"))
+
+    def test_delete_removes_everything(self):
+        chatbot = self.make_chatbot()
+        self.identify(chatbot, "alice")
+        chatbot.current_user = "alice"
+        chatbot.add_user_channel("general")
+        self.client.zadd("presence", {"alice": 1})
+        self.client.hset("last_seen:alice", "general", "1-0")
+        self.client.lpush("inbox:alice", "hello")
+        self.client.set("unread:alice", 1)
+        channels = chatbot.remove_user_keys("alice")
+        self.assertEqual(set(channels), {"alice private inbox", "general"})
+        for key in ("user:alice", "channels:alice", "last_seen:alice", "inbox:alice", "unread:alice"):
+            self.assertFalse(self.client.exists(key), key)
+        self.assertIsNone(self.client.zscore("users", "alice"))
+        self.assertIsNone(self.client.zscore("presence", "alice"))
+
+
+@unittest.skipUnless(TEST_REDIS_URL, "set TEST_REDIS_URL to a Redis server the tests may flush")
+class ConcurrentChatScriptsTest(ChatScriptsTest):
+    """
+    The same tests on a real Redis server, and what is left behind when sessions race each other
+    """
+    def setUp(self):
+        self.client = self.make_client()
+        self.client.flushdb()
+        self.addCleanup(self.client.flushdb)
+
+    def make_client(self):
+        return redis.Redis.from_url(TEST_REDIS_URL, decode_responses=True)
+
+    def race(self, first, second):
+        """
+        Run two functions at the same time and return their results
+        """
+        barrier = threading.Barrier(2)
+        results = [None, None]
+
+        def run(index, function):
+            barrier.wait()
+            results[index] = function()
+
+        threads = [threading.Thread(target=run, args=(0, first)), threading.Thread(target=run, args=(1, second))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_identify_and_delete(self):
+        identifying, deleting = self.make_chatbot(), self.make_chatbot()
+        for _ in range(RACE_ROUNDS):
+            self.race(lambda: self.identify(identifying, "alice"), lambda: deleting.remove_user_keys("alice"))
+            self.assert_consistent("alice")
+
+    def test_concurrent_join_and_delete(self):
+        joining, deleting = self.make_chatbot(), self.make_chatbot()
+        joining.current_user = "alice"
+        for _ in range(RACE_ROUNDS):
+            self.identify(deleting, "alice")
+            joined, _ = self.race(lambda: joining.add_user_channel("general"),
+                                  lambda: deleting.remove_user_keys("alice"))
+            # Whichever ran first, the delete leaves no channels set behind for the deleted user
+            self.assertFalse(self.client.exists("channels:alice"))
+            self.assert_consistent("alice")
+            if not joined:
+                self.assertFalse(self.client.exists("user:alice"))
+
+    def test_concurrent_identifies_of_one_user(self):
+        first, second = self.make_chatbot(), self.make_chatbot()
+        for _ in range(RACE_ROUNDS):
+            self.race(lambda: self.identify(first, "alice"), lambda: self.identify(second, "alice"))
+            self.assert_consistent("alice")
+            self.assertEqual(self.client.zcard("users"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+
+from message_codec import CODECS, decode_envelope, make_envelope
+
+
+class MessageCodecTest(unittest.TestCase):
+    """
+    Envelopes come back unchanged from every codec
+    """
+    def test_round_trip(self):
+        envelope = make_envelope("alice", "hello", private=True, stored=True)
+        for name, codec in CODECS.items():
+            with self.subTest(codec=name):
+                self.assertEqual(decode_envelope(codec.encode(envelope)), envelope)
+
+    def test_struct_sender_over_255_bytes(self):
+        # 300 bytes in UTF-8, more than a one-byte length can hold
+        sender = "é" * 150
+        envelope = make_envelope(sender, "hello", message_id="1718000000000-0")
+        decoded = decode_envelope(CODECS["struct"].encode(envelope))
+        self.assertEqual(decoded["from"], sender)
+        self.assertEqual(decoded["id"], "1718000000000-0")
+        self.assertEqual(decoded["message"], "hello")
+
+
+if __name__ == "__main__":
+    unittest.main()